@@ -72,6 +72,8 @@ def main(global_config, **settings):
     config.include('cnxauthoring.events.main')
 
     config.include('openstax_accounts')
+    config.include('cnxauthoring.notifications')
+    config.include('cnxauthoring.publications')
     # authorization policy must be set if an authentication policy is set
     config.set_authentication_policy(
         config.registry.getUtility(IOpenstaxAccountsAuthenticationPolicy))
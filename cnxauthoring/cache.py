@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""In process caches"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe mapping that holds up to ``max_size`` of values,
+    dropping the least recently used values to make room. The size of
+    a value is given by ``sizeof`` (each value counts as one by default).
+    Values set with a ``ttl`` expire after that many seconds.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        item = self._items.get(key)
+        return item is not None and not _expired(item)
+
+    def get(self, key, default=None):
+        """The ``key`` value, which becomes the most recently used."""
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                return default
+            if _expired(item):
+                self.size -= item[1]
+                return default
+            self._items[key] = item
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """Set the ``key`` value, unless it is larger than the cache.
+        The value expires after ``ttl`` seconds, if given.
+        """
+        size = self.sizeof(value)
+        expires = None if ttl is None else time.time() + float(ttl)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return
+            self._items[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                self._pop(next(iter(self._items)))
+
+    def _pop(self, key):
+        try:
+            value, size, expires = self._items.pop(key)
+        except KeyError:
+            return None
+        self.size -= size
+        return value
+
+    def pop(self, key, default=None):
+        """Remove the ``key`` value and return it."""
+        with self._lock:
+            item = self._items.get(key)
+            value = self._pop(key)
+        if value is None or _expired(item):
+            return default
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class ResponseCache(object):
+    """Bodies of HTTP responses by url, along with their ETag (or None),
+    kept in memory up to ``max_size`` bytes and, given a ``directory``,
+    on disk, where they outlive the process.
+    """
+
+    def __init__(self, max_size, directory=None):
+        self.memory = LRUCache(int(max_size), lambda item: len(item[1]))
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """The ``(etag, body)`` of the ``url`` response, or None."""
+        item = self.memory.get(url)
+        if item is None and self.directory:
+            try:
+                with open(self._path(url), 'rb') as f:
+                    etag, body = f.read().split(b'\n', 1)
+            except (IOError, OSError, ValueError):
+                return None
+            item = (etag.decode('utf-8') or None, body)
+            self.memory.set(url, item)
+        return item
+
+    def set(self, url, etag, body):
+        """Keep the ``body`` of the ``url`` response and its ``etag``."""
+        self.memory.set(url, (etag, body))
+        if not self.directory:
+            return
+        # Written to a temporary file first, so that readers never see
+        # part of a response.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write((etag or '').encode('utf-8') + b'\n' + body)
+            os.rename(temp_path, self._path(url))
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+def _expired(item):
+    expires = item[2]
+    return expires is not None and expires <= time.time()
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key, so that only one of
+    them is made while the others wait for and share its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func, *args, **kwargs):
+        """Return ``func(*args, **kwargs)``, or the result of the call
+        for ``key`` already in progress in another thread. Its exception
+        is raised in all the waiting threads, should it fail.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
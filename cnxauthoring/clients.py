@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""HTTP clients of the services authoring uses (i.e. archive and
+publishing)"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from pyramid.threadlocal import get_current_registry
+
+
+# The ``<service>.*`` settings of a client, as ``ServiceClient`` arguments.
+CLIENT_SETTINGS = ('pool-size', 'connect-timeout', 'read-timeout',)
+
+
+class ServiceClient(object):
+    """Makes HTTP requests to a service, keeping up to ``pool_size``
+    connections (i.e. one per worker thread) alive between requests.
+    Requests time out after ``connect_timeout`` seconds of connecting or
+    ``read_timeout`` seconds of waiting for the response.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=60):
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=int(pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        """Create the client of the ``name`` service from its
+        ``<name>.pool-size``, ``<name>.connect-timeout`` and
+        ``<name>.read-timeout`` settings.
+        """
+        kwargs = {}
+        for setting in CLIENT_SETTINGS:
+            key = '{}.{}'.format(name, setting)
+            if key in settings:
+                kwargs[setting.replace('-', '_')] = settings[key]
+        return cls(**kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.delete(url, **kwargs)
+
+
+_lock = threading.Lock()
+
+
+def get_client(name, registry=None):
+    """The client of the ``name`` service (e.g. 'publishing'),
+    shared by the application of the ``registry``.
+    """
+    if registry is None:
+        registry = get_current_registry()
+    with _lock:
+        clients = getattr(registry, 'service_clients', None)
+        if clients is None:
+            clients = registry.service_clients = {}
+        if name not in clients:
+            clients[name] = ServiceClient.from_settings(
+                registry.settings or {}, name)
+        return clients[name]
@@ -14,11 +14,11 @@ except ImportError:
     import urlparse
 
 import cnxepub.models as cnxepub
-import requests
 from pyramid.events import subscriber, ApplicationCreated
 from pyramid.security import Allow, Authenticated
 
 from . import utils
+from .clients import get_client
 # BBB 12-Nov-2014 Moved TZINFO to utils
 from .utils import TZINFO
 
@@ -55,6 +55,16 @@ class ArchiveConnectionError(Exception):
         return self.message
 
 
+class PublishingConnectionError(Exception):
+
+    def __init__(self, message=None, timeout=False):
+        self.message = message
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.message
+
+
 class PublishingError(Exception):
 
     def __init__(self, response):
@@ -99,7 +109,7 @@ def initialize_licenses(event):
 
     # Contact archive for an authoritative list of licenses.
     url = urlparse.urljoin(archive_url, '/extras')
-    response = requests.get(url)
+    response = get_client('archive', event.app.registry).get(url)
     licenses = response.json()['licenses']
 
     LICENSES = []
@@ -159,6 +169,38 @@ class Resource(cnxepub.Resource):
                 )
 
 
+class StoredResource(Resource):
+    """A ``Resource`` retrieved from storage, whose data is only read
+    when it is opened. ``opener`` is a callable returning a file-like
+    object of the data. ``path`` is set when the data is a local file.
+    """
+
+    def __init__(self, mediatype, hash, opener, size=None, path=None):
+        # The hash is known, so the data isn't read to compute it.
+        self._hash = hash
+        self.id = hash
+        self.media_type = mediatype
+        self.filename = hash
+        self.size = size
+        self.path = path
+        self._opener = opener
+        self._loaded_data = None
+
+    def stream(self):
+        """Open the data for reading, without loading all of it."""
+        return self._opener()
+
+    @property
+    def _data(self):
+        if self._loaded_data is None:
+            f = self._opener()
+            try:
+                self._loaded_data = io.BytesIO(f.read())
+            finally:
+                f.close()
+        return self._loaded_data
+
+
 class BaseContent(object):
     """A base class for common code in Document and Binder
     """
@@ -228,16 +270,50 @@ class Document(cnxepub.Document, BaseContent):
     """
     mediatype = DOCUMENT_MEDIATYPE
 
-    def __init__(self, title, acls=None,
-                 licensor_acceptance=None, **kwargs):
+    def __init__(self, title, acls=None, licensor_acceptance=None,
+                 publishing_fingerprints=None, lazy=False, **kwargs):
         metadata = build_metadata(title, **kwargs)
         metadata['media_type'] = self.mediatype
         id = str(metadata['id'])
         content = metadata['content']
-        cnxepub.Document.__init__(self, id, content, metadata)
+        if lazy:
+            # The content is parsed on first use (see ``_xml``).
+            cnxepub.Document.__init__(self, id, '', metadata)
+            self.__dict__['_unparsed_content'] = content
+        else:
+            cnxepub.Document.__init__(self, id, content, metadata)
         self.acls = acls and acls or {}
         la = licensor_acceptance
         self.licensor_acceptance = la and la or []
+        # The fingerprints of what was last declared within publishing.
+        self.publishing_fingerprints = publishing_fingerprints or {}
+
+    def _parse_content(self):
+        content = self.__dict__.get('_unparsed_content')
+        if content is not None:
+            # (setting ``_xml`` drops the unparsed content)
+            cnxepub.Document.content.fset(self, content)
+
+    # The parsed content and its references, which are what the
+    # ``content`` and ``references`` of ``cnxepub.Document`` use.
+    @property
+    def _xml(self):
+        self._parse_content()
+        return self.__dict__['_xml']
+
+    @_xml.setter
+    def _xml(self, value):
+        self.__dict__.pop('_unparsed_content', None)
+        self.__dict__['_xml'] = value
+
+    @property
+    def _references(self):
+        self._parse_content()
+        return self.__dict__['_references']
+
+    @_references.setter
+    def _references(self, value):
+        self.__dict__['_references'] = value
 
     def update(self, **kwargs):
         super(Document, self).update(**kwargs)
@@ -414,18 +490,54 @@ class Binder(cnxepub.Binder, BaseContent):
     """
     mediatype = BINDER_MEDIATYPE
 
-    def __init__(self, title, tree, acls=None,
-                 licensor_acceptance=None, **kwargs):
+    def __init__(self, title, tree, acls=None, licensor_acceptance=None,
+                 publishing_fingerprints=None, lazy=False, **kwargs):
         metadata = build_metadata(title, **kwargs)
         metadata['media_type'] = self.mediatype
         id = str(metadata['id'])
-        nodes, title_overrides = build_tree(tree)
-        cnxepub.Binder.__init__(
-            self, id, nodes=nodes, metadata=metadata,
-            title_overrides=title_overrides)
+        if lazy:
+            # The tree is built on first use (see ``_nodes``).
+            cnxepub.Binder.__init__(self, id, metadata=metadata)
+            self.__dict__['_unbuilt_tree'] = tree
+        else:
+            nodes, title_overrides = build_tree(tree)
+            cnxepub.Binder.__init__(
+                self, id, nodes=nodes, metadata=metadata,
+                title_overrides=title_overrides)
         self.acls = acls and acls or {}
         la = licensor_acceptance
         self.licensor_acceptance = la and la or []
+        # The fingerprints of what was last declared within publishing.
+        self.publishing_fingerprints = publishing_fingerprints or {}
+
+    def _build_tree(self):
+        tree = self.__dict__.get('_unbuilt_tree')
+        if tree is not None:
+            nodes, title_overrides = build_tree(tree)
+            self.__dict__.pop('_unbuilt_tree')
+            self.__dict__['_nodes'] = nodes
+            self.__dict__['_title_overrides'] = title_overrides
+
+    # The nodes and their titles, which ``cnxepub.Binder`` is built on.
+    @property
+    def _nodes(self):
+        self._build_tree()
+        return self.__dict__['_nodes']
+
+    @_nodes.setter
+    def _nodes(self, value):
+        self.__dict__.pop('_unbuilt_tree', None)
+        self.__dict__['_nodes'] = value
+
+    @property
+    def _title_overrides(self):
+        self._build_tree()
+        return self.__dict__['_title_overrides']
+
+    @_title_overrides.setter
+    def _title_overrides(self, value):
+        self.__dict__.pop('_unbuilt_tree', None)
+        self.__dict__['_title_overrides'] = value
 
     def update(self, **kwargs):
         if 'tree' in kwargs:
@@ -471,9 +583,36 @@ class Binder(cnxepub.Binder, BaseContent):
         return data
 
 
-def create_content(**appstruct):
-    """Given a Colander *appstruct*, create a content object."""
+class ContentSummary(object):
+    """The listing information of a ``Document`` or ``Binder``, as retrieved
+    without its content or building the full model.
+    """
+    # The metadata fields of a summary.
+    fields = ('id', 'media_type', 'title', 'version', 'revised',
+              'derived_from', 'state', 'publication', 'contained_in',
+              ) + tuple(cnxepub.ATTRIBUTED_ROLE_KEYS)
+
+    def __init__(self, **metadata):
+        self.metadata = {field: metadata.get(field) for field in self.fields}
+        self.metadata['id'] = self.id = str(metadata['id'])
+        self.metadata['contained_in'] = metadata.get('contained_in') or []
+        for role_key in cnxepub.ATTRIBUTED_ROLE_KEYS:
+            self.metadata[role_key] = metadata.get(role_key) or []
+
+    def __json__(self, request=None):
+        result = self.metadata.copy()
+        result['revised'] = result['revised'].astimezone(TZINFO).isoformat()
+        utils.change_dict_keys(result, utils.underscore_to_camelcase)
+        return result
+
+
+def create_content(lazy=False, **appstruct):
+    """Given a Colander *appstruct*, create a content object.
+    When ``lazy`` is true, the document content is parsed and the binder
+    tree is built when first used rather than right away.
+    """
     kwargs = appstruct.copy()
+    kwargs['lazy'] = lazy
     # TODO Lookup via storage.
     for li_arg in ('license', 'original_license'):
         license = appstruct.get(li_arg)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Messages to users, which are added to an outbox in storage along with
+the changes of the request and sent through accounts in the background.
+"""
+import datetime
+import logging
+import threading
+
+from openstax_accounts.interfaces import IOpenstaxAccounts
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+
+from .utils import TZINFO
+
+
+logger = logging.getLogger('cnxauthoring')
+
+# The ``notifications.*`` settings of the dispatcher,
+# as ``NotificationDispatcher`` arguments.
+DISPATCHER_SETTINGS = ('batch-size', 'poll-interval', 'retry-delay',
+                       'max-retry-delay', 'max-attempts',)
+
+
+def enqueue_notification(user_id, subject, body):
+    """Add a message to the user to the outbox, from which it is sent
+    once the changes of the current request are persisted.
+    """
+    from .storage import storage
+
+    storage.add_notifications([{
+        'user_id': user_id,
+        'subject': subject,
+        'body': body,
+        }])
+    request = get_current_request()
+    dispatcher = getattr(request and request.registry,
+                         'notification_dispatcher', None)
+    if dispatcher is not None:
+        # Send it right away rather than at the next poll.
+        request.add_finished_callback(lambda request: dispatcher.wake())
+
+
+class NotificationDispatcher(object):
+    """Sends the messages in the outbox of the ``storage`` through the
+    accounts utility of the ``registry``, in a background thread.
+
+    Up to ``batch_size`` messages are sent at a time, in a transaction.
+    The outbox is checked every ``poll_interval`` seconds, or when woken
+    after a request has added messages to it. Messages that fail to send
+    are retried after ``retry_delay`` seconds, doubling with each attempt
+    up to ``max_retry_delay``, and left in the outbox once they have been
+    attempted ``max_attempts`` times.
+    """
+
+    def __init__(self, storage, registry, batch_size=20, poll_interval=5,
+                 retry_delay=30, max_retry_delay=3600, max_attempts=10):
+        self.storage = storage
+        self.registry = registry
+        self.batch_size = int(batch_size)
+        self.poll_interval = float(poll_interval)
+        self.retry_delay = float(retry_delay)
+        self.max_retry_delay = float(max_retry_delay)
+        self.max_attempts = int(max_attempts)
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls, settings, storage, registry):
+        """Create the dispatcher from the ``notifications.*`` settings."""
+        kwargs = {}
+        for setting in DISPATCHER_SETTINGS:
+            key = 'notifications.{}'.format(setting)
+            if key in settings:
+                kwargs[setting.replace('-', '_')] = settings[key]
+        return cls(storage, registry, **kwargs)
+
+    def start(self):
+        """Start sending messages in a background thread."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run,
+                                        name='notification-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, after the batch it is sending."""
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Check the outbox now rather than at the next poll."""
+        self._wake.set()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                attempted = self.dispatch()
+            except Exception:
+                logger.exception('Failed dispatching notifications')
+                attempted = 0
+            if attempted < self.batch_size:
+                # The outbox has no more messages due.
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _next_attempt(self, attempts):
+        delay = min(self.retry_delay * 2 ** attempts, self.max_retry_delay)
+        return datetime.datetime.now(TZINFO) + \
+            datetime.timedelta(seconds=delay)
+
+    def dispatch(self):
+        """Send a batch of the messages due to be sent.
+        Returns the number of messages attempted.
+        """
+        storage = self.storage
+        accounts = self.registry.getUtility(IOpenstaxAccounts)
+        try:
+            notifications = storage.get_notifications(self.batch_size,
+                                                      self.max_attempts)
+            sent = []
+            for notification in notifications:
+                try:
+                    accounts.send_message(notification['user_id'],
+                                          notification['subject'],
+                                          notification['body'])
+                except Exception as exc:
+                    attempts = notification['attempts'] + 1
+                    logger.warning(
+                        "Failed sending notification message to {} "
+                        "(attempt {} of {}): {}".format(
+                            notification['user_id'], attempts,
+                            self.max_attempts, exc))
+                    storage.reschedule_notification(
+                        notification['id'],
+                        self._next_attempt(notification['attempts']),
+                        str(exc))
+                else:
+                    sent.append(notification['id'])
+            storage.remove_notifications(sent)
+            storage.persist()
+        except storage.Error:
+            try:
+                storage.abort()
+            except storage.Error:
+                storage.restart()
+            raise
+        return len(notifications)
+
+
+def includeme(config):
+    """Send the notifications in the background, unless the
+    ``notifications.dispatch`` setting is false.
+    """
+    from . import storage
+
+    settings = config.registry.settings
+    if not asbool(settings.get('notifications.dispatch', True)):
+        return
+    dispatcher = NotificationDispatcher.from_settings(
+        settings, storage.storage, config.registry)
+    config.registry.notification_dispatcher = dispatcher
+    config.action(None, dispatcher.start, order=1)
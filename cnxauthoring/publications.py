@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""The states of the publications in progress in publishing, which are
+polled in the background and kept up to date in storage.
+"""
+import datetime
+import json
+import logging
+import threading
+from collections import OrderedDict
+try:
+    import urlparse  # python2
+except ImportError:
+    import urllib.parse as urlparse  # renamed in python3
+
+import requests
+from pyramid.settings import asbool
+
+from .cache import LRUCache, SingleFlight
+from .clients import get_client
+from .utils import TZINFO
+
+
+logger = logging.getLogger('cnxauthoring')
+
+# The ``publications.*`` settings of the poller,
+# as ``PublicationPoller`` arguments.
+POLLER_SETTINGS = ('batch-size', 'poll-interval',)
+
+# States a publication doesn't leave, which are cached for good.
+FINAL_STATES = ('Done/Success', 'Failed/Error',)
+
+_lock = threading.Lock()
+
+
+class PublicationStates(object):
+    """The states of publications looked up in publishing, shared by the
+    application. States are cached for ``ttl`` seconds, or for good once
+    final, in a cache of up to ``max_size`` publications. Concurrent
+    lookups of a publication make a single request to publishing.
+    """
+
+    def __init__(self, registry, ttl=5, max_size=10000):
+        self.registry = registry
+        self.ttl = float(ttl)
+        self.cache = LRUCache(int(max_size))
+        self._flights = SingleFlight()
+
+    @classmethod
+    def from_settings(cls, settings, registry):
+        """Create the states from the ``publications.state-*`` settings."""
+        return cls(registry,
+                   ttl=settings.get('publications.state-ttl', 5),
+                   max_size=settings.get('publications.state-cache-size',
+                                         10000))
+
+    def get(self, publication):
+        """The state of the ``publication``, or None when it can't be told.
+        """
+        key = str(publication)
+        state = self.cache.get(key)
+        if state is None:
+            state = self._flights.call(key, self._lookup, key)
+        return state
+
+    def is_final(self, publication):
+        """Whether the ``publication`` is cached in a final state."""
+        return self.cache.get(str(publication)) in FINAL_STATES
+
+    def refresh(self, publication):
+        """Look up the state of the ``publication`` in publishing,
+        rather than in the cache, and cache it.
+        """
+        key = str(publication)
+        return self._flights.call(key, self._request, key)
+
+    def _lookup(self, publication):
+        # Another lookup may have finished since the cache was checked.
+        state = self.cache.get(publication)
+        if state is not None:
+            return state
+        return self._request(publication)
+
+    def _request(self, publication):
+        state = _request_publication_state(publication, self.registry)
+        if state in FINAL_STATES:
+            self.cache.set(publication, state)
+        elif state is not None and self.ttl > 0:
+            self.cache.set(publication, state, ttl=self.ttl)
+        return state
+
+
+def get_publication_states(registry):
+    """The publication states shared by the application of the
+    ``registry``.
+    """
+    with _lock:
+        states = getattr(registry, 'publication_states', None)
+        if states is None:
+            states = registry.publication_states = \
+                PublicationStates.from_settings(registry.settings or {},
+                                                registry)
+        return states
+
+
+def get_publication_state(publication, registry):
+    """The state of the ``publication`` in publishing,
+    or None when it can't be told.
+    """
+    return get_publication_states(registry).get(publication)
+
+
+def _request_publication_state(publication, registry):
+    publishing_url = registry.settings['publishing.url']
+    url = urlparse.urljoin(publishing_url,
+                           'publications/{}'.format(publication))
+    try:
+        response = get_client('publishing', registry).get(url)
+    except requests.exceptions.RequestException:
+        # e.g. publishing is down or slow; try again on the next lookup.
+        logger.warning('Failed to look up the state of publication {}'
+                       .format(publication), exc_info=True)
+        return None
+    if response.status_code != 200:
+        return None
+    try:
+        return json.loads(response.content.decode('utf-8'))['state']
+    except (TypeError, ValueError, KeyError):
+        # Not critical if there's a json problem here.
+        return None
+
+
+def get_poller(registry):
+    """The publication poller of the application, if it is polling."""
+    return getattr(registry, 'publication_poller', None)
+
+
+class PublicationPoller(object):
+    """Polls publishing for the states of the publications in progress in
+    the ``storage``, in a background thread, and updates the documents
+    when their publication's state changes.
+
+    Every ``poll_interval`` seconds, or when woken after a publication,
+    the state of each publication in progress is requested once, however
+    many documents are in it. The documents of up to ``batch_size``
+    publications are updated at a time, in a transaction.
+    """
+
+    def __init__(self, storage, registry, batch_size=20, poll_interval=10):
+        self.storage = storage
+        self.registry = registry
+        self.batch_size = int(batch_size)
+        self.poll_interval = float(poll_interval)
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls, settings, storage, registry):
+        """Create the poller from the ``publications.*`` settings."""
+        kwargs = {}
+        for setting in POLLER_SETTINGS:
+            key = 'publications.{}'.format(setting)
+            if key in settings:
+                kwargs[setting.replace('-', '_')] = settings[key]
+        return cls(storage, registry, **kwargs)
+
+    def start(self):
+        """Start polling in a background thread."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run,
+                                        name='publication-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, after the poll it is making."""
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Poll now rather than at the next interval."""
+        self._wake.set()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Failed polling publication states')
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _abort(self):
+        storage = self.storage
+        try:
+            storage.abort()
+        except storage.Error:
+            storage.restart()
+
+    def poll(self):
+        """Update the documents of the publications whose state has
+        changed. Returns the number of publications polled.
+        """
+        storage = self.storage
+        try:
+            pending = storage.get_pending_publications()
+            storage.persist()
+        except storage.Error:
+            self._abort()
+            raise
+        documents = OrderedDict()
+        for document in pending:
+            documents.setdefault(document['publication'], []).append(document)
+        publications = list(documents)
+
+        publication_states = get_publication_states(self.registry)
+        for i in range(0, len(publications), self.batch_size):
+            batch = publications[i:i + self.batch_size]
+            states = {}
+            for publication in batch:
+                try:
+                    if publication_states.is_final(publication):
+                        # It can't change, so isn't requested again.
+                        states[publication] = publication_states.get(
+                            publication)
+                    else:
+                        states[publication] = publication_states.refresh(
+                            publication)
+                except Exception:
+                    logger.exception('Failed polling the state of '
+                                     'publication {}'.format(publication))
+            try:
+                revised = datetime.datetime.now(TZINFO)
+                for publication, state in states.items():
+                    if state is None:
+                        continue
+                    for document in documents[publication]:
+                        if document['state'] == state:
+                            continue
+                        # Unless it has been published again since.
+                        storage.update_document_state(
+                            document['id'], publication, state, revised)
+                storage.persist()
+            except storage.Error:
+                self._abort()
+                raise
+        return len(publications)
+
+
+def includeme(config):
+    """Poll the publication states in the background, unless the
+    ``publications.poll`` setting is false.
+    """
+    from . import storage
+
+    settings = config.registry.settings
+    if not asbool(settings.get('publications.poll', True)):
+        return
+    poller = PublicationPoller.from_settings(
+        settings, storage.storage, config.registry)
+    config.registry.publication_poller = poller
+    config.action(None, poller.start, order=1)
@@ -11,7 +11,7 @@ import sys
 import argparse
 
 import psycopg2
-from ..storage.database import CONNECTION_SETTINGS_KEY, initdb
+from ..storage.database import CONNECTION_SETTINGS_KEY, initdb, migrate
 from .utils import parse_app_settings
 
 # FIXME These locations are also 'constants' in the tests module.
@@ -27,12 +27,19 @@ EXAMPLE_DATA_FILEPATHS = (
 def main(argv=None):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('config_uri', help="Configuration INI file.")
+    parser.add_argument('--migrate', action='store_true',
+                        help="Bring an existing database up to date by "
+                             "applying the schema migrations.")
 #    parser.add_argument('--with-example-data', action='store_true',
 #                        help="Initializes the database with example data.")
     args = parser.parse_args(argv)
 
     settings = parse_app_settings(args.config_uri)
-    initdb(settings)
+    if args.migrate:
+        for version in migrate(settings):
+            print('Applied migration {}'.format(version))
+    else:
+        initdb(settings)
 
 #    if args.with_example_data:
 #        connection_string = settings[CONNECTION_SETTINGS_KEY]
@@ -9,5 +9,6 @@
 storage = None
 storages = {
     'postgresql': ('postgresql', 'PostgresqlStorage'),
+    'memory': ('memory', 'MemoryStorage'),
     }
-default_storage = storages.keys()[0]
+default_storage = 'postgresql'
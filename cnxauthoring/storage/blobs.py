@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Content addressed storage of resource data"""
+import errno
+import os
+import re
+import tempfile
+
+
+HASH_PATTERN = re.compile('^[0-9a-f]+$')
+
+
+class FilesystemBlobStore(object):
+    """Stores blobs (resource data) on the local filesystem by hash in
+    sharded directories, e.g. ``<directory>/ab/cd/abcdef0123...``.
+    """
+
+    def __init__(self, directory, depth=2, width=2):
+        self.directory = os.path.abspath(directory)
+        self.depth = depth
+        self.width = width
+
+    def path(self, hash):
+        """The filesystem path of the blob for ``hash``."""
+        if not HASH_PATTERN.match(hash):
+            raise ValueError("Invalid hash '{}'".format(hash))
+        shards = [hash[i * self.width:(i + 1) * self.width]
+                  for i in range(self.depth)]
+        return os.path.join(self.directory, *(shards + [hash]))
+
+    def exists(self, hash):
+        return os.path.exists(self.path(hash))
+
+    def open(self, hash):
+        """Open the blob for ``hash`` for reading."""
+        return open(self.path(hash), 'rb')
+
+    def write(self, hash, data):
+        """Write the ``data`` (bytes) of the blob for ``hash``.
+        The blob is written to a temporary file first and moved into place,
+        so readers never see a partially written blob.
+        """
+        path = self.path(hash)
+        if os.path.exists(path):
+            # Content addressed, the blob is already stored.
+            return path
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return path
+
+    def remove(self, hash):
+        """Remove the blob for ``hash``, if it exists."""
+        try:
+            os.remove(self.path(hash))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
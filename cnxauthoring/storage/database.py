@@ -18,39 +18,163 @@ here = os.path.abspath(os.path.dirname(__file__))
 SQL_DIRECTORY = os.path.join(here, 'sql')
 DB_SCHEMA_DIRECTORY = os.path.join(SQL_DIRECTORY, 'schema')
 DB_SCHEMA_FILES = (
+    'schema-migrations.sql',
     'document.sql',
+    'document-search.sql',
     'resource.sql',
     'document-acl.sql',
     'document-licensor-acceptance.sql',
+    'notification-outbox.sql',
     )
 
 DB_SCHEMA_FILE_PATHS = tuple([os.path.join(DB_SCHEMA_DIRECTORY, dsf)
                               for dsf in DB_SCHEMA_FILES])
 
+# The changes to bring an existing database up to date with the schema,
+# as (version, sql files relative to the sql directory) in the order
+# they are applied. A freshly initialized database has all of them.
+# Migrations using CREATE INDEX CONCURRENTLY can't run in a transaction
+# and must consist of only that statement. Batched statements (those taking
+# a ``%(batch_size)s`` argument) run after the others until they no longer
+# change a full batch, each batch in its own transaction. The version is
+# recorded after them, so the other statements of such a migration must
+# be safe to run again.
+MIGRATIONS = (
+    ('0001', ('migrations/0001-resource-size.sql',
+              'migrations/0001-resource-size-backfill.sql',)),
+    ('0002', ('migrations/0002-document-search-vector.sql',
+              'migrations/0002-document-search-vector-trigger.sql',
+              'migrations/0002-document-search-vector-backfill.sql',)),
+    ('0003', ('migrations/0003-document-search-vector-index.sql',)),
+    ('0004', ('migrations/0004-document-acl-user-id-permission-index.sql',)),
+    ('0005', ('migrations/0005-document-contained-in-index.sql',)),
+    ('0006', ('migrations/0006-document-submitter-id-index.sql',)),
+    ('0007', ('migrations/0007-document-revised-id-index.sql',)),
+    ('0008', ('migrations/0008-document-publishing-fingerprints.sql',)),
+    ('0009', ('schema/notification-outbox.sql',)),
+    ('0010', ('migrations/0010-document-publication-pending-index.sql',)),
+    )
+
 
 def _read_sql_file(name):
     path = os.path.join(SQL_DIRECTORY, '{}.sql'.format(name))
     with open(path, 'r') as fp:
         return fp.read()
 SQL = {
+    'add-schema-migration': _read_sql_file('add-schema-migration'),
+    'get-schema-migrations': _read_sql_file('get-schema-migrations'),
     'get': _read_sql_file('get'),
     'get-document': _read_sql_file('get-document'),
+    'get-document-acls': _read_sql_file('get-document-acls'),
+    'get-document-version': _read_sql_file('get-document-version'),
+    'get-document-licensor-acceptances': _read_sql_file(
+        'get-document-licensor-acceptances'),
+    'get-notifications': _read_sql_file('get-notifications'),
+    'get-pending-publications': _read_sql_file('get-pending-publications'),
+    'get-resource': _read_sql_file('get-resource'),
+    'get-resource-chunk': _read_sql_file('get-resource-chunk'),
+    'get-resource-hashes': _read_sql_file('get-resource-hashes'),
     'add-document': _read_sql_file('add-document'),
     'add-document-acl': _read_sql_file('add-document-acl'),
+    'add-document-containment': _read_sql_file('add-document-containment'),
     'add-document-licensor-acceptance': _read_sql_file(
         'add-document-licensor-acceptance'),
+    'add-notification': _read_sql_file('add-notification'),
     'add-resource': _read_sql_file('add-resource'),
     'delete-document': _read_sql_file('delete-document'),
     'delete-document-acl': _read_sql_file('delete-document-acl'),
+    'delete-document-acl-entry': _read_sql_file('delete-document-acl-entry'),
+    'delete-document-containment': _read_sql_file(
+        'delete-document-containment'),
     'delete-document-licensor-acceptance': _read_sql_file(
         'delete-document-licensor-acceptance'),
+    'delete-document-licensor-acceptance-entry': _read_sql_file(
+        'delete-document-licensor-acceptance-entry'),
+    'delete-notifications': _read_sql_file('delete-notifications'),
     'delete-resource': _read_sql_file('delete-resource'),
     'update-document': _read_sql_file('update-document'),
+    'update-document-state': _read_sql_file('update-document-state'),
+    'update-document-licensor-acceptance': _read_sql_file(
+        'update-document-licensor-acceptance'),
+    'update-notification': _read_sql_file('update-notification'),
     'update-resource': _read_sql_file('update-resource'),
-    'search-title': _read_sql_file('search-title'),
+    'search-document': _read_sql_file('search-document'),
     }
 
 
+# Matches ``%(name)s``, ``%s`` and ``%%`` style placeholders,
+# as well as any unsupported ones (e.g. ``%d``).
+_PLACEHOLDER = re.compile(r'%(?:\((?P<name>[^)]*)\))?(?P<conversion>.)', re.S)
+_PARAMS = {}
+
+
+def parse_params(sql):
+    """Parse the parameter names used in the ``sql`` statement,
+    in order of first appearance. Raises ``ValueError`` for unsupported
+    placeholders or a mix of named and positional placeholders.
+    """
+    names = []
+    positional = False
+    for match in _PLACEHOLDER.finditer(sql):
+        name, conversion = match.group('name', 'conversion')
+        if name is None and conversion == '%':
+            continue
+        if conversion != 's':
+            raise ValueError("Unsupported placeholder '{}'"
+                             .format(match.group(0)))
+        if name is None:
+            positional = True
+        elif name not in names:
+            names.append(name)
+        if positional and names:
+            raise ValueError("Mixed named and positional placeholders")
+    return tuple(names)
+
+
+def statement_params(sql):
+    """The (cached) parameter names of the ``sql`` statement."""
+    try:
+        return _PARAMS[sql]
+    except KeyError:
+        params = _PARAMS[sql] = parse_params(sql)
+        return params
+
+
+_RENDERED = {}
+
+
+def render_sql(name, **fields):
+    """Fill in the ``str.format`` fields (e.g. ``where_clause``) of the
+    ``name`` statement. The result is cached, so that equal statements are
+    the same text and can be prepared once.
+    """
+    key = (name,) + tuple(sorted(fields.items()))
+    try:
+        return _RENDERED[key]
+    except KeyError:
+        sql = _RENDERED[key] = SQL[name].format(**fields)
+        return sql
+
+
+def _split_insert(sql):
+    """Split a single row ``INSERT ... VALUES (...)`` statement into its
+    multi-row form and row template (for ``execute_values``).
+    """
+    idx = sql.upper().rindex('VALUES')
+    template = sql[idx + len('VALUES'):].strip().rstrip(';').rstrip()
+    return (sql[:idx] + 'VALUES %s', template)
+BULK_SQL = {name: _split_insert(SQL[name]) for name in (
+    'add-document',
+    'add-document-acl',
+    'add-document-licensor-acceptance',
+    'add-notification',
+    )}
+# Compile the statements' parameters, which also validates them.
+for _sql in list(SQL.values()) + [
+        statement for bulk in BULK_SQL.values() for statement in bulk]:
+    statement_params(_sql)
+
+
 def initdb(settings, clear=False):
     """Initialize the database from the given settings. If clear is true, drop
        tables first.
@@ -71,3 +195,97 @@ def initdb(settings, clear=False):
             for filepath in sql_constants:
                 with open(filepath, 'r') as f:
                     cursor.execute(f.read())
+            # The schema is up to date, so no migration needs applying.
+            cursor.execute(SQL['add-schema-migration'],
+                           {'versions': [v for v, files in MIGRATIONS]})
+
+
+def _is_concurrent(sql):
+    return 'CONCURRENTLY' in sql.upper()
+
+
+# The number of rows changed per transaction by batched migrations.
+MIGRATION_BATCH_SIZE = 1000
+
+
+def _is_batched(sql):
+    return '%(batch_size)s' in sql
+
+
+def _execute_batched(db_connection, sql, batch_size):
+    """Execute the batched ``sql`` statement until it changes less than
+    ``batch_size`` rows, committing after each batch.
+    """
+    while True:
+        with db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute(sql, {'batch_size': batch_size})
+                if cursor.rowcount < batch_size:
+                    return
+
+
+def migrate(settings, batch_size=MIGRATION_BATCH_SIZE):
+    """Apply the migrations that haven't been applied to the database from
+    the given settings. Batched statements change up to ``batch_size`` rows
+    per transaction. Returns the versions of the applied migrations.
+    """
+    applied = []
+    connection_string = settings[CONNECTION_SETTINGS_KEY]
+    db_connection = psycopg2.connect(connection_string)
+    try:
+        with db_connection:
+            with db_connection.cursor() as cursor:
+                schema_migrations = os.path.join(
+                    DB_SCHEMA_DIRECTORY, 'schema-migrations.sql')
+                with open(schema_migrations, 'r') as f:
+                    cursor.execute(f.read())
+                cursor.execute(SQL['get-schema-migrations'])
+                done = set([row[0] for row in cursor.fetchall()])
+
+        for version, filenames in MIGRATIONS:
+            if version in done:
+                continue
+            statements = []
+            for filename in filenames:
+                with open(os.path.join(SQL_DIRECTORY, filename), 'r') as f:
+                    statements.append(f.read())
+            batched = [statement for statement in statements
+                       if _is_batched(statement)]
+            statements = [statement for statement in statements
+                          if not _is_batched(statement)]
+            # The version is recorded with the statements, unless it has to
+            # wait for the batches.
+            record = [] if batched else [version]
+            if any(_is_concurrent(statement) for statement in statements):
+                # Indexes are built concurrently so that the tables
+                # remain writable, which isn't possible in a transaction.
+                db_connection.autocommit = True
+                try:
+                    with db_connection.cursor() as cursor:
+                        for statement in statements:
+                            cursor.execute(statement)
+                        cursor.execute(SQL['add-schema-migration'],
+                                       {'versions': record})
+                finally:
+                    db_connection.autocommit = False
+            else:
+                with db_connection:
+                    with db_connection.cursor() as cursor:
+                        for statement in statements:
+                            cursor.execute(statement)
+                        cursor.execute(SQL['add-schema-migration'],
+                                       {'versions': record})
+            if batched:
+                # Rows are changed a batch at a time, so that they aren't
+                # all locked until the end and an interrupted migration
+                # continues where it stopped.
+                for statement in batched:
+                    _execute_batched(db_connection, statement, batch_size)
+                with db_connection:
+                    with db_connection.cursor() as cursor:
+                        cursor.execute(SQL['add-schema-migration'],
+                                       {'versions': [version]})
+            applied.append(version)
+    finally:
+        db_connection.close()
+    return applied
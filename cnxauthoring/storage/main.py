@@ -26,6 +26,45 @@ class BaseStorage:
         """Updates any item or set of items in storage."""
         raise NotImplementedError()
 
+    def update_containment(self, binder_id, document_ids):
+        """Updates which documents are in the binder (by their
+        ``contained_in``) to those of the ``document_ids``."""
+        raise NotImplementedError()
+
+    def get_pending_publications(self):
+        """Retrieve the ``id``, ``publication`` and ``state`` (as dicts)
+        of the documents with a publication in progress in publishing,
+        ordered by publication."""
+        raise NotImplementedError()
+
+    def update_document_state(self, id, publication, state, revised):
+        """Sets the ``state`` and ``revised`` time of the document ``id``
+        of the ``publication``, unless it has been published again since
+        or already has the state. Returns whether it was updated."""
+        raise NotImplementedError()
+
+    def add_notifications(self, notifications):
+        """Adds the ``notifications`` (dicts of the ``user_id``, ``subject``
+        and ``body`` of messages to users) to the outbox, from which they
+        are sent once the changes are persisted."""
+        raise NotImplementedError()
+
+    def get_notifications(self, limit, max_attempts):
+        """Retrieve up to ``limit`` notifications due to be sent that have
+        been attempted fewer than ``max_attempts`` times, as dicts of their
+        ``id``, ``user_id``, ``subject``, ``body`` and ``attempts``.
+        Others can't retrieve them until the changes are persisted."""
+        raise NotImplementedError()
+
+    def remove_notifications(self, ids):
+        """Removes the notifications of the ``ids`` from the outbox."""
+        raise NotImplementedError()
+
+    def reschedule_notification(self, id, next_attempt, error):
+        """Records the failed attempt to send the notification ``id``
+        and when to attempt it next."""
+        raise NotImplementedError()
+
     def persist(self):
         """Persist/commit the changes."""
         raise NotImplementedError()
@@ -46,3 +85,13 @@ class BaseStorage:
     def restart(self):
         """Restart the storage interface """
         raise NotImplementedError()
+
+    # Whether there are read replicas of the storage.
+    has_replicas = False
+
+    def read_from_replica(self, last_write=None):
+        """Send the reads of the current thread to a read replica, unless
+        the replicas may not have the writes made at ``last_write`` yet.
+        Storages without replicas ignore this.
+        """
+        pass
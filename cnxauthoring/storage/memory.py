@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Storage that keeps everything in the memory of the process.
+Nothing survives a restart, which makes it useful for benchmarking and
+profiling the views and models without a database.
+"""
+import copy
+import datetime
+import functools
+import io
+import itertools
+import json
+import re
+import threading
+from uuid import UUID
+
+import colander
+
+from .main import BaseStorage
+from ..models import (
+    create_content, model_to_tree, MEDIATYPES,
+    ContentSummary, Document, Resource, StoredResource,
+    )
+from ..publications import FINAL_STATES
+from ..utils import TZINFO
+
+
+# The document fields, as the columns of the ``document`` table.
+DOCUMENT_FIELDS = (
+    'id', 'title', 'created', 'revised', 'license', 'original_license',
+    'language', 'derived_from', 'derived_from_uri', 'derived_from_title',
+    'content', 'abstract', 'submitter', 'authors', 'publishers',
+    'copyright_holders', 'editors', 'translators', 'illustrators',
+    'subjects', 'keywords', 'state', 'publication', 'cnx_archive_uri',
+    'version', 'contained_in', 'print_style',
+    )
+# The search weights of the fields, as those of postgres' ``ts_rank``
+# for the weights the ``document_search_vector`` trigger gives them.
+SEARCH_WEIGHTS = (
+    ('title', 1.0),
+    ('keywords', 0.4),
+    ('subjects', 0.4),
+    ('abstract', 0.2),
+    ('content', 0.1),
+    )
+_DATETIME = colander.DateTime(default_tzinfo=TZINFO)
+_MARKUP = re.compile(r'<[^>]*>')
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _text(value):
+    return u'{}'.format(value)
+
+
+def _timestamp(value):
+    """The datetime or ISO 8601 ``value`` as a timezone aware datetime,
+    as postgres would store it in a ``timestamptz`` column.
+    """
+    if not isinstance(value, datetime.datetime):
+        value = _DATETIME.deserialize(None, value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=TZINFO)
+    return value
+
+
+def _words(text):
+    """The words of ``text``, as postgres' ``simple`` configuration
+    would find them.
+    """
+    return _WORD.findall(_MARKUP.sub(u' ', text or u'').lower())
+
+
+def _search_vector(row):
+    """The weights of the words of a document ``row``."""
+    vector = {}
+    for field, weight in SEARCH_WEIGHTS:
+        value = row.get(field)
+        if isinstance(value, (list, tuple)):
+            value = u' '.join(value)
+        for word in _words(value):
+            vector[word] = vector.get(word, 0) + weight
+    return vector
+
+
+def _copy_row(row):
+    """Copy a document ``row``, so that changes to the models
+    don't change the stored values or the other way around.
+    """
+    licenses = ('license', 'original_license')
+    result = copy.deepcopy({k: v for k, v in row.items()
+                            if k not in licenses})
+    for field in licenses:
+        result[field] = row[field]
+    return result
+
+
+class DocumentEntry(object):
+    """A stored document or binder with its ACL and licensor acceptance."""
+
+    def __init__(self, row, acls, licensor_acceptance):
+        self.row = row
+        self.acls = acls
+        self.licensor_acceptance = licensor_acceptance
+        self.search_vector = _search_vector(row)
+
+    @property
+    def key(self):
+        """The key documents are listed in descending order of."""
+        return (self.row['revised'], self.row['id'])
+
+
+class MemoryStorage(BaseStorage):
+    """Utility for managing and interfacing with the the storage medium.
+
+    Changes are visible to all threads right away; ``abort`` undoes those
+    of the current thread since it last persisted or aborted.
+    """
+
+    def __init__(self, **kwargs):
+        self._lock = threading.RLock()
+        # Each thread records how to undo its changes, see ``abort``.
+        self._local = threading.local()
+        self._documents = {}
+        self._resources = {}
+        # Indexes of the ids of the documents in each binder and
+        # of those each user has an ACL entry on.
+        self._contained_in = {}
+        self._user_documents = {}
+        # The notification outbox and the ids of the notifications
+        # retrieved to be sent, until the thread persists or aborts.
+        self._notifications = {}
+        self._notification_ids = itertools.count(1)
+        self._claimed_notifications = set()
+
+    @property
+    def _undo(self):
+        undo = getattr(self._local, 'undo', None)
+        if undo is None:
+            undo = self._local.undo = []
+        return undo
+
+    def _index(self, id, entry, add):
+        if entry is None:
+            return
+        for index, keys in ((self._contained_in, entry.row['contained_in']),
+                            (self._user_documents, entry.acls)):
+            for key in keys:
+                ids = index.setdefault(key, set())
+                if add:
+                    ids.add(id)
+                else:
+                    ids.discard(id)
+                    if not ids:
+                        del index[key]
+
+    def _set_document(self, id, entry):
+        """Store (or remove when ``entry`` is None) the document ``id``."""
+        with self._lock:
+            previous = self._documents.pop(id, None)
+            self._index(id, previous, add=False)
+            if entry is not None:
+                self._documents[id] = entry
+                self._index(id, entry, add=True)
+            self._undo.append(functools.partial(
+                self._set_document, id, previous))
+
+    def _set_resource(self, hash, resource):
+        """Store (or remove when ``resource`` is None) the resource
+        ``hash`` as its (mediatype, data).
+        """
+        with self._lock:
+            previous = self._resources.pop(hash, None)
+            if resource is not None:
+                self._resources[hash] = resource
+            self._undo.append(functools.partial(
+                self._set_resource, hash, previous))
+
+    def _set_notification(self, id, notification):
+        """Store (or remove when ``notification`` is None)
+        the notification ``id``.
+        """
+        with self._lock:
+            previous = self._notifications.pop(id, None)
+            if notification is not None:
+                self._notifications[id] = notification
+            self._undo.append(functools.partial(
+                self._set_notification, id, previous))
+
+    def _release_notifications(self):
+        claimed = getattr(self._local, 'claimed_notifications', set())
+        with self._lock:
+            self._claimed_notifications.difference_update(claimed)
+        self._local.claimed_notifications = set()
+
+    def get(self, type_=Document, **kwargs):
+        """Retrieve ``Document`` objects from storage."""
+        for obj in self.get_all(type_=type_, **kwargs):
+            return obj
+
+    def _document_entry(self, item):
+        """Build the stored entry of the document or binder ``item``."""
+        metadata = item.metadata
+        row = {field: metadata.get(field) for field in DOCUMENT_FIELDS}
+        row['id'] = UUID(str(item.id))
+        row['media_type'] = MEDIATYPES[item.__class__.__name__.lower()]
+        row['cnx_archive_uri'] = metadata.get('cnx-archive-uri')
+        for field in ('created', 'revised'):
+            row[field] = _timestamp(row[field])
+        if row['media_type'] == MEDIATYPES['binder']:
+            row['content'] = json.dumps(model_to_tree(item))
+        row['publishing_fingerprints'] = item.publishing_fingerprints
+        acls = {user_id: set(permissions)
+                for user_id, permissions in item.acls.items()}
+        return DocumentEntry(_copy_row(row), acls,
+                             copy.deepcopy(item.licensor_acceptance))
+
+    def _reassemble_models(self, entries):
+        """Reassembles the document ``entries`` into model objects."""
+        models = []
+        for entry in entries:
+            row = _copy_row(entry.row)
+            if row['media_type'] == MEDIATYPES['binder']:
+                row['tree'] = json.loads(row.pop('content'))
+            # BBB 05-Jan-2015 licensors - deprecated property 'licensors'
+            #     needs changed in webview and archive before removing here.
+            row['licensors'] = row['copyright_holders']
+            # /BBB
+            model = create_content(lazy=True, **row)
+
+            # Attach ACL and license acceptance info, including the users'
+            # permissions on any containing draft binders.
+            permissions_by_users = {}
+            binders = [entry]
+            for binderid in row['contained_in']:
+                try:
+                    binder = self._documents.get(UUID(binderid))
+                except ValueError:
+                    continue
+                if binder is not None:
+                    binders.append(binder)
+            for binder in binders:
+                for user_id, permissions in binder.acls.items():
+                    permissions_by_users.setdefault(user_id, set()).update(
+                        permissions)
+            for user_id, permissions in permissions_by_users.items():
+                model.acls[user_id] = tuple(permissions)
+
+            model.licensor_acceptance = copy.deepcopy(
+                entry.licensor_acceptance)
+            models.append(model)
+        return models
+
+    def _matches(self, row, kwargs):
+        """Whether the ``row`` has the field values of ``kwargs``
+        (see ``get_all``).
+        """
+        for k, v in kwargs.items():
+            value = row.get(k)
+            if isinstance(v, dict):
+                for json_k, json_v in v.items():
+                    if not value or _text(value.get(json_k)) != json_v:
+                        return False
+            elif k == 'contained_in':
+                if v.startswith('not:'):
+                    if v[4:] in value:
+                        return False
+                elif v not in value:
+                    return False
+            elif value is None:
+                return False
+            elif _text(v).startswith('not:'):
+                if _text(value) == _text(v)[4:]:
+                    return False
+            elif _text(value) != _text(v):
+                return False
+        return True
+
+    def _is_contained(self, entry, user_id, permissions, kwargs):
+        """Whether the document ``entry`` is in a binder that the user
+        has the ``permissions`` on and that matches ``kwargs``.
+        """
+        for binderid in entry.row['contained_in']:
+            try:
+                binder = self._documents.get(UUID(binderid))
+            except ValueError:
+                continue
+            if (binder is not None and
+                    binder.row['media_type'] == MEDIATYPES['binder'] and
+                    binder.acls.get(user_id, set()) & permissions and
+                    self._matches(binder.row, kwargs)):
+                return True
+        return False
+
+    def _page(self, entries, limit, after):
+        """The ``limit`` of ``entries`` after the ``after`` key,
+        most recently revised first.
+        """
+        if after is not None:
+            after = (_timestamp(after[0]), UUID(str(after[1])))
+            entries = [entry for entry in entries if entry.key < after]
+        entries = sorted(entries, key=lambda entry: entry.key, reverse=True)
+        if limit is not None:
+            entries = entries[:limit]
+        return entries
+
+    def get_all(self, type_=Document, user_id=None, permissions=None,
+                stream=False, limit=None, after=None,
+                exclude_contained=False, summary=False, **kwargs):
+        """Retrieve ``Document`` objects from storage.
+        See ``PostgresqlStorage.get_all`` for the arguments.
+        """
+        type_name = type_.__name__.lower()
+
+        if type_name == 'resource':
+            with self._lock:
+                if 'hash' in kwargs:
+                    hashes = [kwargs.pop('hash')]
+                else:
+                    hashes = list(self._resources.keys())
+                resources = [(hash, self._resources[hash]) for hash in hashes
+                             if hash in self._resources]
+            for hash, (mediatype, data) in resources:
+                if not self._matches({'mediatype': mediatype}, kwargs):
+                    continue
+                yield StoredResource(
+                    mediatype, hash, functools.partial(io.BytesIO, data),
+                    size=len(data))
+            raise StopIteration
+
+        # if ID is not a well formed uuid, there's no need to even look
+        if 'id' in kwargs and type(kwargs['id']) != UUID:
+            try:
+                kwargs['id'] = UUID(kwargs['id'])
+            except ValueError:
+                return
+
+        with self._lock:
+            # Narrow down the documents using the indexes.
+            if 'id' in kwargs:
+                ids = [kwargs['id']]
+            elif user_id and permissions:
+                ids = self._user_documents.get(user_id, ())
+            elif not kwargs.get('contained_in', 'not:').startswith('not:'):
+                ids = self._contained_in.get(kwargs['contained_in'], ())
+            else:
+                ids = self._documents.keys()
+            entries = [self._documents[id] for id in ids
+                       if id in self._documents]
+
+            entries = [entry for entry in entries
+                       if self._matches(entry.row, kwargs)]
+            if user_id and permissions:
+                permissions = set(permissions)
+                entries = [entry for entry in entries
+                           if entry.acls.get(user_id, set()) & permissions]
+                if exclude_contained:
+                    entries = [entry for entry in entries
+                               if not self._is_contained(
+                                   entry, user_id, permissions, kwargs)]
+            entries = self._page(entries, limit, after)
+
+            if summary:
+                models = [ContentSummary(**_copy_row(entry.row))
+                          for entry in entries]
+            else:
+                models = self._reassemble_models(entries)
+        for model in models:
+            yield model
+        raise StopIteration
+
+    def add(self, item_or_items):
+        """Adds any item or set of items to storage."""
+        if isinstance(item_or_items, list):
+            items = item_or_items
+        else:
+            items = [item_or_items]
+        for item in items:
+            type_name = item.__class__.__name__.lower()
+            if isinstance(item, Resource):
+                if item._hash not in self._resources:
+                    with item.open() as f:
+                        data = f.read()
+                    self._set_resource(item._hash, (item.media_type, data))
+            elif type_name in ['document', 'binder']:
+                self._set_document(UUID(str(item.id)),
+                                   self._document_entry(item))
+            else:
+                raise NotImplementedError(type_name)
+        return item_or_items
+
+    def remove(self, item_or_items):
+        """Removes any item or set of items from storage."""
+        if isinstance(item_or_items, list):
+            items = item_or_items
+        else:
+            items = [item_or_items]
+        for item in items:
+            type_name = item.__class__.__name__.lower()
+            if isinstance(item, Resource):
+                self._set_resource(item._hash, None)
+            elif type_name in ['document', 'binder']:
+                self._set_document(UUID(str(item.id)), None)
+        return item_or_items
+
+    def update(self, item_or_items):
+        """Updates any item or set of items in storage."""
+        if isinstance(item_or_items, list):
+            items = item_or_items
+        else:
+            items = [item_or_items]
+        for item in items:
+            type_name = item.__class__.__name__.lower()
+            if isinstance(item, Resource):
+                with item.open() as f:
+                    data = f.read()
+                self._set_resource(item._hash, (item.media_type, data))
+            elif type_name in ['document', 'binder']:
+                id = UUID(str(item.id))
+                with self._lock:
+                    if id in self._documents:
+                        self._set_document(id, self._document_entry(item))
+        return item_or_items
+
+    def update_containment(self, binder_id, document_ids):
+        """Updates which documents are in the binder (by their
+        ``contained_in``) to those of the ``document_ids``.
+        """
+        binder_id = str(binder_id)
+        ids = set([UUID(str(id)) for id in document_ids])
+        with self._lock:
+            for id in ids | self._contained_in.get(binder_id, set()):
+                entry = self._documents.get(id)
+                if entry is None:
+                    continue
+                contained_in = entry.row['contained_in']
+                if id in ids and binder_id not in contained_in:
+                    contained_in = contained_in + [binder_id]
+                elif id not in ids and binder_id in contained_in:
+                    contained_in = [i for i in contained_in if i != binder_id]
+                else:
+                    continue
+                row = dict(entry.row, contained_in=contained_in)
+                self._set_document(id, DocumentEntry(
+                    row, entry.acls, entry.licensor_acceptance))
+
+    def get_pending_publications(self):
+        """Retrieve the ``id``, ``publication`` and ``state`` of the
+        documents with a publication in progress in publishing.
+        """
+        with self._lock:
+            pending = [{'id': entry.row['id'],
+                        'publication': entry.row['publication'],
+                        'state': entry.row['state']}
+                       for entry in self._documents.values()
+                       if entry.row['publication'] is not None
+                       and entry.row['state'] is not None
+                       and entry.row['state'] not in FINAL_STATES]
+        pending.sort(key=lambda p: (p['publication'], p['id']))
+        return pending
+
+    def update_document_state(self, id, publication, state, revised):
+        """Sets the ``state`` and ``revised`` time of the document ``id``
+        of the ``publication``, unless it has been published again since
+        or already has the state. Returns whether it was updated.
+        """
+        id = UUID(str(id))
+        with self._lock:
+            entry = self._documents.get(id)
+            if entry is None or entry.row['state'] == state or \
+                    str(entry.row['publication']) != str(publication):
+                return False
+            row = dict(entry.row, state=state, revised=_timestamp(revised))
+            self._set_document(id, DocumentEntry(
+                row, entry.acls, entry.licensor_acceptance))
+        return True
+
+    def add_notifications(self, notifications):
+        """Adds the ``notifications`` (dicts of the ``user_id``, ``subject``
+        and ``body`` of messages to users) to the outbox.
+        """
+        now = datetime.datetime.now(TZINFO)
+        with self._lock:
+            for notification in notifications:
+                id = next(self._notification_ids)
+                self._set_notification(id, {
+                    'id': id,
+                    'user_id': notification['user_id'],
+                    'subject': notification['subject'],
+                    'body': notification['body'],
+                    'attempts': 0,
+                    'next_attempt': now,
+                    'last_error': None,
+                    })
+
+    def get_notifications(self, limit, max_attempts):
+        """Retrieve up to ``limit`` notifications due to be sent,
+        which other threads don't retrieve until this one persists or aborts.
+        """
+        now = datetime.datetime.now(TZINFO)
+        claimed = getattr(self._local, 'claimed_notifications', None)
+        if claimed is None:
+            claimed = self._local.claimed_notifications = set()
+        with self._lock:
+            due = [n for n in self._notifications.values()
+                   if n['next_attempt'] <= now
+                   and n['attempts'] < max_attempts
+                   and (n['id'] not in self._claimed_notifications
+                        or n['id'] in claimed)]
+            due.sort(key=lambda n: (n['next_attempt'], n['id']))
+            due = due[:limit]
+            for notification in due:
+                self._claimed_notifications.add(notification['id'])
+                claimed.add(notification['id'])
+            return [{k: notification[k] for k in (
+                        'id', 'user_id', 'subject', 'body', 'attempts')}
+                    for notification in due]
+
+    def remove_notifications(self, ids):
+        """Removes the notifications of the ``ids`` from the outbox."""
+        with self._lock:
+            for id in ids:
+                if id in self._notifications:
+                    self._set_notification(id, None)
+
+    def reschedule_notification(self, id, next_attempt, error):
+        """Records the failed attempt to send the notification ``id``
+        and when to attempt it next.
+        """
+        with self._lock:
+            notification = self._notifications.get(id)
+            if notification is None:
+                return
+            self._set_notification(id, dict(
+                notification, attempts=notification['attempts'] + 1,
+                next_attempt=_timestamp(next_attempt), last_error=error))
+
+    def persist(self):
+        """Persist/commit the changes."""
+        self._local.undo = []
+        self._release_notifications()
+
+    def abort(self):
+        """Undo the changes of the current thread."""
+        undo, self._local.undo = self._undo, []
+        with self._lock:
+            for change in reversed(undo):
+                change()
+        self._local.undo = []
+        self._release_notifications()
+
+    def search(self, limits, type_=Document, submitter_id=None,
+               stream=False, limit=None, after=None):
+        """Retrieve any ``Document`` objects from storage that matches the
+        search terms, best matches first. When paging through the results
+        with a ``limit`` and ``after`` key (see ``get_all``), they are
+        most recently revised first instead.
+        """
+        if type_ != Document:
+            raise NotImplementedError()
+
+        queries = []
+        for limit_type, term in limits:
+            if limit_type != 'text':
+                raise NotImplementedError()
+            words = set(_words(term))
+            if words:
+                queries.append(words)
+
+        with self._lock:
+            ranked = []
+            for entry in self._documents.values():
+                submitter = entry.row['submitter'] or {}
+                if (submitter_id is not None and
+                        submitter.get('id') != submitter_id):
+                    continue
+                vector = entry.search_vector
+                # Documents containing words starting with all the words
+                # of any of the terms.
+                matched = set()
+                for words in queries:
+                    found = [[w for w in vector if w.startswith(word)]
+                             for word in words]
+                    if all(found):
+                        for prefixed in found:
+                            matched.update(prefixed)
+                if matched:
+                    rank = sum([vector[word] for word in matched])
+                    ranked.append((rank, entry))
+
+            if limit is not None or after is not None:
+                # The rank can't be used as a key.
+                entries = self._page([entry for rank, entry in ranked],
+                                     limit, after)
+            else:
+                ranked.sort(key=lambda item: (item[0], item[1].key[0]),
+                            reverse=True)
+                entries = [entry for rank, entry in ranked]
+            models = self._reassemble_models(entries)
+        for model in models:
+            yield model
+        raise StopIteration
+
+    def restart(self):
+        """Restart the interface"""
+        self.abort()
@@ -5,49 +5,79 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import collections
+import copy
+import functools
+import hashlib
 import io
 import json
-from uuid import UUID
+import random
+import threading
+import time
+import weakref
+from uuid import UUID, uuid4
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import Binary
 from psycopg2.extensions import STATUS_READY
+from pyramid.settings import asbool, aslist
 
+from ..cache import LRUCache
+from .blobs import FilesystemBlobStore
 from .main import BaseStorage
 from ..models import (
     create_content, MEDIATYPES,
-    Document, License, Resource,
+    ContentSummary, Document, Resource, StoredResource,
     )
-from .database import SQL
+from .database import SQL, BULK_SQL, render_sql, statement_params
 
 
 psycopg2.extras.register_uuid()
 psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
 
 JSON_FIELDS = ('authors', 'publishers', 'copyright_holders', 'editors',
-               'translators', 'illustrators',)
+               'translators', 'illustrators', 'publishing_fingerprints',)
+# The columns of the documents retrieved. They are listed rather than
+# selected with ``*``, so that the prepared statements keep their result
+# type (and keep working) when a migration adds a column.
+DOCUMENT_COLUMNS = ', '.join([
+    'id', 'title', 'created', 'revised', 'license', 'original_license',
+    'language', 'media_type', 'derived_from', 'derived_from_uri',
+    'derived_from_title', 'content', 'abstract', 'submitter', 'authors',
+    'publishers', 'copyright_holders', 'editors', 'translators',
+    'illustrators', 'subjects', 'keywords', 'state', 'publication',
+    'cnx_archive_uri', 'version', 'contained_in', 'print_style',
+    'publishing_fingerprints',
+    ])
+# Keyset pagination: the rows after the ``after`` (revised, id) key in
+# ``ORDER BY revised DESC, id DESC`` order.
+PAGE_CLAUSE = ('(revised, id) < '
+               '(%(after_revised)s::timestamptz, %(after_id)s::uuid)')
+# Documents in a binder that the user has the permissions on and that
+# matches the same ``where_clause``.
+CONTAINED_CLAUSE = """EXISTS (
+    SELECT 1 FROM document binder
+    JOIN document_acl binder_acl ON binder.id = binder_acl.uuid
+    WHERE binder.id::text = ANY(document.contained_in)
+      AND binder.media_type = %(binder_media_type)s
+      AND binder_acl.user_id = %(user_id)s
+      AND binder_acl.permission = ANY(%(permissions)s)
+      AND {where_clause})"""
 
 
-# cribbed from
-# http://stackoverflow.com/questions/19048017/python-extract-substitution-vars-from-format-string
-def get_format_keys(s):
-    d = {}
-    while True:
-        try:
-            s % d
-        except KeyError as exc:
-            # exc.args[0] contains the name of the key that was not found;
-            # 0 is used because it appears to work with all types of
-            # placeholders.
-            d[exc.args[0]] = 0
-        else:
-            break
-    return d.keys()
+def _cached_document_size(value):
+    """An estimate of the memory used by a document cache value."""
+    row = value[1][0]
+    size = 2048 + len(row.get('content') or '') + len(row['abstract'] or '')
+    if 'tree' in row:
+        size += len(json.dumps(row['tree']))
+    return size
 
 
 def check_args(s, kwargs):
-    format_keys = get_format_keys(s)
+    format_keys = statement_params(s)
     for k in kwargs:
         if k not in format_keys:
             raise KeyError(k)
@@ -58,47 +88,519 @@ def checked_execute(cur, s, kwargs):
     cur.execute(s, kwargs)
 
 
+# Names of the statements prepared on each connection.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def _prepare(cur, s):
+    """Prepare the ``s`` statement on the cursor's connection, if it
+    has not been already. Returns the ``EXECUTE`` statement to run it with
+    the same named arguments.
+    """
+    params = statement_params(s)
+    name = 'stmt_{}'.format(hashlib.md5(s.encode('utf-8')).hexdigest())
+    with _prepared_lock:
+        prepared = _prepared.setdefault(cur.connection, set())
+    if name not in prepared:
+        positional = s.strip().rstrip(';')
+        for i, param in enumerate(params, 1):
+            positional = positional.replace('%({})s'.format(param),
+                                            '${}'.format(i))
+        # Run without arguments, so psycopg2 doesn't unescape ``%%``.
+        positional = positional.replace('%%', '%')
+        cur.execute('PREPARE {} AS {}'.format(name, positional))
+        prepared.add(name)
+    if not params:
+        return 'EXECUTE {}'.format(name)
+    return 'EXECUTE {} ({})'.format(
+        name, ', '.join(['%({})s'.format(param) for param in params]))
+
+
+def prepared_execute(cur, s, kwargs):
+    """Like ``checked_execute``, but runs ``s`` as a prepared statement,
+    which saves the server from parsing and planning it on every call.
+    """
+    check_args(s, kwargs)
+    if cur.name is not None:
+        # Named cursors can only DECLARE a plain query.
+        cur.execute(s, kwargs)
+    else:
+        cur.execute(_prepare(cur, s), kwargs)
+
+
+def bulk_execute(cur, name, argslist):
+    """Insert a row for each of the ``argslist`` using the multi-row
+    form of the single row INSERT statement ``name``.
+    """
+    if not argslist:
+        return
+    s, template = BULK_SQL[name]
+    for kwargs in argslist:
+        check_args(template, kwargs)
+    psycopg2.extras.execute_values(cur, s, argslist, template=template,
+                                   page_size=len(argslist))
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """A bounded thread-safe connection pool. Rather than raising a
+    ``PoolError`` when all ``maxconn`` connections are in use,
+    ``getconn`` blocks until one is returned.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        psycopg2.pool.ThreadedConnectionPool.__init__(
+            self, minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            conn = psycopg2.pool.ThreadedConnectionPool.getconn(self, key)
+            if conn.closed:
+                # Discard connections that were lost while idle.
+                psycopg2.pool.ThreadedConnectionPool.putconn(
+                    self, conn, key, close=True)
+                conn = psycopg2.pool.ThreadedConnectionPool.getconn(
+                    self, key)
+        except:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            psycopg2.pool.ThreadedConnectionPool.putconn(
+                self, conn, key, close=close or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+
+class ResourceReader(io.RawIOBase):
+    """A read-only file-like object over the data of a stored resource.
+    Rather than loading all of it, the data is read a chunk at a time
+    using ``read_chunk(offset, length)``. ``release()``, when given, is
+    called once the reader is closed.
+    """
+
+    def __init__(self, read_chunk, size, chunk_size, release=None):
+        self._read_chunk = read_chunk
+        self._size = size
+        self._chunk_size = chunk_size
+        self._position = 0
+        self._release = release
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed and self._release is not None:
+            self._release()
+        io.RawIOBase.close(self)
+
+    def readinto(self, b):
+        length = min(len(b), self._chunk_size, self._size - self._position)
+        if length <= 0:
+            return 0
+        data = self._read_chunk(self._position, length)
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self):
+        chunks = []
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
 class PostgresqlStorage(BaseStorage):
     """Utility for managing and interfacing with the the storage medium."""
 
     Error = psycopg2.Error
 
-    def __init__(self, db_connection_string=None):
-        # initialize db
-        self.conn = psycopg2.connect(db_connection_string)
+    def __init__(self, db_connection_string=None, pool_min=1, pool_max=10,
+                 itersize=500, prepare_statements=True,
+                 resource_directory=None, resource_chunk_size=65536,
+                 replica_connection_strings=None, replica_max_lag=10,
+                 document_cache_size=33554432):
         # adding a variable to store the db_connection string
         # needed to restart the database when a connection
         # is broken or lost.
         self.db_connection_string = db_connection_string
+        # initialize db
+        self.pool = ConnectionPool(int(pool_min), int(pool_max),
+                                   db_connection_string)
+        # Each thread checks out its own connection, see ``conn``.
+        self._local = threading.local()
+        # Number of rows fetched per round trip when streaming results.
+        self.itersize = int(itersize)
+        # Run the frequently used statements as prepared statements;
+        # turn off when connecting through a transaction-level pooler.
+        self.prepare_statements = asbool(prepare_statements)
+        # Resource data is kept on the filesystem rather than in the
+        # database when a directory is configured.
+        self.blobs = None
+        if resource_directory:
+            self.blobs = FilesystemBlobStore(resource_directory)
+        # The number of transactions in progress adding each blob, which
+        # isn't removed while they may still refer to it.
+        self._blob_lock = threading.Lock()
+        self._adding_blobs = collections.Counter()
+        # Size of the pieces resource data is read from the database in.
+        self.resource_chunk_size = int(resource_chunk_size)
+        # Pools of connections to read replicas (one per line),
+        # see ``read_from_replica``.
+        self.replica_pools = [
+            ConnectionPool(int(pool_min), int(pool_max), connection_string)
+            for connection_string in aslist(replica_connection_strings or '',
+                                            flatten=False)]
+        # Seconds the replicas may be behind the primary.
+        self.replica_max_lag = float(replica_max_lag)
+        # Bytes of documents kept between requests, see ``get``.
+        self.document_cache = None
+        if int(document_cache_size):
+            self.document_cache = LRUCache(int(document_cache_size),
+                                           _cached_document_size)
+
+    @property
+    def has_replicas(self):
+        return bool(self.replica_pools)
+
+    @property
+    def conn(self):
+        """The connection checked out by the current thread. A connection
+        is taken from the pool on first use and given back on
+        ``persist`` or ``abort``.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.pool.getconn()
+            self._local.pooled = True
+        return conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._release(close=True)
+        self._local.conn = conn
+        self._local.pooled = False
+
+    def read_from_replica(self, last_write=None):
+        """Send the reads of the current thread to a replica until the
+        changes are persisted or aborted. Reads go back to the primary
+        once anything is written, or right away when the replicas may not
+        have the user's writes (at the ``last_write`` time) yet.
+        """
+        if not self.replica_pools:
+            return
+        if (last_write is not None and
+                time.time() - last_write < self.replica_max_lag):
+            return
+        self._local.replica = True
+
+    def _replica_pool(self):
+        """The pool of the replica the current thread reads from,
+        or None when it reads from the primary.
+        """
+        if (not getattr(self._local, 'replica', False) or
+                getattr(self._local, 'written', False)):
+            return None
+        pool = getattr(self._local, 'replica_pool', None)
+        if pool is None:
+            pool = self._local.replica_pool = random.choice(
+                self.replica_pools)
+        return pool
+
+    @property
+    def read_conn(self):
+        """The connection the current thread reads from, which is
+        a replica's when reading from a replica, otherwise ``conn``.
+        """
+        pool = self._replica_pool()
+        if pool is None:
+            return self.conn
+        conn = getattr(self._local, 'replica_conn', None)
+        if conn is None:
+            conn = self._local.replica_conn = pool.getconn()
+        return conn
+
+    def _release_replica(self, close=False):
+        """Give the current thread's replica connection back and
+        read from the primary again.
+        """
+        self._local.replica = self._local.written = False
+        conn = getattr(self._local, 'replica_conn', None)
+        pool = getattr(self._local, 'replica_pool', None)
+        self._local.replica_conn = self._local.replica_pool = None
+        if conn is not None:
+            pool.putconn(conn, close=close)
+
+    def _release(self, close=False):
+        """Give the current thread's connection back to the pool.
+        A connection that was assigned rather than checked out is kept
+        unless ``close`` is true.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        if self._local.pooled:
+            self._local.conn = None
+            self.pool.putconn(conn, close=close)
+        elif close:
+            self._local.conn = None
+            conn.close()
+
+    @property
+    def _identity_map(self):
+        """The models the current thread retrieved or added since it
+        last persisted or aborted (i.e. in the request), by their
+        ``_identity_key``.
+        """
+        identity_map = getattr(self._local, 'identity_map', None)
+        if identity_map is None:
+            identity_map = self._local.identity_map = {}
+        return identity_map
+
+    def _identity_key(self, model):
+        if isinstance(model, Resource):
+            return ('resource', model._hash)
+        return ('document', str(model.id))
+
+    def _identify(self, model):
+        """The model already in the identity map that is the same as
+        ``model``, or ``model`` after adding it to the map.
+        """
+        return self._identity_map.setdefault(
+            self._identity_key(model), model)
+
+    def _forget(self, item):
+        """Drop the ``item`` from the identity map and document cache."""
+        key = self._identity_key(item)
+        self._identity_map.pop(key, None)
+        if self.document_cache is not None:
+            self.document_cache.pop(key)
 
     def get(self, type_=Document, **kwargs):
         """Retrieve ``Document`` objects from storage."""
+        # The same content is often retrieved several times in a request
+        # (e.g. for the binders it is in), so it is only retrieved once.
+        key = None
+        if type_ is Resource and list(kwargs.keys()) == ['hash']:
+            key = ('resource', kwargs['hash'])
+        elif type_ is Document and list(kwargs.keys()) == ['id']:
+            try:
+                key = ('document', str(UUID(str(kwargs['id']))))
+            except ValueError:
+                return
+        if key in self._identity_map:
+            return self._identity_map[key]
+        if key is not None and self.document_cache is not None and \
+                key[0] == 'document':
+            return self._get_cached_document(key)
         for obj in self.get_all(type_=type_, **kwargs):
             return obj
 
+    def _get_cached_document(self, key):
+        """Retrieve the document of the identity ``key`` from the
+        document cache if it is the stored version, which is much cheaper
+        to check than retrieving the document. Otherwise the document is
+        retrieved and cached.
+        """
+        args = {'id': UUID(key[1])}
+        conn = self.read_conn
+        in_progress = (conn.status != STATUS_READY)
+        cursor = self._cursor(conn)
+        self._execute(cursor, SQL['get-document-version'], args)
+        row = cursor.fetchone()
+        models = []
+        if row is not None:
+            version = tuple(row)
+            cached = self.document_cache.get(key)
+            if cached is not None and cached[0] == version:
+                models = [self._build_model(*copy.deepcopy(cached[1]))]
+            else:
+                self._execute(cursor, render_sql(
+                    'get', columns=DOCUMENT_COLUMNS, tablename='document',
+                    where_clause='id = %(id)s'), args)
+                assembled = []
+                models = self._reassemble_models(cursor.fetchall(),
+                                                 assembled)
+                if assembled:
+                    self.document_cache.set(key, (version, assembled[0]))
+        if not in_progress:
+            conn.rollback()  # Frees the connection
+        for model in models:
+            return self._identify(model)
+
+    def _execute(self, cursor, s, kwargs):
+        """Execute a frequently used statement, preparing it when
+        prepared statements are enabled.
+        """
+        if self.prepare_statements:
+            prepared_execute(cursor, s, kwargs)
+        else:
+            checked_execute(cursor, s, kwargs)
+
+    def _cursor(self, conn, stream=False):
+        """Create a dictionary result cursor. When ``stream`` is true
+        this is a named (server-side) cursor that transfers
+        ``itersize`` rows at a time.
+        """
+        if not stream:
+            return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor = conn.cursor('stream_{}'.format(uuid4().hex),
+                             cursor_factory=psycopg2.extras.DictCursor)
+        cursor.itersize = self.itersize
+        return cursor
+
+    def _fetch_models(self, cursor, in_progress, stream=False,
+                      reassemble=None):
+        """Generate the models for the rows of an executed ``cursor``,
+        as reassembled by ``reassemble`` (``_reassemble_models`` by
+        default).
+        """
+        reassemble = reassemble or self._reassemble_models
+        if stream:
+            # Reassemble the rows a batch at a time as they arrive.
+            while True:
+                res = cursor.fetchmany(self.itersize)
+                if not res:
+                    break
+                for model in reassemble(res):
+                    yield model
+            # The transaction is left to ``persist`` or ``abort``, as
+            # changes may have been made while the results were read.
+            cursor.close()
+            return
+        res = cursor.fetchall()
+        if not in_progress:
+            cursor.connection.rollback()  # Frees the connection
+        if res:
+            for model in reassemble(res):
+                yield model
+
+    def _reassemble_summaries(self, rows):
+        """Reassembles summary ``rows`` into ``ContentSummary`` objects."""
+        return [ContentSummary(**row) for row in rows]
+
+    def _read_resource_chunk(self, hash, offset, length, conn):
+        """Read ``length`` bytes of the ``hash`` resource's data from
+        ``offset`` on the ``conn`` connection.
+        """
+        args = {'hash': hash, 'start': offset + 1, 'length': length}
+        in_progress = (conn.status != STATUS_READY)
+        with conn.cursor() as cursor:
+            self._execute(cursor, SQL['get-resource-chunk'], args)
+            row = cursor.fetchone()
+        if not in_progress:
+            conn.rollback()  # Ends the read's transaction
+        if row is None or row[0] is None:
+            raise IOError('The data of resource {} is missing'.format(hash))
+        return bytes(row[0])
+
+    def _open_resource(self, hash, size, pool=None):
+        """Open the data of the ``hash`` resource for reading
+        (from the replica of ``pool`` when given). Resources are often
+        read after the request's connection was given back (e.g. while
+        the response is sent), in which case a connection is borrowed
+        for all the reads and given back once the resource is closed.
+        """
+        pool = pool or self.pool
+        borrowed = []
+
+        def read_chunk(offset, length):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None or pool is not self.pool:
+                if not borrowed:
+                    borrowed.append(pool.getconn())
+                conn = borrowed[0]
+            return self._read_resource_chunk(hash, offset, length, conn)
+
+        def release():
+            if borrowed:
+                pool.putconn(borrowed.pop())
+
+        reader = ResourceReader(read_chunk, size, self.resource_chunk_size,
+                                release)
+        return io.BufferedReader(reader, self.resource_chunk_size)
+
     def _reassemble_model_from_document_entry(self, **row):
         """Reassembles a document ``row`` (in dictionary result format)
         into model object.
         """
-        cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        # FIXME media-type is called 'media_type' in a document/binder query
-        #       and 'mediatype' in a resource query.
-        #       If this is fixed this will read better at the very least.
-        #       The fix should be rename the resources field to mediatype.
-        #       This can then be fixed to something like:
-        # if row['mediatype'] in MEDIATTYPES.values():
-        #     # then process as a Document/Binder.
-        # else:
-        #     # then process as a Resource.
-        if 'mediatype' in row:  # It's a resource...
-            model = Resource(row['mediatype'], io.BytesIO(row['data'][:]),
-                             filename=row['hash'])
-        else:  # It's a Document/Binder...
-            row['license'] = License.from_url(row['license']['url'])
-            row['original_license'] = License.from_url(
-                row['original_license']['url'])
-            for field in ('user_id', 'permission', 'uuid'):
+        return self._reassemble_models([row])[0]
+
+    def _reassemble_models(self, rows, assembled=None):
+        """Reassembles document ``rows`` (in dictionary result format)
+        into model objects. The ACL and license acceptance info for
+        all the rows is acquired in a fixed number of queries.
+        The arguments of ``_build_model`` for the documents are
+        appended to the ``assembled`` list when given.
+        """
+        rows = [dict(row) for row in rows]
+        replica_pool = self._replica_pool()
+        cursor = self.read_conn.cursor(
+            cursor_factory=psycopg2.extras.DictCursor)
+
+        # Gather the ids of the documents and their containing binders.
+        document_ids = set()
+        for row in rows:
+            if 'mediatype' in row:
+                continue
+            document_ids.add(row['id'])
+            for binderid in row['contained_in'] or []:
+                try:
+                    document_ids.add(UUID(binderid))
+                except ValueError:
+                    pass
+
+        acls_by_id = {}
+        licensors_by_id = {}
+        if document_ids:
+            self._execute(cursor, SQL['get-document-acls'],
+                          {'uuids': list(document_ids)})
+            for acl in cursor.fetchall():
+                permissions_by_users = acls_by_id.setdefault(acl['uuid'], {})
+                permissions_by_users.setdefault(acl['user_id'], [])
+                permissions_by_users[acl['user_id']].append(acl['permission'])
+            self._execute(cursor, SQL['get-document-licensor-acceptances'],
+                          {'uuids': [row['id'] for row in rows
+                                     if 'mediatype' not in row]})
+            for r in cursor.fetchall():
+                licensors_by_id.setdefault(r['uuid'], []).append(
+                    {'id': r['user_id'], 'has_accepted': r['has_accepted']})
+
+        models = []
+        for row in rows:
+            # FIXME media-type is called 'media_type' in a document/binder
+            #       query and 'mediatype' in a resource query.
+            #       If this is fixed this will read better at the very least.
+            #       The fix should be rename the resources field to mediatype.
+            #       This can then be fixed to something like:
+            # if row['mediatype'] in MEDIATTYPES.values():
+            #     # then process as a Document/Binder.
+            # else:
+            #     # then process as a Resource.
+            if 'mediatype' in row:  # It's a resource...
+                if not row['has_data'] and self.blobs is not None:
+                    # The data is stored on the filesystem.
+                    path = self.blobs.path(row['hash'])
+                    models.append(StoredResource(
+                        row['mediatype'], row['hash'],
+                        functools.partial(open, path, 'rb'),
+                        size=row['size'], path=path))
+                    continue
+                models.append(StoredResource(
+                    row['mediatype'], row['hash'],
+                    functools.partial(self._open_resource, row['hash'],
+                                      row['size'] or 0, replica_pool),
+                    size=row['size']))
+                continue
+            # It's a Document/Binder...
+            for field in ('user_id', 'permission', 'uuid', 'search_vector'):
                 if field in row:
                     row.pop(field)
             if row['media_type'] == MEDIATYPES['binder']:
@@ -107,54 +609,67 @@ class PostgresqlStorage(BaseStorage):
             #     needs changed in webview and archive before removing here.
             row['licensors'] = row['copyright_holders']
             # /BBB
-            model = create_content(**row)
 
             # Attach ACL and license acceptance info.
-            checked_execute(cursor, SQL['get'].format(
-                tablename='document_acl',
-                where_clause='uuid = %(uuid)s'), {'uuid': row['id']})
             permissions_by_users = {}
-            for acl in cursor.fetchall():
-                permissions_by_users.setdefault(acl['user_id'], [])
-                permissions_by_users[acl['user_id']].append(
-                        acl['permission'])
+            for user_id, permissions in acls_by_id.get(row['id'], {}).items():
+                permissions_by_users[user_id] = list(permissions)
             # UNION with  the users' permissions on any containing draft
             # binders
-            binders = model.metadata['contained_in']
-            if binders and binders != []:
-                for binderid in binders:
-                    checked_execute(cursor, SQL['get'].format(
-                        tablename='document_acl',
-                        where_clause='uuid = %(uuid)s'), {'uuid': binderid})
-                    for acl in cursor.fetchall():
-                        permissions_by_users.setdefault(acl['user_id'], [])
-                        if acl['permission'] not in \
-                                permissions_by_users[acl['user_id']]:
-                            permissions_by_users[acl['user_id']].append(
-                                acl['permission'])
-
-            for user_id, permissions in permissions_by_users.items():
-                model.acls[user_id] = tuple(set(permissions))
-
-            checked_execute(cursor, SQL['get'].format(
-                tablename='document_licensor_acceptance',
-                where_clause='uuid = %(uuid)s'), {'uuid': row['id']})
-            licensor_acceptance = [
-                {'id': r['user_id'], 'has_accepted': r['has_accepted']}
-                for r in cursor.fetchall()]
-            model.licensor_acceptance = licensor_acceptance
+            for binderid in row['contained_in'] or []:
+                try:
+                    binder_acls = acls_by_id.get(UUID(binderid), {})
+                except ValueError:
+                    continue
+                for user_id, permissions in binder_acls.items():
+                    permissions_by_users.setdefault(user_id, [])
+                    for permission in permissions:
+                        if permission not in permissions_by_users[user_id]:
+                            permissions_by_users[user_id].append(permission)
+
+            acls = {user_id: tuple(set(permissions))
+                    for user_id, permissions in permissions_by_users.items()}
+
+            args = (row, acls, licensors_by_id.get(row['id'], []))
+            if assembled is not None:
+                assembled.append(copy.deepcopy(args))
+            models.append(self._build_model(*args))
+        return models
+
+    def _build_model(self, row, acls, licensor_acceptance):
+        """Build the model of a document ``row`` with its ``acls`` and
+        ``licensor_acceptance``.
+        """
+        # The content and tree are often not needed, e.g. to check
+        # permissions, so they are only parsed and built on use.
+        model = create_content(lazy=True, **row)
+        model.acls.update(acls)
+        model.licensor_acceptance = licensor_acceptance
         return model
 
     def get_all(self, type_=Document, user_id=None, permissions=None,
-                **kwargs):
-        """Retrieve ``Document`` objects from storage."""
+                stream=False, limit=None, after=None,
+                exclude_contained=False, summary=False, **kwargs):
+        """Retrieve ``Document`` objects from storage.
+        When ``stream`` is true, the results are read through a server-side
+        cursor rather than loaded into memory all at once.
+
+        The documents the ``user_id`` has the ``permissions`` on are
+        retrieved most recently revised first. These can be paged through
+        by giving a ``limit`` and the ``(revised, id)`` of the last
+        document of the previous page as ``after``. With
+        ``exclude_contained`` the documents in a binder that is also
+        retrieved are left out. With ``summary`` only the listing
+        information is retrieved, as ``ContentSummary`` objects.
+        """
         # all kwargs are expected to match attributes of the stored Document.
         # We're trusting the names of the args to match table column names, but
         # not trusting the values
 
-        in_progress = (self.conn.status != STATUS_READY)
+        conn = self.read_conn
+        in_progress = (conn.status != STATUS_READY)
 
-        cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor = self._cursor(conn, stream)
 
         type_name = type_.__name__.lower()
 
@@ -178,13 +693,14 @@ class PostgresqlStorage(BaseStorage):
                 match_values.pop(k)
             elif k == 'contained_in':
                 # Array based storage , assumes singular key
+                # (written as containment to use the GIN index)
                 if v.startswith('not:'):
-                    match_clauses.append(
-                        ' NOT %(contained_in)s = ANY (contained_in) ')
+                    match_clauses.append(' NOT contained_in @> '
+                                         'ARRAY[%(contained_in)s]::text[] ')
                     match_values[k] = v[4:]
                 else:
                     match_clauses.append(
-                        ' %(contained_in)s = ANY (contained_in) ')
+                        ' contained_in @> ARRAY[%(contained_in)s]::text[] ')
             else:
                 if str(v).startswith('not:'):
                     match_clauses.append(
@@ -199,203 +715,483 @@ class PostgresqlStorage(BaseStorage):
         if type_name in ('document', 'binder') and user_id and permissions:
             match_values.update({
                 'user_id': user_id,
-                'permissions': permissions})
-            checked_execute(cursor, SQL['get-document'].format(
-                where_clause=where_clause), match_values)
+                'permissions': list(permissions),
+                'limit': limit})
+            if exclude_contained:
+                match_clauses.append('NOT ' + CONTAINED_CLAUSE.format(
+                    where_clause=where_clause))
+                match_values['binder_media_type'] = MEDIATYPES['binder']
+            if after is not None:
+                match_clauses.append(PAGE_CLAUSE)
+                match_values.update({
+                    'after_revised': after[0],
+                    'after_id': after[1]})
+            columns = DOCUMENT_COLUMNS
+            if summary:
+                columns = ', '.join(ContentSummary.fields)
+            self._execute(cursor, render_sql(
+                'get-document', columns=columns,
+                where_clause=' AND '.join(match_clauses) or '1 = 1'),
+                match_values)
+        elif (limit is not None or after is not None or exclude_contained or
+              summary):
+            raise NotImplementedError()
+        elif type_name == 'resource':
+            self._execute(cursor, render_sql(
+                'get-resource', where_clause=where_clause), match_values)
         else:
-            checked_execute(cursor, SQL['get'].format(
-                tablename=type_name, where_clause=where_clause), match_values)
-        res = cursor.fetchall()
-        if not in_progress:
-            self.conn.rollback()  # Frees the connection
-        if res:
-            for r in res:
-                yield self._reassemble_model_from_document_entry(**r)
+            columns = '*'
+            if type_name == 'document':
+                columns = DOCUMENT_COLUMNS
+            self._execute(cursor, render_sql(
+                'get', columns=columns, tablename=type_name,
+                where_clause=where_clause), match_values)
+        if summary:
+            for model in self._fetch_models(cursor, in_progress, stream,
+                                            self._reassemble_summaries):
+                yield model
+            raise StopIteration
+        for model in self._fetch_models(cursor, in_progress, stream):
+            yield self._identify(model)
         raise StopIteration
 
-    def add(self, item_or_items):
-        """Adds any item or set of items to storage."""
-        if isinstance(item_or_items, list):
-            raise NotImplementedError()
-        item = item_or_items
-        type_name = item.__class__.__name__.lower()
-        cursor = self.conn.cursor()
-        if type_name == 'resource':
-            exists = self.get(type_=Resource, hash=item._hash)
-            if not exists:
-                with item.open() as f:
-                    data = Binary(f.read())
-                checked_execute(
-                    cursor, SQL['add-resource'],
-                    {'hash': item._hash,
-                     'mediatype': item.media_type,
-                     'data': data})
-        elif type_name in ['document', 'binder']:
-            args = item.to_dict()
-            args['license'] = json.dumps(args['license'])
-            args['original_license'] = json.dumps(args['original_license'])
-            args['media_type'] = MEDIATYPES[type_name]
-            if 'summary' in args:
-                args.pop('summary')
-            if 'tree' in args:
-                args['content'] = json.dumps(args.pop('tree'))
-            if 'cnx-archive-uri' not in args:
-                args['cnx-archive-uri'] = None
-            # BBB 18-Nov-2014 licensors - deprecated property 'licensors'
-            #     needs changed in webview and archive before removing here.
-            if 'licensors' in args:
-                args['copyright_holders'] = args.pop('licensors')
-            # /BBB
+    def _document_args(self, item, type_name):
+        """Build the ``add-document`` statement arguments for ``item``."""
+        args = item.to_dict()
+        args['license'] = json.dumps(args['license'])
+        args['original_license'] = json.dumps(args['original_license'])
+        args['media_type'] = MEDIATYPES[type_name]
+        if 'license_url' in args:
+            args.pop('license_url')
+        if 'license_text' in args:
+            args.pop('license_text')
+        if 'summary' in args:
+            args.pop('summary')
+        if 'tree' in args:
+            args['content'] = json.dumps(args.pop('tree'))
+        if 'cnx-archive-uri' not in args:
+            args['cnx-archive-uri'] = None
+        # BBB 18-Nov-2014 licensors - deprecated property 'licensors'
+        #     needs changed in webview and archive before removing here.
+        if 'licensors' in args:
+            args['copyright_holders'] = args.pop('licensors')
+        # /BBB
+        args['publishing_fingerprints'] = item.publishing_fingerprints
 
-            for field in JSON_FIELDS:
-                args[field] = psycopg2.extras.Json(args[field])
-            checked_execute(cursor, SQL['add-document'], args)
+        for field in JSON_FIELDS:
+            args[field] = psycopg2.extras.Json(args[field])
+        return args
 
+    def _acl_entries(self, items):
+        """The ACL entries of the ``items`` as statement arguments."""
+        entries = []
+        for item in items:
             for user_id, permissions in item.acls.items():
                 for permission in set(permissions):
-                    checked_execute(cursor, SQL['add-document-acl'], {
-                        'uuid': item.id,
+                    entries.append({
+                        'uuid': str(item.id),
                         'user_id': user_id,
                         'permission': permission,
                         })
+        return entries
+
+    def _licensor_acceptance_entries(self, items):
+        """The licensor acceptance entries of the ``items``
+        as statement arguments.
+        """
+        entries = []
+        for item in items:
             for licensor in item.licensor_acceptance:
                 # licensor format: {'uid': <str>, 'has_accepted': <bool|None>}
-                params = {
-                    'uuid': item.id,
+                entries.append({
+                    'uuid': str(item.id),
                     'user_id': licensor['id'],
                     'has_accepted': licensor['has_accepted'],
-                    }
-                checked_execute(cursor,
-                                SQL['add-document-licensor-acceptance'],
-                                params)
+                    })
+        return entries
+
+    def _batch_execute(self, cursor, s, argslist):
+        """Execute ``s`` once for each of the ``argslist``
+        in as few round trips as possible.
+        """
+        if not argslist:
+            return
+        for kwargs in argslist:
+            check_args(s, kwargs)
+        if self.prepare_statements:
+            s = _prepare(cursor, s)
+        psycopg2.extras.execute_batch(cursor, s, argslist)
+
+    def _update_acls(self, cursor, items):
+        """Write only the differences between the stored ACL entries
+        and those of the ``items``.
+        """
+        self._execute(cursor, SQL['get-document-acls'],
+                      {'uuids': [UUID(str(item.id)) for item in items]})
+        stored = set([(str(uuid), user_id, permission)
+                      for uuid, user_id, permission in cursor.fetchall()])
+        keys = ('uuid', 'user_id', 'permission',)
+        current = set([tuple([entry[k] for k in keys])
+                       for entry in self._acl_entries(items)])
+        self._batch_execute(cursor, SQL['delete-document-acl-entry'], [
+            dict(zip(keys, entry)) for entry in stored - current])
+        bulk_execute(cursor, 'add-document-acl', [
+            dict(zip(keys, entry)) for entry in current - stored])
+
+    def _update_licensor_acceptance(self, cursor, items):
+        """Write only the differences between the stored licensor
+        acceptance entries and those of the ``items``.
+        """
+        self._execute(cursor, SQL['get-document-licensor-acceptances'],
+                      {'uuids': [UUID(str(item.id)) for item in items]})
+        stored = {(str(uuid), user_id): has_accepted
+                  for uuid, user_id, has_accepted in cursor.fetchall()}
+        current = {(entry['uuid'], entry['user_id']): entry
+                   for entry in self._licensor_acceptance_entries(items)}
+        removed = [{'uuid': uuid, 'user_id': user_id}
+                   for uuid, user_id in stored
+                   if (uuid, user_id) not in current]
+        added = []
+        changed = []
+        for key, entry in current.items():
+            if key not in stored:
+                added.append(entry)
+            elif stored[key] != entry['has_accepted']:
+                changed.append(entry)
+        self._batch_execute(
+            cursor, SQL['delete-document-licensor-acceptance-entry'], removed)
+        self._batch_execute(
+            cursor, SQL['update-document-licensor-acceptance'], changed)
+        bulk_execute(cursor, 'add-document-licensor-acceptance', added)
+
+    def add(self, item_or_items):
+        """Adds any item or set of items to storage."""
+        if isinstance(item_or_items, list):
+            items = item_or_items
         else:
-            raise NotImplementedError(type_name)
-        return item
+            items = [item_or_items]
+        # Read from the primary from now on, to read the changes.
+        self._local.written = True
+        cursor = self.conn.cursor()
+        documents = []
+        for item in items:
+            type_name = item.__class__.__name__.lower()
+            if isinstance(item, Resource):
+                if self.blobs is not None:
+                    self._adding_blob(item._hash)
+                exists = self.get(type_=Resource, hash=item._hash)
+                if not exists:
+                    with item.open() as f:
+                        data = f.read()
+                    size = len(data)
+                    if self.blobs is not None:
+                        # Written before the row is committed, so that it
+                        # is there once the row can be read; removed
+                        # again if the changes are aborted.
+                        self.blobs.write(item._hash, data)
+                        data = None
+                    else:
+                        data = Binary(data)
+                    checked_execute(
+                        cursor, SQL['add-resource'],
+                        {'hash': item._hash,
+                         'mediatype': item.media_type,
+                         'size': size,
+                         'data': data})
+            elif type_name in ['document', 'binder']:
+                documents.append(item)
+            else:
+                raise NotImplementedError(type_name)
+
+        if documents:
+            bulk_execute(cursor, 'add-document', [
+                self._document_args(item, item.__class__.__name__.lower())
+                for item in documents])
+            bulk_execute(cursor, 'add-document-acl',
+                         self._acl_entries(documents))
+            bulk_execute(cursor, 'add-document-licensor-acceptance',
+                         self._licensor_acceptance_entries(documents))
+        return item_or_items
 
     def remove(self, item_or_items):
         """Removes any item or set of items from storage."""
         if isinstance(item_or_items, list):
-            raise NotImplementedError()
-        item = item_or_items
-        type_name = item.__class__.__name__.lower()
+            items = item_or_items
+        else:
+            items = [item_or_items]
+        self._local.written = True
+        for item in items:
+            self._forget(item)
         with self.conn.cursor() as cursor:
-            if type_name == 'resource':
-                checked_execute(cursor, SQL['delete-resource'],
-                                {'hash': item._hash})
-            elif type_name in ['document', 'binder']:
-                params = {'uuid': item.id}
+            document_ids = []
+            for item in items:
+                type_name = item.__class__.__name__.lower()
+                if isinstance(item, Resource):
+                    checked_execute(cursor, SQL['delete-resource'],
+                                    {'hash': item._hash})
+                    if self.blobs is not None:
+                        # Removed from the filesystem once committed.
+                        self._local.removed_blobs = getattr(
+                            self._local, 'removed_blobs', []) + [item._hash]
+                elif type_name in ['document', 'binder']:
+                    document_ids.append(item.id)
+            if document_ids:
+                params = {'uuids': document_ids}
                 checked_execute(cursor, SQL['delete-document-acl'], params)
                 checked_execute(cursor,
                                 SQL['delete-document-licensor-acceptance'],
                                 params)
                 checked_execute(cursor, SQL['delete-document'],
-                                {'id': item.id})
-        return item
+                                {'ids': document_ids})
+        return item_or_items
 
     def update(self, item_or_items):
         """Updates any item or set of items in storage."""
         if isinstance(item_or_items, list):
-            raise NotImplementedError()
-        item = item_or_items
-        type_name = item.__class__.__name__.lower()
+            items = item_or_items
+        else:
+            items = [item_or_items]
+        self._local.written = True
+        # The stored content may differ from the items (e.g. the ACLs
+        # inherited from binders), so it is retrieved again.
+        for item in items:
+            self._forget(item)
         cursor = self.conn.cursor()
-        if type_name == 'resource':
-            checked_execute(
-                cursor, SQL['update-resource'],
-                {'hash': item._hash,
-                 'mediatype': item.mediatype,
-                 'data': Binary(item.data)})
-        elif type_name in ['document', 'binder']:
-            args = item.to_dict()
-            args['license'] = json.dumps(args['license'])
-            args['original_license'] = json.dumps(args['original_license'])
-            if 'license_url' in args:
-                args.pop('license_url')
-            if 'license_text' in args:
-                args.pop('license_text')
-            if 'media_type' in args:
+        documents = []
+        argslist = []
+        for item in items:
+            type_name = item.__class__.__name__.lower()
+            if type_name == 'resource':
+                checked_execute(
+                    cursor, SQL['update-resource'],
+                    {'hash': item._hash,
+                     'mediatype': item.mediatype,
+                     'data': Binary(item.data)})
+            elif type_name in ['document', 'binder']:
+                args = self._document_args(item, type_name)
                 args.pop('media_type')
-            if 'summary' in args:
-                args.pop('summary')
-            if 'cnx-archive-uri' not in args:
-                args['cnx-archive-uri'] = None
-            if 'tree' in args:
-                args['content'] = json.dumps(args.pop('tree'))
-            # BBB 18-Nov-2014 licensors - deprecated property 'licensors'
-            #     needs changed in webview and archive before removing here.
-            if 'licensors' in args:
-                args['copyright_holders'] = args.pop('licensors')
-            # /BBB
+                documents.append(item)
+                argslist.append(args)
 
-            for field in JSON_FIELDS:
-                args[field] = psycopg2.extras.Json(args[field])
-            checked_execute(cursor, SQL['update-document'], args)
-            checked_execute(cursor, SQL['delete-document-acl'],
-                            {'uuid': args['id']})
-            for user_id, permissions in item.acls.items():
-                for permission in set(permissions):
-                    checked_execute(cursor, SQL['add-document-acl'], {
-                        'uuid': item.id,
-                        'user_id': user_id,
-                        'permission': permission,
-                        })
-            checked_execute(cursor, SQL['delete-document-licensor-acceptance'],
-                            {'uuid': args['id']})
-            for licensor in item.licensor_acceptance:
-                # licensor format: {'uid': <str>, 'has_accepted': <bool|None>}
-                params = {
-                    'uuid': item.id,
-                    'user_id': licensor['id'],
-                    'has_accepted': licensor['has_accepted'],
-                    }
-                checked_execute(cursor,
-                                SQL['add-document-licensor-acceptance'],
-                                params)
-        return item
+        if documents:
+            self._batch_execute(cursor, SQL['update-document'], argslist)
+            self._update_acls(cursor, documents)
+            self._update_licensor_acceptance(cursor, documents)
+        return item_or_items
+
+    def update_containment(self, binder_id, document_ids):
+        """Updates which documents are in the binder (by their
+        ``contained_in``) to those of the ``document_ids``, in a statement
+        for the documents added to and one for those removed from it.
+        """
+        self._local.written = True
+        args = {'binder_id': str(binder_id),
+                'ids': [UUID(str(id)) for id in document_ids]}
+        with self.conn.cursor() as cursor:
+            changed = []
+            for name in ('add-document-containment',
+                         'delete-document-containment'):
+                self._execute(cursor, SQL[name], args)
+                changed.extend([row[0] for row in cursor.fetchall()])
+        # The documents inherit the binder's ACL, so they are
+        # retrieved again.
+        for id in changed:
+            key = ('document', str(id))
+            self._identity_map.pop(key, None)
+            if self.document_cache is not None:
+                self.document_cache.pop(key)
+
+    def get_pending_publications(self):
+        """Retrieve the ``id``, ``publication`` and ``state`` of the
+        documents with a publication in progress in publishing.
+        """
+        with self.conn.cursor(
+                cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            self._execute(cursor, SQL['get-pending-publications'], {})
+            return [dict(row) for row in cursor.fetchall()]
+
+    def update_document_state(self, id, publication, state, revised):
+        """Sets the ``state`` and ``revised`` time of the document ``id``
+        of the ``publication``, unless it has been published again since
+        or already has the state. Only those columns are written, so that
+        changes made to the document meanwhile are kept.
+        Returns whether it was updated.
+        """
+        self._local.written = True
+        id = UUID(str(id))
+        with self.conn.cursor() as cursor:
+            self._execute(cursor, SQL['update-document-state'],
+                          {'id': id, 'publication': str(publication),
+                           'state': state, 'revised': revised})
+            updated = cursor.rowcount > 0
+        if updated:
+            key = ('document', str(id))
+            self._identity_map.pop(key, None)
+            if self.document_cache is not None:
+                self.document_cache.pop(key)
+        return updated
+
+    def add_notifications(self, notifications):
+        """Adds the ``notifications`` (dicts of the ``user_id``, ``subject``
+        and ``body`` of messages to users) to the outbox.
+        """
+        self._local.written = True
+        with self.conn.cursor() as cursor:
+            bulk_execute(cursor, 'add-notification', notifications)
+
+    def get_notifications(self, limit, max_attempts):
+        """Retrieve up to ``limit`` notifications due to be sent,
+        locking them until the changes are persisted or aborted.
+        """
+        self._local.written = True
+        with self.conn.cursor(
+                cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            self._execute(cursor, SQL['get-notifications'],
+                          {'limit': limit, 'max_attempts': max_attempts})
+            return [dict(row) for row in cursor.fetchall()]
+
+    def remove_notifications(self, ids):
+        """Removes the notifications of the ``ids`` from the outbox."""
+        if not ids:
+            return
+        self._local.written = True
+        with self.conn.cursor() as cursor:
+            self._execute(cursor, SQL['delete-notifications'],
+                          {'ids': list(ids)})
+
+    def reschedule_notification(self, id, next_attempt, error):
+        """Records the failed attempt to send the notification ``id``
+        and when to attempt it next.
+        """
+        self._local.written = True
+        with self.conn.cursor() as cursor:
+            self._execute(cursor, SQL['update-notification'],
+                          {'id': id, 'next_attempt': next_attempt,
+                           'error': error})
+
+    def _adding_blob(self, hash):
+        """Record that the current thread's transaction may refer to the
+        blob of ``hash``, until it is committed or rolled back.
+        """
+        added = getattr(self._local, 'added_blobs', None)
+        if added is None:
+            added = self._local.added_blobs = set()
+        if hash not in added:
+            added.add(hash)
+            with self._blob_lock:
+                self._adding_blobs[hash] += 1
+
+    def _end_blobs(self, remove):
+        """End the current thread's use of the blobs it added, once its
+        transaction is committed or rolled back, and remove the blobs of
+        the ``remove`` hashes that nothing refers to anymore.
+        """
+        added = getattr(self._local, 'added_blobs', None) or set()
+        self._local.added_blobs = set()
+        self._local.removed_blobs = []
+        if self.blobs is None:
+            return
+
+        def unused(hashes):
+            # Blobs being added by transactions in progress are kept.
+            return [hash for hash in hashes if hash not in self._adding_blobs]
+
+        with self._blob_lock:
+            for hash in added:
+                self._adding_blobs[hash] -= 1
+                if not self._adding_blobs[hash]:
+                    del self._adding_blobs[hash]
+            remove = unused(set(remove))
+        if not remove:
+            return
+        # So are the blobs of stored resources, e.g. added again since.
+        # The connection is taken without holding the lock, which threads
+        # holding connections wait for.
+        conn = self.conn
+        try:
+            with conn.cursor() as cursor:
+                self._execute(cursor, SQL['get-resource-hashes'],
+                              {'hashes': remove})
+                stored = set([row[0] for row in cursor.fetchall()])
+        finally:
+            conn.rollback()
+            self._release()
+        with self._blob_lock:
+            for hash in unused(remove):
+                if hash not in stored:
+                    self.blobs.remove(hash)
 
     def persist(self):
         """Persist/commit the changes."""
+        self._local.identity_map = {}
+        self._release_replica()
+        if getattr(self._local, 'conn', None) is None:
+            return
         self.conn.commit()
+        self._release()
+        self._end_blobs(getattr(self._local, 'removed_blobs', []))
 
     def abort(self):
         """Abort the changes"""
-        self.conn.rollback()
+        self._local.identity_map = {}
+        self._release_replica()
+        try:
+            if getattr(self._local, 'conn', None) is not None:
+                self.conn.rollback()
+                self._release()
+        finally:
+            # The blobs written for the aborted changes are removed,
+            # the removed ones kept.
+            self._end_blobs(getattr(self._local, 'added_blobs', None) or [])
 
-    def search(self, limits, type_=Document, submitter_id=None):
+    def search(self, limits, type_=Document, submitter_id=None,
+               stream=False, limit=None, after=None):
         """Retrieve any ``Document`` objects from storage that matches the
-        search terms."""
+        search terms, best matches first. When paging through the results
+        with a ``limit`` and ``after`` key (see ``get_all``), they are
+        most recently revised first instead.
+        """
         if type_ != Document:
             raise NotImplementedError()
 
-        in_progress = (self.conn.status != STATUS_READY)
+        conn = self.read_conn
+        in_progress = (conn.status != STATUS_READY)
 
-        cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor = self._cursor(conn, stream)
 
         search_terms = []
         for limit_type, term in limits:
             if limit_type != 'text':
                 raise NotImplementedError()
-            search_terms.append(term.lower())
+            search_terms.append(term)
 
-        title_terms = ['lower(title) ~ %s'] * len(search_terms)
-        if submitter_id is None:
-            where_clause = '(' + ' OR '.join(title_terms) + ')'
-            sqlargs = search_terms
-        else:
-            where_clause = '(' + ' OR '.join(title_terms) + \
-                ") AND submitter->>'id' = %s"
-            sqlargs = search_terms + [submitter_id]
+        sqlargs = {'terms': search_terms, 'limit': limit}
+        match_clauses = []
+        if submitter_id is not None:
+            match_clauses.append("submitter->>'id' = %(submitter_id)s")
+            sqlargs['submitter_id'] = submitter_id
+        order_by = 'ts_rank_cd(search_vector, search.query) DESC, revised DESC'
+        if limit is not None or after is not None:
+            # The rank can't be used as a key.
+            order_by = 'revised DESC, id DESC'
+        if after is not None:
+            match_clauses.append(PAGE_CLAUSE)
+            sqlargs.update({
+                'after_revised': after[0],
+                'after_id': after[1]})
 
-        cursor.execute(SQL['search-title'].format(where_clause=where_clause),
-                       sqlargs)
-        res = cursor.fetchall()
-        if not in_progress:
-            self.conn.rollback()  # Frees the connection
-        if res:
-            for item in res:
-                yield self._reassemble_model_from_document_entry(**item)
+        self._execute(cursor, render_sql(
+            'search-document', columns=DOCUMENT_COLUMNS,
+            where_clause=' AND '.join(match_clauses) or '1 = 1',
+            order_by=order_by), sqlargs)
+        for model in self._fetch_models(cursor, in_progress, stream):
+            yield self._identify(model)
         raise StopIteration
 
     def restart(self):
         """Restart the interface"""
-        self.conn = psycopg2.connect(self.db_connection_string)
+        # Discard the (likely broken) connection, the next use
+        # checks out a fresh one.
+        self._local.identity_map = {}
+        self._release_replica(close=True)
+        self._release(close=True)
@@ -0,0 +1,17 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: binder_id:string, ids:uuid[]
+-- Adds the binder to the containing binders of the documents
+-- that aren't in it yet.
+
+UPDATE document
+SET contained_in = array_append(coalesce(contained_in, '{}'::text[]),
+                                %(binder_id)s::text)
+WHERE id = ANY(%(ids)s::uuid[])
+  AND NOT coalesce(contained_in, '{}'::text[]) @> ARRAY[%(binder_id)s]::text[]
+RETURNING id;
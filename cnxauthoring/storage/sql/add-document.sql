@@ -13,11 +13,13 @@ INSERT INTO document (license, language, created, abstract, media_type,
                       cnx_archive_uri, subjects, keywords, state,
                       publication, publishers, contained_in, original_license,
                       copyright_holders, editors, translators,
-                      illustrators, version, print_style)
+                      illustrators, version, print_style,
+                      publishing_fingerprints)
     VALUES(%(license)s, %(language)s, %(created)s, %(abstract)s, %(media_type)s,
            %(title)s, %(revised)s, %(content)s, %(derived_from)s, %(submitter)s,
            %(authors)s, %(id)s, %(derived_from_title)s, %(derived_from_uri)s,
            %(cnx-archive-uri)s, %(subjects)s, %(keywords)s, %(state)s,
            %(publication)s, %(publishers)s, %(contained_in)s, %(original_license)s,
            %(copyright_holders)s, %(editors)s, %(translators)s,
-           %(illustrators)s, %(version)s,  %(print_style)s);
+           %(illustrators)s, %(version)s,  %(print_style)s,
+           %(publishing_fingerprints)s);
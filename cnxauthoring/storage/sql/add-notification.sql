@@ -0,0 +1,11 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: user_id:string, subject:string, body:string
+
+INSERT INTO notification_outbox (user_id, subject, body)
+VALUES (%(user_id)s, %(subject)s, %(body)s);
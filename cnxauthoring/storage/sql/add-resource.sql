@@ -5,6 +5,7 @@
 -- See LICENCE.txt for details.
 -- ###
 
--- arguments: hash:string; mediatype:string, data:bytea
+-- arguments: hash:string; mediatype:string, size:integer, data:bytea
 
-INSERT INTO resource (hash,mediatype,data) VALUES( %(hash)s, %(mediatype)s, %(data)s);
+INSERT INTO resource (hash, mediatype, size, data)
+    VALUES (%(hash)s, %(mediatype)s, %(size)s, %(data)s);
@@ -0,0 +1,12 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: uuid:uuid; user_id:string, permission:string
+
+DELETE FROM document_acl
+WHERE uuid = %(uuid)s AND user_id = %(user_id)s
+  AND permission = %(permission)s;
@@ -0,0 +1,16 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: binder_id:string, ids:uuid[]
+-- Removes the binder from the containing binders of the documents
+-- other than those of the ids.
+
+UPDATE document
+SET contained_in = array_remove(contained_in, %(binder_id)s::text)
+WHERE contained_in @> ARRAY[%(binder_id)s]::text[]
+  AND id <> ALL(%(ids)s::uuid[])
+RETURNING id;
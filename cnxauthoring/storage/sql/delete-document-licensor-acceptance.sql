@@ -5,6 +5,6 @@
 -- See LICENCE.txt for details.
 -- ###
 
--- arguments: uuid:uuid
+-- arguments: uuids:uuid[]
 
-DELETE FROM document_licensor_acceptance WHERE uuid = %(uuid)s;
+DELETE FROM document_licensor_acceptance WHERE uuid = ANY(%(uuids)s::uuid[]);
@@ -5,6 +5,6 @@
 -- See LICENCE.txt for details.
 -- ###
 
--- arguments: id:string
+-- arguments: ids:uuid[]
 
-DELETE FROM document WHERE id =  %(id)s;
+DELETE FROM document WHERE id = ANY(%(ids)s::uuid[]);
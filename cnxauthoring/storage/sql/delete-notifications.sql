@@ -0,0 +1,10 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: ids:int[]
+
+DELETE FROM notification_outbox WHERE id = ANY(%(ids)s::int[]);
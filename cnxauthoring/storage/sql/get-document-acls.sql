@@ -0,0 +1,11 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: uuids:uuid[]
+
+SELECT uuid, user_id, permission FROM document_acl
+WHERE uuid = ANY(%(uuids)s::uuid[]);
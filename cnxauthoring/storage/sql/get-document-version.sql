@@ -0,0 +1,26 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: id:uuid
+-- The version of a document, which changes with any change to the
+-- document, its ACL and licensor acceptance, or the ACLs of the binders
+-- it is in: the ids of the transactions that last wrote those rows.
+
+SELECT revised,
+       xmin::text || ';' || coalesce((
+           SELECT string_agg(acl.xmin::text, ',' ORDER BY acl.xmin::text)
+           FROM document_acl acl
+           WHERE acl.uuid = ANY(ARRAY[document.id] || ARRAY(
+               SELECT binderid::uuid FROM unnest(contained_in) binderid
+               WHERE binderid ~* '^[0-9a-f]{8}-([0-9a-f]{4}-){3}[0-9a-f]{12}$'))
+           ), '') || ';' || coalesce((
+           SELECT string_agg(la.xmin::text, ',' ORDER BY la.xmin::text)
+           FROM document_licensor_acceptance la
+           WHERE la.uuid = document.id
+           ), '') AS version
+FROM document
+WHERE id = %(id)s;
@@ -5,11 +5,14 @@
 -- See LICENCE.txt for details.
 -- ###
 
-WITH docids as (SELECT distinct id
-FROM document d JOIN document_acl da ON d.id = da.uuid
-WHERE {where_clause}
-  AND da.user_id = %(user_id)s
-  AND da.permission IN %(permissions)s
-) 
-select * from document join docids on document.id = docids.id
-ORDER BY revised DESC;
+-- arguments: user_id:text, permissions:text[], limit:int (NULL for all)
+--            and those of the where_clause
+-- columns: the selected columns, e.g. id, title
+
+SELECT {columns} FROM document
+WHERE id IN (SELECT uuid FROM document_acl
+             WHERE user_id = %(user_id)s
+               AND permission = ANY(%(permissions)s))
+  AND {where_clause}
+ORDER BY revised DESC, id DESC
+LIMIT %(limit)s;
@@ -0,0 +1,18 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: max_attempts:int, limit:int
+-- The notifications due to be sent, locked until the end of the
+-- transaction so that they are sent once.
+
+SELECT id, user_id, subject, body, attempts
+FROM notification_outbox
+WHERE next_attempt <= CURRENT_TIMESTAMP
+  AND attempts < %(max_attempts)s
+ORDER BY next_attempt, id
+LIMIT %(limit)s
+FOR UPDATE;
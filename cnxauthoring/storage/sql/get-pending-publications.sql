@@ -0,0 +1,16 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: (none)
+-- The documents with a publication in progress in publishing, i.e. with
+-- a publication and a state other than the final 'Done/Success' and
+-- 'Failed/Error' (as in the document_publication_pending_idx index).
+
+SELECT id, publication, state FROM document
+WHERE publication IS NOT NULL
+      AND state NOT IN ('Done/Success', 'Failed/Error')
+ORDER BY publication, id;
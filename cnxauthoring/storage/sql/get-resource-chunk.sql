@@ -0,0 +1,11 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: hash:text, start:int (1-based), length:int
+
+SELECT substring(data FROM %(start)s FOR %(length)s)
+FROM resource WHERE hash = %(hash)s;
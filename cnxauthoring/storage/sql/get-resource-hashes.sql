@@ -0,0 +1,11 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: hashes:text[]
+-- The hashes of the stored resources, of those given.
+
+SELECT hash FROM resource WHERE hash = ANY(%(hashes)s::text[]);
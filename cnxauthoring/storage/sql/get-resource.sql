@@ -0,0 +1,12 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- The data is read in chunks by get-resource-chunk.
+
+SELECT hash, mediatype, COALESCE(size, octet_length(data)) AS size,
+       data IS NOT NULL AS has_data
+FROM resource WHERE {where_clause};
@@ -5,4 +5,4 @@
 -- See LICENCE.txt for details.
 -- ###
 
-SELECT * from document WHERE {where_clause} 
+SELECT version FROM schema_migrations;
@@ -5,4 +5,6 @@
 -- See LICENCE.txt for details.
 -- ###
 
-SELECT * from {tablename} WHERE {where_clause}; 
+-- columns: the selected columns, e.g. *
+
+SELECT {columns} from {tablename} WHERE {where_clause}; 
@@ -0,0 +1,6 @@
+-- arguments: batch_size:int
+-- Fills in the size of a batch of the resources without one.
+UPDATE resource SET size = octet_length(data)
+WHERE hash IN (SELECT hash FROM resource
+               WHERE size IS NULL AND data IS NOT NULL
+               LIMIT %(batch_size)s);
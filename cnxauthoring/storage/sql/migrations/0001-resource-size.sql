@@ -0,0 +1,10 @@
+-- Rerunnable, because the backfill after it commits in batches.
+DO $$
+BEGIN
+    ALTER TABLE resource ADD COLUMN size bigint;
+EXCEPTION WHEN duplicate_column THEN
+    NULL;
+END;
+$$;
+-- Only applies to data stored from now on.
+ALTER TABLE resource ALTER COLUMN data SET STORAGE EXTERNAL;
@@ -0,0 +1,6 @@
+-- arguments: batch_size:int
+-- Computes the search_vector of a batch of the documents without one,
+-- which the search_vector trigger does when it is set to NULL.
+UPDATE document SET search_vector = NULL
+WHERE id IN (SELECT id FROM document WHERE search_vector IS NULL
+             LIMIT %(batch_size)s);
@@ -0,0 +1,37 @@
+-- The search_vector trigger as of this migration, so that later changes
+-- to schema/document-search.sql don't change what it does.
+
+-- The search_vector of a document covers its title, keywords, subjects,
+-- abstract and content (without markup), weighted in that order.
+-- It is recomputed when one of those changes or it is set to NULL.
+CREATE OR REPLACE FUNCTION document_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+       AND NEW.title IS NOT DISTINCT FROM OLD.title
+       AND NEW.keywords IS NOT DISTINCT FROM OLD.keywords
+       AND NEW.subjects IS NOT DISTINCT FROM OLD.subjects
+       AND NEW.abstract IS NOT DISTINCT FROM OLD.abstract
+       AND NEW.content IS NOT DISTINCT FROM OLD.content
+       AND NEW.search_vector IS NOT NULL THEN
+        RETURN NEW;
+    END IF;
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('simple',
+            coalesce(array_to_string(NEW.keywords, ' '), '')), 'B') ||
+        setweight(to_tsvector('simple',
+            coalesce(array_to_string(NEW.subjects, ' '), '')), 'B') ||
+        setweight(to_tsvector('simple',
+            regexp_replace(coalesce(NEW.abstract, ''), '<[^>]*>', ' ', 'g')),
+            'C') ||
+        setweight(to_tsvector('simple',
+            regexp_replace(coalesce(NEW.content, ''), '<[^>]*>', ' ', 'g')),
+            'D');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS document_search_vector ON document;
+CREATE TRIGGER document_search_vector
+    BEFORE INSERT OR UPDATE ON document
+    FOR EACH ROW EXECUTE PROCEDURE document_search_vector_update();
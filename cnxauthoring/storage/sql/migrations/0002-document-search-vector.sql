@@ -0,0 +1,8 @@
+-- Rerunnable, because the backfill after it commits in batches.
+DO $$
+BEGIN
+    ALTER TABLE document ADD COLUMN search_vector tsvector;
+EXCEPTION WHEN duplicate_column THEN
+    NULL;
+END;
+$$;
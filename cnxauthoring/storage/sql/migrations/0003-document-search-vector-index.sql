@@ -0,0 +1,2 @@
+CREATE INDEX CONCURRENTLY document_search_vector_idx ON document
+    USING GIN (search_vector);
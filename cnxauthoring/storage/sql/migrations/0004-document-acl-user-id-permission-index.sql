@@ -0,0 +1,2 @@
+CREATE INDEX CONCURRENTLY document_acl_user_id_permission_idx
+    ON document_acl (user_id, permission);
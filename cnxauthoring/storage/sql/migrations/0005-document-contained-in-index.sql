@@ -0,0 +1,2 @@
+CREATE INDEX CONCURRENTLY document_contained_in_idx
+    ON document USING GIN (contained_in);
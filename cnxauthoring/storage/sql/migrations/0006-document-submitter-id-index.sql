@@ -0,0 +1,2 @@
+CREATE INDEX CONCURRENTLY document_submitter_id_idx
+    ON document ((submitter->>'id'));
@@ -0,0 +1,2 @@
+CREATE INDEX CONCURRENTLY document_revised_id_idx
+    ON document (revised, id);
@@ -0,0 +1 @@
+ALTER TABLE document ADD COLUMN publishing_fingerprints json;
@@ -0,0 +1,4 @@
+CREATE INDEX CONCURRENTLY document_publication_pending_idx
+    ON document (publication)
+    WHERE publication IS NOT NULL
+          AND state NOT IN ('Done/Success', 'Failed/Error');
@@ -4,3 +4,6 @@ CREATE TABLE document_acl ( uuid       UUID NOT NULL,
                             PRIMARY KEY (uuid, user_id, permission),
                             FOREIGN KEY (uuid) REFERENCES document (id) ON DELETE CASCADE
                           );
+
+CREATE INDEX document_acl_user_id_permission_idx
+    ON document_acl (user_id, permission);
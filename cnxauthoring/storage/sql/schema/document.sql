@@ -25,5 +25,15 @@ CREATE TABLE document ( id                 uuid primary key,
                         cnx_archive_uri    text,
                         version            text,
                         contained_in       text[],
-                        print_style    text
+                        print_style    text,
+                        search_vector      tsvector,
+                        publishing_fingerprints json
                     );
+
+CREATE INDEX document_contained_in_idx ON document USING GIN (contained_in);
+CREATE INDEX document_submitter_id_idx ON document ((submitter->>'id'));
+CREATE INDEX document_search_vector_idx ON document USING GIN (search_vector);
+CREATE INDEX document_revised_id_idx ON document (revised, id);
+CREATE INDEX document_publication_pending_idx ON document (publication)
+    WHERE publication IS NOT NULL
+          AND state NOT IN ('Done/Success', 'Failed/Error');
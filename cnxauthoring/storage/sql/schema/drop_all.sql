@@ -1,4 +1,7 @@
+DROP TABLE IF EXISTS notification_outbox;
 DROP TABLE IF EXISTS document_acl;
 DROP TABLE IF EXISTS document_licensor_acceptance;
 DROP TABLE IF EXISTS document;
 DROP TABLE IF EXISTS resource;
+DROP FUNCTION IF EXISTS document_search_vector_update();
+DROP TABLE IF EXISTS schema_migrations;
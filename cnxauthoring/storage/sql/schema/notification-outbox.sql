@@ -0,0 +1,15 @@
+-- Messages to users waiting to be sent through accounts
+-- (see ``cnxauthoring.notifications``).
+CREATE TABLE notification_outbox (
+    id            serial PRIMARY KEY,
+    user_id       text NOT NULL,
+    subject       text NOT NULL,
+    body          text NOT NULL,
+    created       timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attempts      integer NOT NULL DEFAULT 0,
+    next_attempt  timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error    text
+    );
+
+CREATE INDEX notification_outbox_next_attempt_idx
+    ON notification_outbox (next_attempt);
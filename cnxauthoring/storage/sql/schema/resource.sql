@@ -1,3 +1,6 @@
 CREATE table resource ( hash text primary key,
                         mediatype text,
+                        size    bigint,
                         data    bytea);
+-- Stored uncompressed, so that substring() reads only the requested chunk.
+ALTER TABLE resource ALTER COLUMN data SET STORAGE EXTERNAL;
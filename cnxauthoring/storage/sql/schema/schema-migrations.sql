@@ -0,0 +1,5 @@
+-- The applied migrations, see ``MIGRATIONS`` in database.py.
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version   text primary key,
+    applied   timestamptz not null default now()
+    );
@@ -0,0 +1,26 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: terms:text[], limit:int (NULL for all)
+--            and those of the where_clause
+-- columns: the selected columns, e.g. id, title
+-- Matches documents containing words starting with all the words of any
+-- of the terms, in the order_by order, e.g. best ranked first. Each word
+-- of a term becomes a prefix match, e.g. 'phys':* for "phys".
+
+SELECT {columns}
+FROM document,
+     (SELECT to_tsquery('simple', string_agg(
+                 '(' || regexp_replace(plainto_tsquery('simple', term)::text,
+                                       '''( |$)', ''':*\1', 'g') || ')',
+                 ' | '))
+             AS query
+      FROM unnest(%(terms)s::text[]) AS term
+      WHERE plainto_tsquery('simple', term)::text <> '') AS search
+WHERE search_vector @@ search.query AND {where_clause}
+ORDER BY {order_by}
+LIMIT %(limit)s;
@@ -0,0 +1,11 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: uuid:uuid; user_id:string, has_accepted:bool
+
+UPDATE document_licensor_acceptance SET has_accepted = %(has_accepted)s
+WHERE uuid = %(uuid)s AND user_id = %(user_id)s;
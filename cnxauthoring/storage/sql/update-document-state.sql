@@ -0,0 +1,14 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: id:uuid, publication:text, state:text, revised:timestamptz
+-- Sets the state of the document of the publication, unless it has been
+-- published again since or already has the state.
+
+UPDATE document SET state = %(state)s, revised = %(revised)s
+WHERE id = %(id)s AND publication = %(publication)s
+      AND state IS DISTINCT FROM %(state)s;
@@ -23,5 +23,6 @@ UPDATE document
             original_license = %(original_license)s,
             copyright_holders = %(copyright_holders)s,
             editors = %(editors)s, translators = %(translators)s,
-            illustrators = %(illustrators)s, version = %(version)s, print_style = %(print_style)s
+            illustrators = %(illustrators)s, version = %(version)s, print_style = %(print_style)s,
+            publishing_fingerprints = %(publishing_fingerprints)s
 WHERE id  = %(id)s
@@ -0,0 +1,13 @@
+-- ###
+-- Copyright (c) 2014, Rice University
+-- This software is subject to the provisions of the GNU Affero General
+-- Public License version 3 (AGPLv3).
+-- See LICENCE.txt for details.
+-- ###
+
+-- arguments: id:int, next_attempt:timestamptz, error:string
+
+UPDATE notification_outbox
+SET attempts = attempts + 1, next_attempt = %(next_attempt)s,
+    last_error = %(error)s
+WHERE id = %(id)s;
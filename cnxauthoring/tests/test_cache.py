@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import os
+import threading
+import time
+import unittest
+try:
+    from unittest import mock  # python3
+except ImportError:
+    import mock  # python2
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def make_one(self, *args, **kwargs):
+        from ..cache import LRUCache
+        return LRUCache(*args, **kwargs)
+
+    def test_get_and_set(self):
+        cache = self.make_one(2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_least_recently_used_dropped(self):
+        cache = self.make_one(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_sizeof(self):
+        cache = self.make_one(10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.size, 8)
+        cache.set('c', 'xxxx')
+        self.assertEqual(sorted(cache._items), ['b', 'c'])
+        # Replacing a value replaces its size.
+        cache.set('c', 'x')
+        self.assertEqual(cache.size, 5)
+        # Values larger than the cache aren't kept.
+        cache.set('d', 'x' * 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.pop('c'), 'x')
+        self.assertEqual(cache.size, 4)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_ttl(self):
+        cache = self.make_one(10)
+        with mock.patch('time.time', return_value=100.0):
+            cache.set('a', 1, ttl=5)
+            cache.set('b', 2)
+        with mock.patch('time.time', return_value=104.0):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('time.time', return_value=105.0):
+            self.assertNotIn('a', cache)
+            self.assertEqual(cache.get('a', 'default'), 'default')
+            self.assertEqual(cache.get('b'), 2)
+        # Expired values don't count towards the size.
+        self.assertEqual((len(cache), cache.size), (1, 1))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def make_one(self, *args, **kwargs):
+        from ..cache import ResponseCache
+        return ResponseCache(*args, **kwargs)
+
+    def test_memory(self):
+        cache = self.make_one(10)
+        self.assertEqual(cache.get('http://archive/a'), None)
+        cache.set('http://archive/a', '"v1"', b'12345')
+        cache.set('http://archive/b', None, b'12345')
+        self.assertEqual(cache.get('http://archive/a'), ('"v1"', b'12345'))
+        self.assertEqual(cache.get('http://archive/b'), (None, b'12345'))
+        # The size is the bytes of the bodies.
+        cache.set('http://archive/c', None, b'1')
+        self.assertEqual(cache.get('http://archive/a'), None)
+
+    def test_directory(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = self.make_one(0, os.path.join(directory, 'archive'))
+        cache.set('http://archive/a', '"v1"', b'line\nline')
+        cache.set('http://archive/b', None, b'')
+        self.assertEqual(len(os.listdir(cache.directory)), 2)
+
+        # Responses on disk outlive the cache in memory.
+        cache = self.make_one(10, cache.directory)
+        self.assertEqual(cache.get('http://archive/a'),
+                         ('"v1"', b'line\nline'))
+        self.assertEqual(cache.get('http://archive/b'), (None, b''))
+        self.assertEqual(cache.get('http://archive/c'), None)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def make_one(self):
+        from ..cache import SingleFlight
+        return SingleFlight()
+
+    def test_concurrent_calls_coalesced(self):
+        flights = self.make_one()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            started.set()
+            release.wait(5)
+            return value * 2
+
+        results = []
+
+        def call():
+            results.append(flights.call('key', func, 21))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=call) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        # Let the followers wait on the call in progress.
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 4)
+
+        # Later calls are made anew.
+        self.assertEqual(flights.call('key', lambda: 'again'), 'again')
+
+    def test_error(self):
+        flights = self.make_one()
+
+        def func():
+            raise IOError('down')
+
+        with self.assertRaises(IOError):
+            flights.call('key', func)
+        self.assertEqual(flights._calls, {})
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import unittest
+try:
+    from unittest import mock  # python3
+except ImportError:
+    import mock  # python2
+
+from pyramid import testing
+
+
+class ServiceClientTestCase(unittest.TestCase):
+
+    def test_from_settings(self):
+        from ..clients import ServiceClient
+        client = ServiceClient.from_settings({
+            'publishing.url': 'http://publishing/',
+            'publishing.pool-size': '4',
+            'publishing.connect-timeout': '2',
+            'publishing.read-timeout': '30',
+            'archive.read-timeout': '5',
+            }, 'publishing')
+        self.assertEqual(client.timeout, (2.0, 30.0))
+        adapter = client.session.get_adapter('http://publishing/')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertIs(client.session.get_adapter('https://publishing/'),
+                      adapter)
+
+    def test_timeout(self):
+        from ..clients import ServiceClient
+        client = ServiceClient(connect_timeout=1, read_timeout=2)
+        with mock.patch('requests.Session.get') as get, \
+                mock.patch('requests.Session.post') as post:
+            client.get('http://publishing/', headers={'x-api-key': 'b07'})
+            client.post('http://publishing/', data='{}', timeout=10)
+        get.assert_called_once_with('http://publishing/',
+                                    headers={'x-api-key': 'b07'},
+                                    timeout=(1.0, 2.0))
+        post.assert_called_once_with('http://publishing/', data='{}',
+                                     timeout=10)
+
+    def test_get_client(self):
+        from ..clients import get_client
+        settings = {'archive.read-timeout': '5'}
+        with testing.testConfig(settings=settings) as config:
+            client = get_client('archive')
+            self.assertEqual(client.timeout, (10.0, 5.0))
+            # The client is shared.
+            self.assertIs(get_client('archive', config.registry), client)
+            self.assertIsNot(get_client('publishing'), client)
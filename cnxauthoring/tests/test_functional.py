@@ -3053,6 +3053,73 @@ class FunctionalTests(BaseFunctionalTestCase):
                 },
             })
 
+    def test_user_contents_pagination(self):
+        self.logout()
+        self.login('user4')
+        titles = []
+        for i in range(5):
+            date = datetime.datetime.now(TZINFO) - datetime.timedelta(5 - i)
+            mock_datetime = mock.Mock()
+            mock_datetime.now = mock.Mock(return_value=date)
+            with mock.patch('datetime.datetime', mock_datetime):
+                self.testapp.post_json(
+                    '/users/contents', {'title': 'page {}'.format(i)},
+                    status=201)
+            titles.insert(0, u'page {}'.format(i))
+
+        pages = []
+        url = '/users/contents?limit=2'
+        while True:
+            response = self.testapp.get(url, status=200)
+            results = response.json['results']
+            self.assertEqual(results['total'], len(results['items']))
+            pages.append([item['title'] for item in results['items']])
+            if results['cursor'] is None:
+                break
+            url = '/users/contents?limit=2&cursor={}'.format(
+                results['cursor'])
+        self.assertEqual(pages, [titles[:2], titles[2:4], titles[4:]])
+
+        # The search results can be paged through the same way.
+        response = self.testapp.get(
+            '/users/contents/search?q=page&limit=3', status=200)
+        results = response.json['results']
+        self.assertEqual([item['title'] for item in results['items']],
+                         titles[:3])
+        response = self.testapp.get(
+            '/users/contents/search?q=page&limit=3&cursor={}'.format(
+                results['cursor']), status=200)
+        results = response.json['results']
+        self.assertEqual([item['title'] for item in results['items']],
+                         titles[3:])
+        self.assertEqual(results['cursor'], None)
+
+        self.testapp.get('/users/contents?limit=0', status=400)
+        self.testapp.get('/users/contents?cursor=invalid', status=400)
+
+    def test_user_contents_publication_state_saved(self):
+        response = self.testapp.post_json(
+            '/users/contents', {'title': 'Pending page'}, status=201)
+        from ..storage import storage
+        document = storage.get(id=response.json['id'])
+        document.update(state='Processing', publication=u'1')
+        storage.update(document)
+        storage.persist()
+
+        with mock.patch('cnxauthoring.publications.get_publication_state',
+                        return_value='Done/Success'):
+            response = self.testapp.get('/users/contents', status=200)
+        (item,) = [item for item in response.json['results']['items']
+                   if item['title'] == 'Pending page']
+        self.assertEqual(item['state'], 'Done/Success')
+
+        # The state update made while listing is stored.
+        with storage.conn.cursor() as cursor:
+            cursor.execute('SELECT state FROM document WHERE id = %s',
+                           (document.id,))
+            self.assertEqual(cursor.fetchone()[0], 'Done/Success')
+        storage.abort()
+
     def test_db_restart(self):
         '''
         Test to see if the database resets itself after a broken
@@ -3228,7 +3295,7 @@ class PublicationTests(BaseFunctionalTestCase):
                     page['id'],
                     ],
                 }
-        with mock.patch('requests.post') as patched_post:
+        with mock.patch('requests.Session.post') as patched_post:
             patched_post.return_value = mock.Mock(status_code=404)
             response = self.testapp.post_json(
                     '/publish', post_data, status=400)
@@ -3252,7 +3319,7 @@ class PublicationTests(BaseFunctionalTestCase):
                     page['id'],
                     ],
                 }
-        with mock.patch('requests.post') as patched_post:
+        with mock.patch('requests.Session.post') as patched_post:
             patched_post.return_value = mock.Mock(
                 status_code=200, content=b'not json')
             response = self.testapp.post_json(
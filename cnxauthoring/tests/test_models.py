@@ -259,3 +259,51 @@ class ModelUtilitiesTestCase(unittest.TestCase):
                          expected_license.code)
         self.assertEqual(document_as_dict['license']['version'],
                          expected_license.version)
+
+
+class LazyContentTestCase(unittest.TestCase):
+
+    def test_document_content(self):
+        from ..models import Document
+        content = (u'<p>A <img src="/resources/1234"/> '
+                   u'and a <a href="http://example.com">link</a></p>')
+        document = Document('title', content=content, lazy=True)
+        self.assertIn('_unparsed_content', document.__dict__)
+
+        self.assertEqual(len(document.references), 2)
+        self.assertNotIn('_unparsed_content', document.__dict__)
+        self.assertEqual(document.content, content)
+
+        document = Document('title', content=content, lazy=True)
+        document.update(content=u'<p>Changed</p>')
+        self.assertEqual(document.content, u'<p>Changed</p>')
+        self.assertEqual(document.references, [])
+
+    @mock.patch('cnxauthoring.storage.storage')
+    def test_binder_tree(self, storage):
+        from ..models import Binder, Document
+        page = Document('page')
+        storage.get.return_value = page
+        binder = Binder('book', {'contents': [
+            {'id': '{}@draft'.format(page.id), 'title': 'Page'},
+            {'id': 'subcol', 'title': 'Chapter', 'contents': [
+                {'id': '91cb5f28-2b8a-4324-9373-dac1d617bc24@1'},
+                ]},
+            ]}, lazy=True)
+        self.assertEqual(storage.get.call_count, 0)
+
+        self.assertEqual(len(binder), 2)
+        storage.get.assert_called_once_with(id=page.id)
+        self.assertEqual(binder[0], page)
+        self.assertEqual(binder.get_title_for_node(page), 'Page')
+        self.assertEqual(binder[1].metadata['title'], 'Chapter')
+
+    @mock.patch('cnxauthoring.storage.storage')
+    def test_binder_tree_not_needed(self, storage):
+        from ..models import Binder
+        binder = Binder('book', {'contents': [
+            {'id': '91cb5f28-2b8a-4324-9373-dac1d617bc24@draft'}]},
+            lazy=True)
+        binder.update(title='new title')
+        self.assertEqual(binder.metadata['title'], 'new title')
+        self.assertEqual(storage.get.call_count, 0)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import datetime
+import time
+import unittest
+try:
+    from unittest import mock  # python3
+except ImportError:
+    import mock  # python2
+
+from pyramid import testing
+
+
+class NotificationDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from ..storage.memory import MemoryStorage
+        self.storage = MemoryStorage()
+        self.accounts = mock.Mock()
+        self.registry = mock.Mock()
+        self.registry.getUtility.return_value = self.accounts
+
+    def make_one(self, **kwargs):
+        from ..notifications import NotificationDispatcher
+        return NotificationDispatcher(self.storage, self.registry, **kwargs)
+
+    def add_notifications(self, *user_ids):
+        self.storage.add_notifications([
+            {'user_id': user_id, 'subject': 'Hello', 'body': 'Hi there'}
+            for user_id in user_ids])
+        self.storage.persist()
+
+    def test_dispatch(self):
+        self.add_notifications('user1', 'user2', 'user3')
+        dispatcher = self.make_one(batch_size=2)
+
+        self.assertEqual(dispatcher.dispatch(), 2)
+        self.assertEqual(self.accounts.send_message.call_args_list, [
+            mock.call('user1', 'Hello', 'Hi there'),
+            mock.call('user2', 'Hello', 'Hi there'),
+            ])
+        self.assertEqual(dispatcher.dispatch(), 1)
+        self.assertEqual(self.accounts.send_message.call_count, 3)
+        # The sent messages are removed from the outbox.
+        self.assertEqual(dispatcher.dispatch(), 0)
+
+    def test_dispatch_retries(self):
+        from ..utils import TZINFO
+        self.add_notifications('user1', 'user2')
+        self.accounts.send_message.side_effect = [IOError('down'), None]
+        dispatcher = self.make_one(retry_delay=10, max_retry_delay=15,
+                                   max_attempts=3)
+
+        before = datetime.datetime.now(TZINFO)
+        self.assertEqual(dispatcher.dispatch(), 2)
+        (notification,) = self.storage._notifications.values()
+        self.assertEqual(notification['user_id'], 'user1')
+        self.assertEqual(notification['attempts'], 1)
+        self.assertEqual(notification['last_error'], 'down')
+        self.assertTrue(notification['next_attempt'] >=
+                        before + datetime.timedelta(seconds=10))
+        # It isn't retried until the delay has passed.
+        self.assertEqual(dispatcher.dispatch(), 0)
+
+        # The delay doubles up to the maximum delay.
+        self.assertTrue(dispatcher._next_attempt(1) - before >=
+                        datetime.timedelta(seconds=15))
+        self.assertTrue(dispatcher._next_attempt(5) - before <
+                        datetime.timedelta(seconds=16))
+
+        # Messages are given up on after the maximum attempts.
+        notification['next_attempt'] = before
+        notification['attempts'] = 3
+        self.assertEqual(dispatcher.dispatch(), 0)
+
+    def test_aborted_notifications_are_not_sent(self):
+        self.storage.add_notifications([
+            {'user_id': 'user1', 'subject': 'Hello', 'body': 'Hi there'}])
+        self.storage.abort()
+        self.assertEqual(self.make_one().dispatch(), 0)
+        self.assertEqual(self.accounts.send_message.call_count, 0)
+
+    def test_start_and_wake(self):
+        self.add_notifications('user1')
+        dispatcher = self.make_one(poll_interval=60)
+        dispatcher.start()
+        self.addCleanup(dispatcher.stop, 5)
+        for i in range(100):
+            if not self.storage._notifications:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.accounts.send_message.call_count, 1)
+
+        # Messages added later are sent when it is woken.
+        self.add_notifications('user2')
+        dispatcher.wake()
+        for i in range(100):
+            if not self.storage._notifications:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.accounts.send_message.call_count, 2)
+
+
+class EnqueueNotificationTestCase(unittest.TestCase):
+
+    def test_enqueue_notification(self):
+        from .. import storage as storage_pkg
+        from ..storage.memory import MemoryStorage
+        from ..notifications import enqueue_notification
+
+        storage = MemoryStorage()
+        setattr(storage_pkg, 'storage', storage)
+        self.addCleanup(setattr, storage_pkg, 'storage', None)
+        request = testing.DummyRequest()
+        request.add_finished_callback = mock.Mock()
+        with testing.testConfig(request=request) as config:
+            config.registry.notification_dispatcher = dispatcher = mock.Mock()
+            enqueue_notification('user1', 'Hello', 'Hi there')
+
+        (notification,) = storage._notifications.values()
+        self.assertEqual((notification['user_id'], notification['subject'],
+                          notification['body']),
+                         ('user1', 'Hello', 'Hi there'))
+        # The dispatcher is woken once the request has finished.
+        (callback,), _ = request.add_finished_callback.call_args
+        callback(request)
+        dispatcher.wake.assert_called_once_with()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import unittest
+import uuid
+try:
+    from unittest import mock  # python3
+except ImportError:
+    import mock  # python2
+
+from pyramid import testing
+
+
+class PublicationPollerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from ..storage.memory import MemoryStorage
+        self.storage = MemoryStorage()
+        self.config = testing.setUp(settings={
+            'publishing.url': 'http://publishing/',
+            })
+        self.addCleanup(testing.tearDown)
+
+    def make_one(self, **kwargs):
+        from ..publications import PublicationPoller
+        return PublicationPoller(self.storage, self.config.registry, **kwargs)
+
+    def add_document(self, title, publication, state):
+        from ..models import Document
+        document = Document(title, id=uuid.uuid4(), publication=publication,
+                            state=state, submitter={u'id': u'me'})
+        self.storage.add(document)
+        self.storage.persist()
+        return document
+
+    def mock_publishing(self, states):
+        def get(url, **kwargs):
+            publication = url.rsplit('/', 1)[-1]
+            response = mock.Mock(status_code=200)
+            response.content = '{{"state": "{}"}}'.format(
+                states[publication]).encode('utf-8')
+            return response
+        patch = mock.patch('requests.Session.get', side_effect=get)
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+    def test_poll(self):
+        d1 = self.add_document('One', '1', 'Processing')
+        d2 = self.add_document('Two', '1', 'Processing')
+        d3 = self.add_document('Three', '2', 'Waiting for moderation')
+        d4 = self.add_document('Four', '3', 'Done/Success')
+        d5 = self.add_document('Five', None, 'Draft')
+        get = self.mock_publishing({
+            '1': 'Done/Success',
+            '2': 'Waiting for moderation',
+            })
+
+        self.assertEqual(self.make_one(batch_size=1).poll(), 2)
+        # Each publication in progress is requested once.
+        self.assertEqual(sorted([args[0] for args, kwargs
+                                 in get.call_args_list]),
+                         ['http://publishing/publications/1',
+                          'http://publishing/publications/2'])
+        states = {d.id: self.storage.get(id=d.id).metadata['state']
+                  for d in (d1, d2, d3, d4, d5)}
+        self.assertEqual(states, {
+            d1.id: 'Done/Success',
+            d2.id: 'Done/Success',
+            d3.id: 'Waiting for moderation',
+            d4.id: 'Done/Success',
+            d5.id: 'Draft',
+            })
+        # Only the publication still in progress is polled next time.
+        get.reset_mock()
+        self.assertEqual(self.make_one().poll(), 1)
+        self.assertEqual(get.call_count, 1)
+
+    def test_poll_final_states(self):
+        d1 = self.add_document('One', '1', 'Processing')
+        self.add_document('Two', '2', 'Failed/Error')
+        get = self.mock_publishing({'1': 'Done/Success'})
+        from ..publications import get_publication_states
+        get_publication_states(self.config.registry).get('1')
+        get.reset_mock()
+
+        # Failed publications aren't in progress, and publications known
+        # to be done aren't requested again.
+        self.assertEqual(self.make_one().poll(), 1)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(self.storage.get(id=d1.id).metadata['state'],
+                         'Done/Success')
+
+    def test_poll_failure(self):
+        d1 = self.add_document('One', '1', 'Processing')
+        d2 = self.add_document('Two', '2', 'Processing')
+        with mock.patch('requests.Session.get') as get:
+            response = mock.Mock(status_code=200)
+            response.content = b'{"state": "Done/Success"}'
+            get.side_effect = [IOError('down'), response]
+            self.assertEqual(self.make_one().poll(), 2)
+        self.assertEqual(self.storage.get(id=d1.id).metadata['state'],
+                         'Processing')
+        self.assertEqual(self.storage.get(id=d2.id).metadata['state'],
+                         'Done/Success')
+
+
+class PublicationStatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'publishing.url': 'http://publishing/',
+            })
+        self.addCleanup(testing.tearDown)
+
+    def make_one(self, **kwargs):
+        from ..publications import PublicationStates
+        return PublicationStates(self.config.registry, **kwargs)
+
+    def mock_publishing(self, *states):
+        responses = []
+        for state in states:
+            response = mock.Mock(status_code=200)
+            response.content = '{{"state": "{}"}}'.format(
+                state).encode('utf-8')
+            responses.append(response)
+        patch = mock.patch('requests.Session.get', side_effect=responses)
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+    def test_ttl(self):
+        get = self.mock_publishing('Processing', 'Done/Success')
+        states = self.make_one(ttl=5)
+        with mock.patch('time.time', return_value=100.0):
+            self.assertEqual(states.get(1), 'Processing')
+            self.assertEqual(states.get('1'), 'Processing')
+        self.assertEqual(get.call_count, 1)
+        # Final states are cached for good.
+        with mock.patch('time.time', return_value=105.0):
+            self.assertEqual(states.get(1), 'Done/Success')
+        with mock.patch('time.time', return_value=10000.0):
+            self.assertEqual(states.get(1), 'Done/Success')
+        self.assertEqual(get.call_count, 2)
+
+    def test_refresh(self):
+        get = self.mock_publishing('Processing', 'Waiting for moderation')
+        states = self.make_one()
+        self.assertEqual(states.get(1), 'Processing')
+        self.assertEqual(states.refresh(1), 'Waiting for moderation')
+        self.assertEqual(states.get(1), 'Waiting for moderation')
+        self.assertEqual(get.call_count, 2)
+
+    def test_unknown_state_not_cached(self):
+        with mock.patch('requests.Session.get') as get:
+            get.return_value = mock.Mock(status_code=404)
+            states = self.make_one()
+            self.assertEqual(states.get(1), None)
+            self.assertEqual(states.get(1), None)
+        self.assertEqual(get.call_count, 2)
+
+    def test_get_publication_state(self):
+        from ..publications import get_publication_state
+        self.config.registry.settings['publications.state-ttl'] = '60'
+        get = self.mock_publishing('Processing')
+        self.assertEqual(
+            get_publication_state(1, self.config.registry), 'Processing')
+        # The states are shared by the application.
+        self.assertEqual(
+            get_publication_state(1, self.config.registry), 'Processing')
+        self.assertEqual(self.config.registry.publication_states.ttl, 60.0)
+        get.assert_called_once_with('http://publishing/publications/1',
+                                    timeout=mock.ANY)
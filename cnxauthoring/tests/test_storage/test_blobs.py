@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FilesystemBlobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        from ...storage.blobs import FilesystemBlobStore
+        self.blobs = FilesystemBlobStore(self.directory)
+
+    def test_path(self):
+        hash = hashlib.sha1(b'data').hexdigest()
+        self.assertEqual(self.blobs.path(hash),
+                         os.path.join(self.directory, hash[:2], hash[2:4],
+                                      hash))
+
+    def test_path_invalid_hash(self):
+        with self.assertRaises(ValueError):
+            self.blobs.path('../../etc/passwd')
+
+    def test_write_open_and_remove(self):
+        data = b'yada yadda yaadda'
+        hash = hashlib.sha1(data).hexdigest()
+        self.assertFalse(self.blobs.exists(hash))
+
+        path = self.blobs.write(hash, data)
+        self.assertTrue(self.blobs.exists(hash))
+        self.assertEqual(path, self.blobs.path(hash))
+        with self.blobs.open(hash) as f:
+            self.assertEqual(f.read(), data)
+        # Writing the same blob again is a no-op.
+        self.blobs.write(hash, data)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [hash])
+
+        self.blobs.remove(hash)
+        self.assertFalse(self.blobs.exists(hash))
+        # Removing a missing blob is not an error.
+        self.blobs.remove(hash)
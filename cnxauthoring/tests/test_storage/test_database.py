@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2016, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import unittest
+
+from ..testing import integration_test_settings
+
+
+class ParseParamsTests(unittest.TestCase):
+
+    @property
+    def target(self):
+        from ...storage.database import parse_params
+        return parse_params
+
+    def test_named(self):
+        sql = ("UPDATE document SET title = %(title)s, "
+               "cnx_archive_uri = %(cnx-archive-uri)s WHERE id = %(id)s "
+               "AND title != %(title)s")
+        self.assertEqual(self.target(sql), ('title', 'cnx-archive-uri', 'id'))
+
+    def test_positional(self):
+        self.assertEqual(self.target('SELECT * FROM document WHERE %s'), ())
+
+    def test_escaped_percent(self):
+        self.assertEqual(
+            self.target("SELECT 1 WHERE title LIKE 'a%%' AND id = %(id)s"),
+            ('id',))
+
+    def test_mixed(self):
+        with self.assertRaises(ValueError):
+            self.target('SELECT %s, %(id)s')
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            self.target('SELECT %(id)d')
+
+    def test_sql_statements_compiled(self):
+        from ...storage.database import SQL, render_sql, statement_params
+        self.assertEqual(statement_params(SQL['delete-resource']),
+                         ('hash',))
+        self.assertEqual(
+            statement_params(render_sql('get-document', columns='*',
+                                        where_clause='1 = 1')),
+            ('user_id', 'permissions', 'limit'))
+
+
+class MigrateTests(unittest.TestCase):
+
+    def setUp(self):
+        from ...storage.database import CONNECTION_SETTINGS_KEY, initdb
+        settings = integration_test_settings()
+        self.settings = {
+            CONNECTION_SETTINGS_KEY: settings[CONNECTION_SETTINGS_KEY]}
+        initdb(self.settings, clear=True)
+
+    def target(self, **kwargs):
+        from ...storage.database import migrate
+        return migrate(self.settings, **kwargs)
+
+    def _execute(self, sql):
+        import psycopg2
+        from ...storage.database import CONNECTION_SETTINGS_KEY
+        db_connection = psycopg2.connect(
+            self.settings[CONNECTION_SETTINGS_KEY])
+        try:
+            with db_connection:
+                with db_connection.cursor() as cursor:
+                    cursor.execute(sql)
+                    if cursor.description is not None:
+                        return cursor.fetchall()
+        finally:
+            db_connection.close()
+
+    def test_initialized_database(self):
+        self.assertEqual(self.target(), [])
+
+    def test_apply_missing_migrations(self):
+        # Make it look like an old database.
+        self._execute('DROP TABLE schema_migrations;'
+                      'DROP TABLE notification_outbox;'
+                      'DROP INDEX document_submitter_id_idx;'
+                      'DROP INDEX document_contained_in_idx;'
+                      'DROP INDEX document_acl_user_id_permission_idx;'
+                      'DROP INDEX document_search_vector_idx;'
+                      'DROP INDEX document_revised_id_idx;'
+                      'DROP INDEX document_publication_pending_idx;'
+                      'DROP TRIGGER document_search_vector ON document;'
+                      'DROP FUNCTION document_search_vector_update();'
+                      'ALTER TABLE document DROP COLUMN search_vector;'
+                      'ALTER TABLE document '
+                      'DROP COLUMN publishing_fingerprints;'
+                      'ALTER TABLE resource DROP COLUMN size;')
+
+        from ...storage.database import MIGRATIONS
+        self.assertEqual(self.target(),
+                         [version for version, files in MIGRATIONS])
+        indexes = self._execute(
+            "SELECT indexname FROM pg_indexes WHERE indexname IN ("
+            "'document_submitter_id_idx', 'document_contained_in_idx', "
+            "'document_acl_user_id_permission_idx', "
+            "'document_search_vector_idx', 'document_revised_id_idx', "
+            "'document_publication_pending_idx') "
+            "ORDER BY indexname")
+        self.assertEqual([row[0] for row in indexes], [
+            'document_acl_user_id_permission_idx',
+            'document_contained_in_idx',
+            'document_publication_pending_idx',
+            'document_revised_id_idx',
+            'document_search_vector_idx',
+            'document_submitter_id_idx',
+            ])
+
+        # Applied migrations are recorded.
+        self.assertEqual(self.target(), [])
+
+    def test_search_vector_backfill(self):
+        self._execute(
+            "INSERT INTO document (id, title, created, revised, license, "
+            "original_license, language, media_type, submitter) "
+            "SELECT uuid_in(md5(title)::cstring), title, now(), now(), "
+            "'{}', '{}', 'en', 'text/html', '{}' "
+            "FROM unnest(ARRAY['Mitosis', 'Meiosis', 'Osmosis']) AS title;"
+            "DELETE FROM schema_migrations "
+            "WHERE version IN ('0002', '0003');"
+            "DROP INDEX document_search_vector_idx;"
+            "DROP TRIGGER document_search_vector ON document;"
+            "DROP FUNCTION document_search_vector_update();"
+            "ALTER TABLE document DROP COLUMN search_vector;")
+
+        self.assertEqual(self.target(batch_size=2), ['0002', '0003'])
+        rows = self._execute("SELECT title, search_vector::text "
+                             "FROM document ORDER BY title")
+        self.assertEqual(rows, [('Meiosis', "'meiosis':1A"),
+                                ('Mitosis', "'mitosis':1A"),
+                                ('Osmosis', "'osmosis':1A")])
+
+        # A migration stopped during its batches can be applied again.
+        self._execute("DELETE FROM schema_migrations WHERE version = '0002'")
+        self.assertEqual(self.target(batch_size=2), ['0002'])
+
+    def test_resource_size_backfill(self):
+        self._execute(
+            "INSERT INTO resource (hash, mediatype, data) "
+            "SELECT md5(data), 'text/plain', convert_to(data, 'UTF8') "
+            "FROM unnest(ARRAY['a', 'bb', 'ccc']) AS data;"
+            "DELETE FROM schema_migrations WHERE version = '0001';"
+            "ALTER TABLE resource DROP COLUMN size;")
+
+        self.assertEqual(self.target(batch_size=2), ['0001'])
+        rows = self._execute("SELECT size FROM resource ORDER BY size")
+        self.assertEqual([row[0] for row in rows], [1, 2, 3])
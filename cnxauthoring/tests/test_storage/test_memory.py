@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import datetime
+import io
+import threading
+import unittest
+import uuid
+
+from ...models import Document, Resource, Binder
+
+
+SUBMITTER = {
+        u'id': u'me',
+        u'firstname': u'User',
+        u'surname': u'One',
+        }
+
+
+class MemoryStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        from ...storage.memory import MemoryStorage
+        self.storage = MemoryStorage()
+
+    def test_add_get_and_remove_document(self):
+        d = Document('Document Title: One', id=uuid.uuid4(),
+                     content='<p>Document One contents etc</p>',
+                     submitter=SUBMITTER, authors=[SUBMITTER])
+        d.licensor_acceptance = [{'id': 'user1', 'has_accepted': True}]
+        d.acls = {'user1': ('view', 'edit')}
+        d.publishing_fingerprints = {'roles': 'd0c'}
+        self.storage.add(d)
+        self.storage.persist()
+
+        result = self.storage.get(id=d.id)
+        self.assertEqual(result.to_dict(), d.to_dict())
+        self.assertEqual(result.content, d.content)
+        self.assertEqual(result.licensor_acceptance,
+                         [{'id': 'user1', 'has_accepted': True}])
+        self.assertEqual(sorted(result.acls['user1']), ['edit', 'view'])
+        self.assertEqual(result.publishing_fingerprints, {'roles': 'd0c'})
+
+        # The stored document isn't changed by changing the model.
+        result.metadata['authors'].append({u'id': u'you'})
+        self.assertEqual(self.storage.get(id=d.id).metadata['authors'],
+                         [SUBMITTER])
+
+        self.assertEqual(self.storage.get(id='not-a-uuid'), None)
+        self.assertEqual(self.storage.get(id=d.id, state='not:Draft'), None)
+        self.assertEqual(self.storage.get(id=d.id, submitter={'id': 'you'}),
+                         None)
+        self.assertEqual(self.storage.get(submitter={'id': 'me'}).id, d.id)
+
+        self.storage.remove(d)
+        self.storage.persist()
+        self.assertEqual(self.storage.get(id=d.id), None)
+
+    def test_add_get_and_remove_resource(self):
+        data = b'yada yadda yaadda'
+        resource = Resource('text/plain', io.BytesIO(data))
+        self.storage.add(resource)
+        self.storage.persist()
+
+        result = self.storage.get(type_=Resource, hash=resource.hash)
+        self.assertEqual(result.media_type, 'text/plain')
+        self.assertEqual(result.size, len(data))
+        with result.stream() as f:
+            self.assertEqual(f.read(), data)
+
+        self.storage.remove(result)
+        self.storage.persist()
+        self.assertEqual(
+            self.storage.get(type_=Resource, hash=resource.hash), None)
+
+    def test_binder_containment_and_acls(self):
+        d1 = Document('Page in a book', id=uuid.uuid4(), submitter=SUBMITTER)
+        d1.acls = {'user1': ('view',)}
+        d2 = Document('Page', id=uuid.uuid4(), submitter=SUBMITTER)
+        d2.acls = {'user1': ('view',)}
+        b = Binder('Book', {'contents': [{'id': d1.id}]}, id=uuid.uuid4(),
+                   submitter=SUBMITTER)
+        b.acls = {'user1': ('view',), 'user2': ('view', 'edit')}
+        d1.metadata['contained_in'] = [b.id]
+        self.storage.add([d1, d2, b])
+        self.storage.persist()
+
+        results = self.storage.get_all(contained_in=b.id)
+        self.assertEqual([r.id for r in results], [d1.id])
+        results = self.storage.get_all(contained_in='not:{}'.format(b.id))
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d2.id, b.id]))
+
+        # The permissions on the binder apply to the documents in it.
+        self.assertEqual(sorted(self.storage.get(id=d1.id).acls['user2']),
+                         ['edit', 'view'])
+
+        results = self.storage.get_all(user_id='user1', permissions=('view',),
+                                       exclude_contained=True)
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d2.id, b.id]))
+        results = self.storage.get_all(user_id='user2', permissions=('view',),
+                                       summary=True)
+        self.assertEqual([r.id for r in results], [b.id])
+
+        # Updating the binder updates the index.
+        d1.metadata['contained_in'] = []
+        self.storage.update(d1)
+        self.storage.persist()
+        self.assertEqual(list(self.storage.get_all(contained_in=b.id)), [])
+
+    def test_update_containment(self):
+        d1 = Document('Page One', id=uuid.uuid4(), submitter=SUBMITTER)
+        d2 = Document('Page Two', id=uuid.uuid4(), submitter=SUBMITTER)
+        d3 = Document('Removed page', id=uuid.uuid4(), submitter=SUBMITTER)
+        b = Binder('Book', {'contents': []}, id=uuid.uuid4(),
+                   submitter=SUBMITTER)
+        b.acls = {'user1': ('view',)}
+        d2.metadata['contained_in'] = ['other-binder']
+        d3.metadata['contained_in'] = [b.id]
+        self.storage.add([d1, d2, d3, b])
+        self.storage.persist()
+
+        self.storage.update_containment(b.id, [d1.id, d2.id])
+        self.storage.persist()
+        results = self.storage.get_all(contained_in=b.id)
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d1.id, d2.id]))
+        self.assertEqual(self.storage.get(id=d2.id).metadata['contained_in'],
+                         ['other-binder', b.id])
+        self.assertEqual(self.storage.get(id=d3.id).metadata['contained_in'],
+                         [])
+        # The documents in the binder have its permissions.
+        self.assertEqual(self.storage.get(id=d1.id).acls,
+                         {'user1': ('view',)})
+        self.storage.persist()
+
+        self.storage.update_containment(b.id, [])
+        self.storage.persist()
+        self.assertEqual(list(self.storage.get_all(contained_in=b.id)), [])
+
+    def test_update_document_state(self):
+        from ...utils import TZINFO
+        d1 = Document('Published', id=uuid.uuid4(), submitter=SUBMITTER,
+                      publication='1', state='Processing')
+        d2 = Document('Failed', id=uuid.uuid4(), submitter=SUBMITTER,
+                      publication='2', state='Failed/Error')
+        self.storage.add([d1, d2])
+        self.storage.persist()
+        self.assertEqual(
+            [str(p['id']) for p in self.storage.get_pending_publications()],
+            [str(d1.id)])
+
+        d1.update(title=u'Changed meanwhile')
+        self.storage.update(d1)
+        self.storage.persist()
+        revised = datetime.datetime(2016, 5, 4, 3, 2, 1, tzinfo=TZINFO)
+        self.assertTrue(self.storage.update_document_state(
+            d1.id, '1', 'Done/Success', revised))
+        # Not once it has the state or is in another publication.
+        self.assertFalse(self.storage.update_document_state(
+            d1.id, '1', 'Done/Success', revised))
+        self.assertFalse(self.storage.update_document_state(
+            d2.id, '3', 'Done/Success', revised))
+        self.storage.persist()
+
+        result = self.storage.get(id=d1.id)
+        self.assertEqual(result.metadata['state'], 'Done/Success')
+        self.assertEqual(result.metadata['revised'], revised)
+        self.assertEqual(result.metadata['title'], u'Changed meanwhile')
+        self.assertEqual(self.storage.get(id=d2.id).metadata['state'],
+                         'Failed/Error')
+        self.assertEqual(self.storage.get_pending_publications(), [])
+
+    def test_get_all_pages(self):
+        revised = datetime.datetime(2014, 3, 13, 15, 21, 15, 677617)
+        docs = []
+        for i in range(5):
+            d = Document('Document {}'.format(i), id=uuid.uuid4(),
+                         revised=revised + datetime.timedelta(i // 2),
+                         submitter=SUBMITTER)
+            d.acls = {'user1': ('view',)}
+            docs.append(d)
+        self.storage.add(docs)
+        self.storage.persist()
+        expected = [d.id for d in sorted(
+            docs, key=lambda d: (d.metadata['revised'], uuid.UUID(d.id)),
+            reverse=True)]
+
+        ids = []
+        after = None
+        while True:
+            page = list(self.storage.get_all(
+                user_id='user1', permissions=('view',), limit=2,
+                after=after))
+            if not page:
+                break
+            ids.extend([d.id for d in page])
+            after = (page[-1].metadata['revised'].isoformat(), page[-1].id)
+        self.assertEqual(ids, expected)
+
+    def test_abort(self):
+        d1 = Document('Kept', id=uuid.uuid4(), submitter=SUBMITTER)
+        self.storage.add(d1)
+        self.storage.persist()
+
+        d1.update(title='Changed')
+        self.storage.update(d1)
+        d2 = Document('Discarded', id=uuid.uuid4(), submitter=SUBMITTER)
+        self.storage.add(d2)
+        self.storage.abort()
+
+        self.assertEqual(self.storage.get(id=d1.id).metadata['title'], 'Kept')
+        self.assertEqual(self.storage.get(id=d2.id), None)
+
+    def test_abort_is_per_thread(self):
+        d = Document('Other thread', id=uuid.uuid4(), submitter=SUBMITTER)
+        thread = threading.Thread(target=self.storage.add, args=(d,))
+        thread.start()
+        thread.join()
+        self.storage.abort()
+        self.assertEqual(self.storage.get(id=d.id).id, d.id)
+
+    def test_search(self):
+        d1 = Document('Physics', id=uuid.uuid4(), submitter=SUBMITTER,
+                      content='<p>Some content about chemistry</p>')
+        d2 = Document('Chemistry', id=uuid.uuid4(), submitter=SUBMITTER,
+                      content='<p>The <em>physics</em> of it</p>')
+        d3 = Document('Chemistry', id=uuid.uuid4(),
+                      submitter={u'id': u'you'})
+        self.storage.add([d1, d2, d3])
+        self.storage.persist()
+
+        results = self.storage.search([('text', 'chemistry')],
+                                      submitter_id='me')
+        self.assertEqual([r.id for r in results], [d2.id, d1.id])
+        results = self.storage.search([('text', 'physics of')])
+        self.assertEqual([r.id for r in results], [d2.id])
+        results = self.storage.search([('text', 'em')])
+        self.assertEqual(list(results), [])
+        # Words are matched by their beginning.
+        results = self.storage.search([('text', 'phys')], submitter_id='me')
+        self.assertEqual([r.id for r in results], [d1.id, d2.id])
+        results = self.storage.search([('text', 'hysics')])
+        self.assertEqual(list(results), [])
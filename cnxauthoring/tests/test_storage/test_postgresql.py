@@ -8,6 +8,10 @@
 import io
 import unittest
 import uuid
+try:
+    from unittest import mock  # python3
+except ImportError:
+    import mock  # python2
 
 from .. import test_data
 from ...models import Document, Resource, Binder
@@ -62,6 +66,7 @@ class PostgresqlStorageTests(unittest.TestCase):
         d.licensor_acceptance = [{'id': 'user1', 'has_accepted': True}]
         d.acls = {'user1': ('view', 'edit', 'publish'),
                   'user2': ('view',)}
+        d.publishing_fingerprints = {'roles': 'd0c'}
 
         self.storage.add(d)
         self.storage.persist()
@@ -70,6 +75,7 @@ class PostgresqlStorageTests(unittest.TestCase):
         self.assertEqual(result.to_dict(), d.to_dict())
         self.assertEqual(result.licensor_acceptance,
                          [{'id': 'user1', 'has_accepted': True}])
+        self.assertEqual(result.publishing_fingerprints, {'roles': 'd0c'})
         self.assertEqual({k: tuple(sorted(v)) for k, v in result.acls.items()},
                          {'user1': ('edit', 'publish', 'view'),
                           'user2': ('view',)})
@@ -91,6 +97,44 @@ class PostgresqlStorageTests(unittest.TestCase):
         result = self.storage.get(id=d2_id)
         self.assertEqual(result.to_dict(), d2.to_dict())
 
+    def test_search_ranked(self):
+        d1 = Document('Cell division', id=uuid.uuid4(),
+                      content=u'<p>All about <em>mitosis</em>.</p>',
+                      submitter=SUBMITTER)
+        d2 = Document('Mitosis', id=uuid.uuid4(), submitter=SUBMITTER)
+        d3 = Document('Photosynthesis', id=uuid.uuid4(),
+                      abstract=u'Light reactions', submitter=SUBMITTER)
+        self.storage.add([d1, d2, d3])
+        self.storage.persist()
+
+        # Title matches rank above content matches.
+        results = list(self.storage.search([('text', 'mitosis')]))
+        self.assertEqual([doc.id for doc in results], [d2.id, d1.id])
+
+        # The markup isn't searchable.
+        self.assertEqual(list(self.storage.search([('text', 'em')])), [])
+
+        # Words are matched by their beginning.
+        results = list(self.storage.search([('text', 'MITO')]))
+        self.assertEqual([doc.id for doc in results], [d2.id, d1.id])
+        results = list(self.storage.search([('text', 'photo light')]))
+        self.assertEqual([doc.id for doc in results], [d3.id])
+        self.assertEqual(list(self.storage.search([('text', 'tosis')])), [])
+
+        # Any of the terms match.
+        results = self.storage.search([('text', 'light reactions'),
+                                       ('text', 'cell')])
+        self.assertEqual(sorted([doc.id for doc in results]),
+                         sorted([d1.id, d3.id]))
+
+        # The search is kept up to date when documents are updated.
+        d3.update(title=u'Mitosis and Photosynthesis')
+        self.storage.update(d3)
+        self.storage.persist()
+        results = list(self.storage.search([('text', 'mitosis')]))
+        self.assertEqual(sorted([doc.id for doc in results]),
+                         sorted([d1.id, d2.id, d3.id]))
+
     def test_add_get_and_remove_binder(self):
         d1_id = uuid.uuid4()
         d = Document('Document Title: One', id=d1_id, submitter=SUBMITTER)
@@ -129,6 +173,128 @@ class PostgresqlStorageTests(unittest.TestCase):
         result = self.storage.get(type_=Resource, hash=r.hash)
         self.assertEqual(result, None)
 
+    def test_read_resource_in_chunks(self):
+        with open(test_data('1x1.png'), 'rb') as f:
+            data = f.read()
+        r = Resource('image/png', io.BytesIO(data))
+        self.storage.add(r)
+        self.storage.persist()
+
+        self.storage.resource_chunk_size = 10
+        result = self.storage.get(type_=Resource, hash=r.hash)
+        self.assertEqual(result.size, len(data))
+        # The data is not retrieved with the resource.
+        self.assertEqual(result._loaded_data, None)
+
+        reads = []
+        read_chunk = self.storage._read_resource_chunk
+
+        def record_read(hash, offset, length, conn):
+            reads.append((offset, length))
+            return read_chunk(hash, offset, length, conn)
+        self.storage._read_resource_chunk = record_read
+
+        # Read after the connection was given back (e.g. by a response
+        # app_iter).
+        self.storage.persist()
+        pool = self.storage.pool
+        with mock.patch.object(pool, 'getconn',
+                               wraps=pool.getconn) as getconn, \
+                mock.patch.object(pool, 'putconn',
+                                  wraps=pool.putconn) as putconn:
+            f = result.stream()
+            chunks = list(iter(lambda: f.read(10), b''))
+            f.close()
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(length <= 10 for offset, length in reads))
+        self.assertEqual(reads[0], (0, 10))
+        # A connection is borrowed for all the reads.
+        self.assertEqual((getconn.call_count, putconn.call_count), (1, 1))
+
+        with result.open() as f:
+            self.assertEqual(f.read(), data)
+
+    def test_read_missing_resource_data(self):
+        r = Resource('text/plain', io.BytesIO(b'data'))
+        self.storage.add(r)
+        self.storage.persist()
+        result = self.storage.get(type_=Resource, hash=r.hash)
+
+        f = result.stream()
+        cursor = self.storage.conn.cursor()
+        cursor.execute('DELETE FROM resource WHERE hash = %s', (r.hash,))
+        cursor.close()
+        self.storage.persist()
+        with self.assertRaises(IOError):
+            f.read()
+        f.close()
+
+    def test_add_get_and_remove_resource_on_filesystem(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        from ...storage.blobs import FilesystemBlobStore
+        self.storage.blobs = FilesystemBlobStore(directory)
+
+        with open(test_data('1x1.png'), 'rb') as f:
+            data = f.read()
+        r = Resource('image/png', io.BytesIO(data))
+        self.storage.add(r)
+        self.storage.persist()
+        self.assertTrue(self.storage.blobs.exists(r.hash))
+
+        cursor = self.storage.conn.cursor()
+        cursor.execute('SELECT size, data FROM resource WHERE hash = %s',
+                       (r.hash,))
+        self.assertEqual(cursor.fetchone(), (len(data), None))
+
+        result = self.storage.get(type_=Resource, hash=r.hash)
+        self.assertEqual(result.hash, r.hash)
+        self.assertEqual(result.path, self.storage.blobs.path(r.hash))
+        with result.open() as f:
+            self.assertEqual(f.read(), data)
+
+        self.storage.remove(r)
+        self.storage.persist()
+        self.assertEqual(self.storage.get(type_=Resource, hash=r.hash), None)
+        self.assertFalse(self.storage.blobs.exists(r.hash))
+
+    def test_blobs_of_aborted_changes(self):
+        import shutil
+        import tempfile
+        import threading
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        from ...storage.blobs import FilesystemBlobStore
+        self.storage.blobs = FilesystemBlobStore(directory)
+        with open(test_data('1x1.png'), 'rb') as f:
+            data = f.read()
+
+        # The blobs written for aborted changes are removed.
+        r = Resource('image/png', io.BytesIO(data))
+        self.storage.add(r)
+        self.assertTrue(self.storage.blobs.exists(r.hash))
+        self.storage.abort()
+        self.assertFalse(self.storage.blobs.exists(r.hash))
+
+        # Not those of stored resources.
+        self.storage.add(r)
+        self.storage.persist()
+        self.storage.add(Resource('image/png', io.BytesIO(data)))
+        self.storage.abort()
+        self.assertTrue(self.storage.blobs.exists(r.hash))
+
+        # Nor those another transaction in progress is adding.
+        thread = threading.Thread(target=self.storage._adding_blob,
+                                  args=(r.hash,))
+        thread.start()
+        thread.join()
+        self.storage.remove(r)
+        self.storage.persist()
+        self.assertEqual(self.storage.get(type_=Resource, hash=r.hash), None)
+        self.assertTrue(self.storage.blobs.exists(r.hash))
+
     def test_get_and_remove_document(self):
         d1_id = uuid.uuid4()
         result = self.storage.get(id=d1_id)
@@ -381,6 +547,503 @@ class PostgresqlStorageTests(unittest.TestCase):
         self.assertEqual({k: tuple(sorted(v)) for k, v in result.acls.items()},
                          {'user2': ('view',)})
 
+    def test_notifications(self):
+        import datetime
+        from ...utils import TZINFO
+        from ...storage.postgresql import PostgresqlStorage
+
+        self.storage.add_notifications([
+            {'user_id': 'user1', 'subject': 'Hello', 'body': 'Hi there'},
+            {'user_id': 'user2', 'subject': 'Hello', 'body': 'Hi there'},
+            ])
+        self.storage.persist()
+
+        notifications = self.storage.get_notifications(10, 3)
+        self.assertEqual([(n['user_id'], n['attempts'])
+                          for n in notifications],
+                         [('user1', 0), ('user2', 0)])
+        # They are locked until the changes are persisted.
+        other = PostgresqlStorage(
+            db_connection_string=self.storage.db_connection_string)
+        self.addCleanup(other.abort)
+        cursor = other.conn.cursor()
+        cursor.execute('SET lock_timeout = 100')
+        with self.assertRaises(other.Error):
+            other.get_notifications(10, 3)
+        other.abort()
+
+        later = datetime.datetime.now(TZINFO) + datetime.timedelta(hours=1)
+        self.storage.remove_notifications([notifications[0]['id']])
+        self.storage.reschedule_notification(notifications[1]['id'],
+                                             later, 'down')
+        self.storage.persist()
+
+        # The rescheduled notification isn't due yet.
+        self.assertEqual(self.storage.get_notifications(10, 3), [])
+        cursor = self.storage.conn.cursor()
+        cursor.execute('SELECT user_id, attempts, last_error '
+                       'FROM notification_outbox')
+        self.assertEqual(cursor.fetchall(), [('user2', 1, 'down')])
+        self.storage.persist()
+
+    def test_update_containment(self):
+        d1 = Document('Page One', id=uuid.uuid4(), submitter=SUBMITTER)
+        d2 = Document('Page Two', id=uuid.uuid4(), submitter=SUBMITTER)
+        d3 = Document('Removed page', id=uuid.uuid4(), submitter=SUBMITTER)
+        b = Binder('Book', {'contents': []}, id=uuid.uuid4(),
+                   submitter=SUBMITTER)
+        b.acls = {'user1': ('view',)}
+        d2.metadata['contained_in'] = ['other-binder']
+        d3.metadata['contained_in'] = [b.id]
+        self.storage.add([d1, d2, d3, b])
+        self.storage.persist()
+
+        self.storage.update_containment(b.id, [d1.id, d2.id])
+        self.storage.persist()
+        results = self.storage.get_all(contained_in=b.id)
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d1.id, d2.id]))
+        self.assertEqual(self.storage.get(id=d2.id).metadata['contained_in'],
+                         ['other-binder', b.id])
+        self.assertEqual(self.storage.get(id=d3.id).metadata['contained_in'],
+                         [])
+        # The documents in the binder have its permissions.
+        self.assertEqual(self.storage.get(id=d1.id).acls,
+                         {'user1': ('view',)})
+        self.storage.persist()
+
+        self.storage.update_containment(b.id, [])
+        self.storage.persist()
+        self.assertEqual(list(self.storage.get_all(contained_in=b.id)), [])
+
+    def test_connection_per_thread(self):
+        import threading
+        conn = self.storage.conn
+        self.assertIs(self.storage.conn, conn)
+
+        other_conns = []
+        thread = threading.Thread(
+            target=lambda: other_conns.append(self.storage.conn))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_conns[0], conn)
+
+        # Persisting hands the connection back to the pool.
+        self.storage.persist()
+        self.assertEqual(self.storage._local.conn, None)
+
+    def test_read_from_replica(self):
+        import time
+        from ...storage.database import CONNECTION_SETTINGS_KEY
+        from ...storage.postgresql import PostgresqlStorage
+        test_db = integration_test_settings()[CONNECTION_SETTINGS_KEY]
+        # The test database stands in for a replica of itself.
+        storage = PostgresqlStorage(db_connection_string=test_db,
+                                    replica_connection_strings=test_db)
+        self.assertTrue(storage.has_replicas)
+        d = Document('Document', id=uuid.uuid4(), submitter=SUBMITTER)
+        storage.add(d)
+        storage.persist()
+
+        storage.read_from_replica()
+        self.assertEqual(storage.get(id=d.id).id, d.id)
+        self.assertNotEqual(storage._local.replica_conn, None)
+        self.assertEqual(storage._local.conn, None)
+
+        # Reads go to the primary once something is written.
+        storage.update(d)
+        self.assertIs(storage.read_conn, storage.conn)
+        storage.persist()
+        self.assertEqual(storage._local.replica_conn, None)
+
+        # and right after the user's writes.
+        storage.read_from_replica(last_write=time.time())
+        self.assertIs(storage.read_conn, storage.conn)
+        storage.persist()
+
+    def test_identity_map(self):
+        d = Document('Document', id=uuid.uuid4(), submitter=SUBMITTER)
+        d.acls = {'user1': ('view',)}
+        self.storage.add(d)
+        self.storage.persist()
+
+        result = self.storage.get(id=d.id)
+        self.assertIsNot(result, d)
+        # The document is retrieved once in a request.
+        self.assertIs(self.storage.get(id=d.id), result)
+        self.assertIs(self.storage.get(id=d.id.upper()), result)
+        results = list(self.storage.get_all(user_id='user1',
+                                            permissions=('view',)))
+        self.assertIs(results[0], result)
+
+        # and again after it changed or the request ended.
+        self.storage.update(result)
+        updated = self.storage.get(id=d.id)
+        self.assertIsNot(updated, result)
+        self.storage.persist()
+        self.assertIsNot(self.storage.get(id=d.id), updated)
+
+        self.storage.remove(d)
+        self.assertEqual(self.storage.get(id=d.id), None)
+
+    def test_document_cache(self):
+        d = Document('Document', id=uuid.uuid4(), submitter=SUBMITTER)
+        d.acls = {'user1': ('view',)}
+        self.storage.add(d)
+        self.storage.persist()
+
+        reassembled = []
+        reassemble = self.storage._reassemble_models
+        self.storage._reassemble_models = lambda *args: reassembled.append(
+            args[0]) or reassemble(*args)
+        self.addCleanup(delattr, self.storage, '_reassemble_models')
+
+        self.assertEqual(self.storage.get(id=d.id).metadata['title'],
+                         'Document')
+        self.storage.persist()
+        self.assertEqual(len(reassembled), 1)
+        # The unchanged document is not retrieved again.
+        result = self.storage.get(id=d.id)
+        self.storage.persist()
+        self.assertEqual(len(reassembled), 1)
+        self.assertEqual(result.metadata['title'], 'Document')
+        self.assertEqual(result.acls, {'user1': ('view',)})
+        # Changes to the model don't change the cached document.
+        result.metadata['authors'].append(SUBMITTER)
+        self.assertEqual(self.storage.get(id=d.id).metadata['authors'], [])
+        self.storage.persist()
+
+        # Any change to the document, even without changing revised,
+        # or to its ACL gives a new version.
+        cursor = self.storage.conn.cursor()
+        cursor.execute("UPDATE document SET title = 'Changed'")
+        cursor.execute("INSERT INTO document_acl VALUES (%s, 'user2', 'view')",
+                       (d.id,))
+        self.storage.persist()
+        result = self.storage.get(id=d.id)
+        self.assertEqual(result.metadata['title'], 'Changed')
+        self.assertEqual(sorted(result.acls), ['user1', 'user2'])
+        self.assertEqual(len(reassembled), 2)
+        self.storage.persist()
+
+    def test_get_all_attaches_acls_and_licensors(self):
+        d1 = Document('Document One', id=uuid.uuid4(), submitter=SUBMITTER)
+        d1.acls = {'user1': ('view', 'edit')}
+        d1.licensor_acceptance = [{'id': 'user1', 'has_accepted': True}]
+        d2 = Document('Document Two', id=uuid.uuid4(), submitter=SUBMITTER)
+        d2.acls = {'user2': ('view',)}
+        d2.licensor_acceptance = [{'id': 'user2', 'has_accepted': None}]
+        self.storage.add(d1)
+        self.storage.add(d2)
+        b = Binder('Book', {'contents': []}, id=uuid.uuid4(),
+                   submitter=SUBMITTER)
+        b.acls = {'user3': ('view',)}
+        self.storage.add(b)
+        d2.metadata['contained_in'] = [str(b.id)]
+        self.storage.update(d2)
+        self.storage.persist()
+
+        results = {doc.id: doc
+                   for doc in self.storage.get_all(submitter={'id': 'me'})}
+        self.assertEqual(sorted(results.keys()),
+                         sorted([d1.id, d2.id, b.id]))
+        self.assertEqual(
+            {k: tuple(sorted(v)) for k, v in results[d1.id].acls.items()},
+            {'user1': ('edit', 'view')})
+        self.assertEqual(
+            {k: tuple(sorted(v)) for k, v in results[d2.id].acls.items()},
+            {'user2': ('view',), 'user3': ('view',)})
+        self.assertEqual(results[d1.id].licensor_acceptance,
+                         [{'id': 'user1', 'has_accepted': True}])
+        self.assertEqual(results[d2.id].licensor_acceptance,
+                         [{'id': 'user2', 'has_accepted': None}])
+
+    def test_get_all_stream(self):
+        self.storage.itersize = 2
+        ids = []
+        for i in range(5):
+            d = Document('Document {}'.format(i), id=uuid.uuid4(),
+                         submitter=SUBMITTER)
+            d.acls = {'user1': ('view',)}
+            self.storage.add(d)
+            ids.append(d.id)
+        self.storage.persist()
+
+        results = list(self.storage.get_all(submitter={'id': 'me'},
+                                            stream=True))
+        self.assertEqual(sorted([r.id for r in results]), sorted(ids))
+        for result in results:
+            self.assertEqual(result.acls, {'user1': ('view',)})
+
+    def test_get_all_stream_keeps_changes(self):
+        self.storage.itersize = 1
+        ids = []
+        for i in range(2):
+            d = Document('Document {}'.format(i), id=uuid.uuid4(),
+                         submitter=SUBMITTER)
+            self.storage.add(d)
+            ids.append(d.id)
+        self.storage.persist()
+
+        # Changes made while streaming are kept once all is read.
+        for result in self.storage.get_all(submitter={'id': 'me'},
+                                           stream=True):
+            result.update(title='Changed')
+            self.storage.update(result)
+        self.storage.persist()
+        self.assertEqual([self.storage.get(id=id).metadata['title']
+                          for id in ids], ['Changed', 'Changed'])
+
+    def test_get_all_pages(self):
+        import datetime
+        revised = datetime.datetime(2014, 3, 13, 15, 21, 15, 677617)
+        docs = []
+        for i in range(5):
+            # Two documents with the same revised date.
+            d = Document('Document {}'.format(i), id=uuid.uuid4(),
+                         revised=revised + datetime.timedelta(i // 2),
+                         submitter=SUBMITTER)
+            d.acls = {'user1': ('view',)}
+            docs.append(d)
+        self.storage.add(docs)
+        self.storage.persist()
+        expected = [d.id for d in sorted(
+            docs, key=lambda d: (d.metadata['revised'], uuid.UUID(d.id)),
+            reverse=True)]
+
+        ids = []
+        after = None
+        while True:
+            page = list(self.storage.get_all(
+                user_id='user1', permissions=('view',), limit=2,
+                after=after))
+            if not page:
+                break
+            self.assertTrue(len(page) <= 2)
+            ids.extend([d.id for d in page])
+            after = (page[-1].metadata['revised'].isoformat(), page[-1].id)
+        self.assertEqual(ids, expected)
+
+    def test_get_all_exclude_contained(self):
+        d1 = Document('Page in a book', id=uuid.uuid4(), submitter=SUBMITTER)
+        d1.acls = {'user1': ('view',)}
+        d2 = Document('Page in a book by someone else', id=uuid.uuid4(),
+                      submitter=SUBMITTER)
+        d2.acls = {'user1': ('view',)}
+        b1 = Binder('Book', {'contents': [{'id': d1.id}]}, id=uuid.uuid4(),
+                    submitter=SUBMITTER)
+        b1.acls = {'user1': ('view',)}
+        b2 = Binder('Other book', {'contents': [{'id': d2.id}]},
+                    id=uuid.uuid4(), submitter=SUBMITTER)
+        b2.acls = {'user2': ('view',)}
+        d1.metadata['contained_in'] = [b1.id]
+        d2.metadata['contained_in'] = [b2.id]
+        self.storage.add([d1, d2, b1, b2])
+        self.storage.persist()
+
+        results = self.storage.get_all(
+            user_id='user1', permissions=('view',), exclude_contained=True)
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d2.id, b1.id]))
+        # Unless the binder isn't retrieved.
+        results = self.storage.get_all(
+            user_id='user1', permissions=('view',), exclude_contained=True,
+            media_type=d1.mediatype)
+        self.assertEqual(sorted([r.id for r in results]),
+                         sorted([d1.id, d2.id]))
+
+    def test_get_all_summary(self):
+        d = Document('Document', id=uuid.uuid4(), content=u'<p>Text</p>',
+                     submitter=SUBMITTER,
+                     authors=[{'id': 'user1', 'has_accepted': True}])
+        d.acls = {'user1': ('view',)}
+        self.storage.add(d)
+        self.storage.persist()
+
+        from ...models import ContentSummary
+        results = list(self.storage.get_all(
+            user_id='user1', permissions=('view',), summary=True))
+        self.assertEqual(len(results), 1)
+        summary = results[0]
+        self.assertTrue(isinstance(summary, ContentSummary))
+        self.assertEqual(summary.id, d.id)
+        self.assertEqual(sorted(summary.metadata.keys()),
+                         sorted(ContentSummary.fields))
+        self.assertNotIn('content', summary.metadata)
+        for field in ContentSummary.fields[1:]:
+            self.assertEqual(summary.metadata[field], d.metadata[field])
+
+    def test_add_update_and_remove_multiple(self):
+        docs = []
+        for i in range(3):
+            d = Document('Document {}'.format(i), id=uuid.uuid4(),
+                         submitter=SUBMITTER)
+            d.acls = {'user1': ('view', 'edit')}
+            d.licensor_acceptance = [{'id': 'user1', 'has_accepted': True}]
+            docs.append(d)
+        self.storage.add(docs)
+        self.storage.persist()
+
+        for d in docs:
+            result = self.storage.get(id=d.id)
+            self.assertEqual(result.to_dict(), d.to_dict())
+            self.assertEqual(
+                {k: tuple(sorted(v)) for k, v in result.acls.items()},
+                {'user1': ('edit', 'view')})
+            self.assertEqual(result.licensor_acceptance,
+                             [{'id': 'user1', 'has_accepted': True}])
+
+        for d in docs:
+            d.update(title='Changed {}'.format(d.metadata['title']))
+            d.acls = {'user2': ('view',)}
+            d.licensor_acceptance = []
+        self.storage.update(docs)
+        self.storage.persist()
+
+        for d in docs:
+            result = self.storage.get(id=d.id)
+            self.assertEqual(result.to_dict(), d.to_dict())
+            self.assertEqual(result.acls, {'user2': ('view',)})
+            self.assertEqual(result.licensor_acceptance, [])
+
+        self.storage.remove(docs[:2])
+        self.storage.persist()
+        self.assertEqual(self.storage.get(id=docs[0].id), None)
+        self.assertEqual(self.storage.get(id=docs[1].id), None)
+        self.assertEqual(self.storage.get(id=docs[2].id).id, docs[2].id)
+
+    def test_prepared_statements(self):
+        d = Document('Document One', id=uuid.uuid4(), submitter=SUBMITTER)
+        self.storage.add(d)
+        self.storage.persist()
+
+        self.assertEqual(self.storage.get(id=d.id).id, d.id)
+        self.assertEqual(self.storage.get(id=d.id).id, d.id)
+        cursor = self.storage.conn.cursor()
+        cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+        prepared_count = cursor.fetchone()[0]
+        self.assertTrue(prepared_count > 0)
+
+        # Reusing the statements doesn't prepare them again.
+        self.assertEqual(self.storage.get(id=d.id).id, d.id)
+        cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+        self.assertEqual(cursor.fetchone()[0], prepared_count)
+
+    def test_prepared_statements_with_percent(self):
+        from ...storage.postgresql import checked_execute, prepared_execute
+        sql = "SELECT %(word)s LIKE 'ab%%', '100%%'"
+        cursor = self.storage.conn.cursor()
+        checked_execute(cursor, sql, {'word': 'abc'})
+        self.assertEqual(cursor.fetchone(), (True, '100%'))
+        # Prepared, the literal percent signs are the same.
+        prepared_execute(cursor, sql, {'word': 'abc'})
+        self.assertEqual(cursor.fetchone(), (True, '100%'))
+        prepared_execute(cursor, sql, {'word': 'xyz'})
+        self.assertEqual(cursor.fetchone(), (False, '100%'))
+
+    def test_prepared_statements_after_adding_a_column(self):
+        d = Document('Document One', id=uuid.uuid4(), submitter=SUBMITTER)
+        d.acls = {'me': ('view',)}
+        self.storage.add(d)
+        self.storage.persist()
+        self.storage.document_cache = None
+
+        def read():
+            ids = [
+                self.storage.get(id=d.id).id,
+                [r.id for r in self.storage.get_all(
+                    user_id='me', permissions=('view',))][0],
+                [r.id for r in self.storage.search(
+                    [('text', 'Document')])][0],
+                ]
+            self.storage.persist()
+            return ids
+
+        self.assertEqual(read(), [d.id] * 3)
+        # A migration adds a column once the statements are prepared.
+        with self.storage.conn.cursor() as cursor:
+            cursor.execute('ALTER TABLE document ADD COLUMN extra text')
+        self.storage.persist()
+        self.assertEqual(read(), [d.id] * 3)
+
+    def test_update_writes_acl_differences(self):
+        d = Document('Document One', id=uuid.uuid4(), submitter=SUBMITTER)
+        d.acls = {'user1': ('view', 'edit'), 'user2': ('view',)}
+        d.licensor_acceptance = [{'id': 'user1', 'has_accepted': True},
+                                 {'id': 'user2', 'has_accepted': None}]
+        self.storage.add(d)
+        self.storage.persist()
+
+        def row_versions():
+            cursor = self.storage.conn.cursor()
+            cursor.execute("""\
+SELECT user_id, permission, xmin::text FROM document_acl
+  WHERE uuid = %s
+UNION ALL
+SELECT user_id, has_accepted::text, xmin::text
+  FROM document_licensor_acceptance WHERE uuid = %s""", (d.id, d.id,))
+            return sorted(cursor.fetchall())
+
+        # An unchanged ACL is not rewritten.
+        before = row_versions()
+        self.storage.update(d)
+        self.storage.persist()
+        self.assertEqual(row_versions(), before)
+
+        d.acls = {'user1': ('view', 'edit', 'publish'), 'user3': ('view',)}
+        d.licensor_acceptance = [{'id': 'user1', 'has_accepted': True},
+                                 {'id': 'user3', 'has_accepted': False}]
+        self.storage.update(d)
+        self.storage.persist()
+
+        result = self.storage.get(id=d.id)
+        self.assertEqual(
+            {k: tuple(sorted(v)) for k, v in result.acls.items()},
+            {'user1': ('edit', 'publish', 'view'), 'user3': ('view',)})
+        self.assertEqual(
+            sorted(result.licensor_acceptance, key=lambda x: x['id']),
+            [{'id': 'user1', 'has_accepted': True},
+             {'id': 'user3', 'has_accepted': False}])
+        # The user1 entries that were kept have not been rewritten.
+        kept = [r for r in before if r[0] == 'user1']
+        after = row_versions()
+        for row in kept:
+            self.assertIn(row, after)
+
+    def test_update_document_state(self):
+        import datetime
+        from ...utils import TZINFO
+        d1 = Document('Published', id=uuid.uuid4(), submitter=SUBMITTER,
+                      publication='1', state='Processing')
+        d2 = Document('Failed', id=uuid.uuid4(), submitter=SUBMITTER,
+                      publication='2', state='Failed/Error')
+        self.storage.add([d1, d2])
+        self.storage.persist()
+        self.assertEqual(
+            [str(p['id']) for p in self.storage.get_pending_publications()],
+            [str(d1.id)])
+
+        d1.update(title=u'Changed meanwhile')
+        self.storage.update(d1)
+        self.storage.persist()
+        revised = datetime.datetime(2016, 5, 4, 3, 2, 1, tzinfo=TZINFO)
+        self.assertTrue(self.storage.update_document_state(
+            d1.id, '1', 'Done/Success', revised))
+        # Not once it has the state or is in another publication.
+        self.assertFalse(self.storage.update_document_state(
+            d1.id, '1', 'Done/Success', revised))
+        self.assertFalse(self.storage.update_document_state(
+            d2.id, '3', 'Done/Success', revised))
+        self.storage.persist()
+
+        result = self.storage.get(id=d1.id)
+        self.assertEqual(result.metadata['state'], 'Done/Success')
+        self.assertEqual(result.metadata['revised'], revised)
+        self.assertEqual(result.metadata['title'], u'Changed meanwhile')
+        self.assertEqual(self.storage.get(id=d2.id).metadata['state'],
+                         'Failed/Error')
+        self.assertEqual(self.storage.get_pending_publications(), [])
+
     def test_restart(self):
         """
         Testing PostrgressStorage class restart function
@@ -221,10 +221,10 @@ class UtilsTests(unittest.TestCase):
             {'uid': 'me', 'permission': 'publish'},
             {'uid': 'you', 'permission': 'publish'},
             ]
-        with mock.patch('requests.get') as get:
+        with mock.patch('requests.Session.get') as get:
             get.return_value.status_code = 200
             get.json.side_effect = ([], records,)
-            with mock.patch('requests.post') as post:
+            with mock.patch('requests.Session.post') as post:
                 post.return_value.status_code = 202
 
                 with testing.testConfig(settings=settings):
@@ -245,18 +245,17 @@ class UtilsTests(unittest.TestCase):
                     'content-type': 'application/json',
                     })
 
+    @mock.patch('cnxauthoring.notifications.enqueue_notification')
     @mock.patch('cnxauthoring.utils.get_current_registry')
-    def test_notify_role_for_acceptance(self, mock_registry):
+    def test_notify_role_for_acceptance(self, mock_registry, mock_enqueue):
         from ..models import create_content
 
         document = create_content(title='My Document')
-        mock_accounts = mock.Mock()
-        mock_registry().getUtility.return_value = mock_accounts
         mock_registry().settings = {'webview.url': 'http://cnx.org/'}
 
         utils.notify_role_for_acceptance('user2', 'user1', document)
-        self.assertEqual(mock_accounts.send_message.call_count, 1)
-        (user_id, subject, body), _ = mock_accounts.send_message.call_args
+        self.assertEqual(mock_enqueue.call_count, 1)
+        (user_id, subject, body), _ = mock_enqueue.call_args
         self.assertEqual(user_id, 'user2')
         self.assertEqual(subject, 'Requesting action on OpenStax CNX content')
         self.assertEqual(body, '''\
@@ -598,11 +597,11 @@ Thank you from your friends at OpenStax CNX
             'publishing.api_key': 'trusted-publisher',
             }
 
-        with mock.patch('requests.get') as get:
+        with mock.patch('requests.Session.get') as get:
             publishing_records = []
             get.return_value.status_code = 200
             get.json.side_effect = publishing_records
-            with mock.patch('requests.post') as post:
+            with mock.patch('requests.Session.post') as post:
                 post.return_value.status_code = 202
 
                 with testing.testConfig(settings=settings):
@@ -654,9 +653,9 @@ Thank you from your friends at OpenStax CNX
         from ..models import PublishingError
 
         with testing.testConfig(settings=settings), \
-                mock.patch('requests.get') as get, \
-                mock.patch('requests.post') as post, \
-                mock.patch('requests.delete') as delete:
+                mock.patch('requests.Session.get') as get, \
+                mock.patch('requests.Session.post') as post, \
+                mock.patch('requests.Session.delete') as delete:
             mock_request().authenticated_userid = 'user1'
 
             get.return_value.status_code = 500
@@ -910,9 +909,9 @@ Thank you from your friends at OpenStax CNX
         from ..models import PublishingError
 
         with testing.testConfig(settings=settings), \
-                mock.patch('requests.get') as get, \
-                mock.patch('requests.post') as post, \
-                mock.patch('requests.delete') as delete:
+                mock.patch('requests.Session.get') as get, \
+                mock.patch('requests.Session.post') as post, \
+                mock.patch('requests.Session.delete') as delete:
             get.return_value.status_code = 500
             post.return_value.status_code = 202
             # No exception raised on a bad GET
@@ -929,6 +928,32 @@ Thank you from your friends at OpenStax CNX
             with self.assertRaises(PublishingError):
                 utils.declare_licensors(document)
 
+    def test_declare_licensors_publishing_unavailable(self):
+        import requests
+        from ..models import (
+            create_content, DEFAULT_LICENSE, PublishingConnectionError)
+
+        document = create_content(
+            title='My Document',
+            license={'url': DEFAULT_LICENSE.url},
+            authors=[{'id': 'me'}],
+            )
+        settings = {
+            'publishing.url': 'http://publishing/',
+            'publishing.api_key': 'trusted-publisher',
+            }
+
+        with testing.testConfig(settings=settings), \
+                mock.patch('requests.Session.get') as get:
+            get.side_effect = requests.exceptions.ConnectionError('down')
+            with self.assertRaises(PublishingConnectionError) as cm:
+                utils.declare_licensors(document)
+            self.assertFalse(cm.exception.timeout)
+            get.side_effect = requests.exceptions.ReadTimeout('slow')
+            with self.assertRaises(PublishingConnectionError) as cm:
+                utils.declare_licensors(document)
+            self.assertTrue(cm.exception.timeout)
+
     @httpretty.activate
     def test_declare_licensors_removal(self):
         from ..models import create_content, DEFAULT_LICENSE
@@ -978,6 +1003,87 @@ Thank you from your friends at OpenStax CNX
         # Check the document's acceptor list remains intact
         self.assertEqual(document.licensor_acceptance, [tracted_acceptance])
 
+    @httpretty.activate
+    @mock.patch('cnxauthoring.utils.get_current_request')
+    @mock.patch('cnxauthoring.utils.notify_role_for_acceptance')
+    def test_declare_publishing(self, mock_notify, mock_request):
+        from ..models import create_content, DEFAULT_LICENSE
+
+        document = create_content(
+            title='My Document',
+            license={'url': DEFAULT_LICENSE.url},
+            authors=[{'id': 'me'}],
+            publishers=[{'id': 'me'}],
+            licensor_acceptance=[{'id': 'me', 'has_accepted': True}],
+            )
+        publishing_url = 'http://publishing/'
+        settings = {
+            'publishing.url': publishing_url,
+            'publishing.api_key': 'trusted-publisher',
+            }
+
+        def url(name):
+            return urlparse.urljoin(
+                publishing_url, '/contents/{}/{}'.format(document.id, name))
+
+        upstream_roles = [
+            {'uid': 'me', 'role': 'Author', 'has_accepted': True},
+            {'uid': 'me', 'role': 'Publisher', 'has_accepted': True},
+            ]
+        upstream_licensors = {'license_url': DEFAULT_LICENSE.url,
+                              'licensors': []}
+        upstream_acl = [{'uid': 'me', 'permission': 'publish'}]
+        httpretty.register_uri(httpretty.GET, url('roles'),
+                               body=json.dumps(upstream_roles), status=200)
+        httpretty.register_uri(httpretty.POST, url('roles'), status=202)
+        httpretty.register_uri(httpretty.GET, url('licensors'),
+                               body=json.dumps(upstream_licensors),
+                               status=200)
+        httpretty.register_uri(httpretty.POST, url('licensors'), status=202)
+        httpretty.register_uri(httpretty.GET, url('permissions'),
+                               body=json.dumps(upstream_acl), status=200)
+        httpretty.register_uri(httpretty.POST, url('permissions'), status=202)
+
+        with testing.testConfig(settings=settings):
+            mock_request().authenticated_userid = 'me'
+            utils.declare_publishing(document)
+
+        requests = [(r.method, r.path.rsplit('/', 1)[-1])
+                    for r in httpretty.HTTPretty.latest_requests]
+        self.assertEqual(sorted(requests), [
+            ('GET', 'licensors'),
+            ('GET', 'permissions'),
+            ('GET', 'permissions'),
+            ('GET', 'roles'),
+            ('POST', 'licensors'),
+            ('POST', 'permissions'),
+            ('POST', 'roles'),
+            ])
+        # The publication permission is declared after the roles.
+        self.assertLess(requests.index(('POST', 'roles')),
+                        requests.index(('POST', 'permissions')))
+        # The acceptance of the upstream roles is used.
+        self.assertEqual(document.metadata['authors'][0]['has_accepted'],
+                         True)
+        self.assertEqual(sorted(document.acls['me']),
+                         ['edit', 'publish', 'view'])
+        self.assertEqual(document.licensor_acceptance,
+                         [{'id': 'me', 'has_accepted': True}])
+
+        # Nothing is declared again until it changes.
+        httpretty.HTTPretty.latest_requests = []
+        with testing.testConfig(settings=settings):
+            utils.declare_publishing(document)
+        self.assertEqual(httpretty.HTTPretty.latest_requests, [])
+
+        document.licensor_acceptance[0]['has_accepted'] = False
+        with testing.testConfig(settings=settings):
+            utils.declare_publishing(document)
+        requests = [(r.method, r.path.rsplit('/', 1)[-1])
+                    for r in httpretty.HTTPretty.latest_requests]
+        self.assertEqual(requests, [('GET', 'licensors'),
+                                    ('POST', 'licensors')])
+
     def test_validate_for_publish_on_document(self):
         from ..models import create_content, DEFAULT_LICENSE
 
@@ -1116,6 +1222,13 @@ Thank you from your friends at OpenStax CNX
 
 class ArchiveCommunicationsTestCase(unittest.TestCase):
 
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'archive.url': 'http://example.com',
+            })
+        self.addCleanup(testing.tearDown)
+        httpretty.HTTPretty.latest_requests = []
+
     @httpretty.activate
     def test_content(self):
         content_id = 'uuid'
@@ -1127,8 +1240,6 @@ class ArchiveCommunicationsTestCase(unittest.TestCase):
                                body=faux_response_body, status=200)
 
         request = testing.DummyRequest()
-        request.registry = mock.Mock()
-        request.registry.settings = {'archive.url': archive_url}
 
         from ..utils import fetch_archive_content
         document_as_dict = fetch_archive_content(request, content_id)
@@ -1145,8 +1256,6 @@ class ArchiveCommunicationsTestCase(unittest.TestCase):
                                body=faux_response_body, status=200)
 
         request = testing.DummyRequest()
-        request.registry = mock.Mock()
-        request.registry.settings = {'archive.url': archive_url}
 
         from ..utils import fetch_archive_content
         extras = fetch_archive_content(request, content_id, extras=True)
@@ -1162,8 +1271,6 @@ class ArchiveCommunicationsTestCase(unittest.TestCase):
         httpretty.register_uri(httpretty.GET, url, status=404)
 
         request = testing.DummyRequest()
-        request.registry = mock.Mock()
-        request.registry.settings = {'archive.url': archive_url}
 
         from ..utils import fetch_archive_content
         from ..models import DocumentNotFoundError
@@ -1179,8 +1286,6 @@ class ArchiveCommunicationsTestCase(unittest.TestCase):
         httpretty.register_uri(httpretty.GET, url, body=response_data, status=200)
 
         request = testing.DummyRequest()
-        request.registry = mock.Mock()
-        request.registry.settings = {'archive.url': archive_url}
 
         from ..utils import fetch_archive_content
         from ..models import DocumentNotFoundError
@@ -1191,12 +1296,73 @@ class ArchiveCommunicationsTestCase(unittest.TestCase):
         content_id = 'uuid'
         archive_url = 'http://example.com'
         request = testing.DummyRequest()
-        request.registry = mock.Mock()
-        request.registry.settings = {'archive.url': archive_url}
 
         from ..utils import fetch_archive_content
         from ..models import ArchiveConnectionError
         from requests.exceptions import ConnectionError
-        with mock.patch('requests.get', side_effect=ConnectionError()) as get:
+        with mock.patch('requests.Session.get', side_effect=ConnectionError()) as get:
             self.assertRaises(ArchiveConnectionError, fetch_archive_content,
                               request, content_id)
+
+    @httpretty.activate
+    def test_versioned_content_cached(self):
+        url = 'http://example.com/contents/uuid@1.json'
+        httpretty.register_uri(httpretty.GET, url,
+                               body=json.dumps({'id': 'uuid'}), status=200)
+
+        from ..utils import fetch_archive_content
+        request = testing.DummyRequest()
+        document = fetch_archive_content(request, 'uuid@1')
+        self.assertEqual(document, {'id': 'uuid'})
+        # Changing the content doesn't change the cached copy.
+        document['id'] = 'changed'
+        self.assertEqual(fetch_archive_content(request, 'uuid@1'),
+                         {'id': 'uuid'})
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+
+    @httpretty.activate
+    def test_content_revalidated(self):
+        url = 'http://example.com/extras/uuid'
+        httpretty.register_uri(httpretty.GET, url, responses=[
+            httpretty.Response(body=json.dumps({'canPublish': ['me']}),
+                               status=200, etag='"v1"'),
+            httpretty.Response(body='', status=304),
+            httpretty.Response(body=json.dumps({'canPublish': ['you']}),
+                               status=200, etag='"v2"'),
+            ])
+
+        from ..utils import fetch_archive_content
+        request = testing.DummyRequest()
+        for can_publish in (['me'], ['me'], ['you']):
+            extras = fetch_archive_content(request, 'uuid', extras=True)
+            self.assertEqual(extras, {'can_publish': can_publish})
+        requests = httpretty.HTTPretty.latest_requests
+        self.assertEqual([r.headers.get('If-None-Match') for r in requests],
+                         [None, '"v1"', '"v1"'])
+
+    @httpretty.activate
+    def test_cache_directory(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        url = 'http://example.com/contents/uuid@1.json'
+        httpretty.register_uri(httpretty.GET, url,
+                               body=json.dumps({'id': 'uuid'}), status=200)
+
+        from ..utils import fetch_archive_content
+        for i in range(2):
+            # A new application, with the cache in the same directory.
+            with testing.testConfig(settings={
+                    'archive.url': 'http://example.com',
+                    'archive.cache-directory': directory,
+                    }):
+                request = testing.DummyRequest()
+                self.assertEqual(fetch_archive_content(request, 'uuid@1'),
+                                 {'id': 'uuid'})
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+
+    def test_cache_disabled(self):
+        from ..utils import get_archive_cache
+        self.config.registry.settings['archive.cache-size'] = '0'
+        self.assertEqual(get_archive_cache(self.config.registry), None)
@@ -35,9 +35,10 @@ class ViewsTests(unittest.TestCase):
         declare_routes(self.config)
         from .. import storage as storage_pkg
         _storage_instance = self.storage_cls()
-        patch = mock.patch.object(_storage_instance, 'persist')
-        patch.start()
-        self.addCleanup(patch.stop)
+        for name in ('persist', 'abort'):
+            patch = mock.patch.object(_storage_instance, name)
+            patch.start()
+            self.addCleanup(patch.stop)
         setattr(storage_pkg, 'storage', _storage_instance)
         self.addCleanup(setattr, storage_pkg, 'storage', None)
 
@@ -59,6 +60,7 @@ class ViewsTests(unittest.TestCase):
                 'cnxauthoring.utils.declare_acl',
                 'cnxauthoring.utils.declare_roles',
                 'cnxauthoring.utils.declare_licensors',
+                'cnxauthoring.utils.declare_publishing',
                 'cnxauthoring.utils.accept_roles',
                 ):
             patch = mock.patch(mock_target)
@@ -127,12 +129,12 @@ class ViewsTests(unittest.TestCase):
         self.assertEqual(document.metadata['created'], created)
         self.assertEqual(document.metadata['revised'], created)
 
-        # Update some fields, set state to Failed/Error
+        # Update some fields, set state to Processing
         revised = datetime.datetime.now(TZINFO)
         with mock.patch('datetime.datetime') as mock_datetime:
             mock_datetime.now.return_value = revised
             document.update(abstract='Abstract of My Document',
-                            state='Failed/Error',
+                            state='Processing',
                             publication=100)
         self.assertEqual(document.metadata['created'], created)
         self.assertEqual(document.metadata['revised'], revised)
@@ -141,9 +143,11 @@ class ViewsTests(unittest.TestCase):
         from ..views import update_content_state
         request = testing.DummyRequest()
         request.registry.settings['publishing.url'] = 'http://cnx-publishing/'
+        # Don't cache the states, which change between the calls.
+        request.registry.settings['publications.state-ttl'] = '0'
         mock_response = mock.Mock(status_code=200)
-        mock_response.content = b'{"state": "Failed/Error"}'
-        with mock.patch('requests.get') as mock_get:
+        mock_response.content = b'{"state": "Processing"}'
+        with mock.patch('requests.Session.get') as mock_get:
             mock_get.return_value = mock_response
             update_content_state(request, document)
             args, kwargs = mock_get.call_args
@@ -156,11 +160,12 @@ class ViewsTests(unittest.TestCase):
         mock_response = mock.Mock(status_code=200)
         mock_response.content = b'{"state": "Done/Success"}'
         state_updated = datetime.datetime.now(TZINFO)
-        with mock.patch('requests.get') as mock_get:
+        with mock.patch('requests.Session.get') as mock_get:
             mock_get.return_value = mock_response
             with mock.patch('datetime.datetime') as mock_datetime:
                 mock_datetime.now.return_value = state_updated
-                with mock.patch.object(self.storage_cls, 'update'):
+                with mock.patch.object(self.storage_cls,
+                                       'update_document_state') as update:
                     update_content_state(request, document)
 
             args, kwargs = mock_get.call_args
@@ -168,6 +173,9 @@ class ViewsTests(unittest.TestCase):
         self.assertEqual(document.metadata['created'], created)
         # since the state changed, revised should be updated
         self.assertEqual(document.metadata['revised'], state_updated)
+        # only the state is written
+        update.assert_called_once_with(document.id, 100, 'Done/Success',
+                                       state_updated)
 
     def test_get_content_for_document(self):
         # Set up a piece of content.
@@ -185,6 +193,106 @@ class ViewsTests(unittest.TestCase):
             content = get_content(request)
         self.assertEqual(content, expected)
 
+    def test_get_content_publication_state_timeout(self):
+        import requests
+        from ..models import Document
+        id = uuid.uuid4()
+        expected = Document('Published', id=id, state='Processing',
+                            publication='1')
+        expected.acls = {'userid': ('edit', 'view', 'publish')}
+
+        request = testing.DummyRequest()
+        request.matchdict = {'id': id}
+        request.registry.settings['publishing.url'] = 'http://publishing/'
+        timeout = requests.exceptions.ReadTimeout('slow')
+        with mock.patch.object(self.storage_cls, 'get',
+                               return_value=expected), \
+                mock.patch.object(self.storage_cls,
+                                  'update_document_state') as update, \
+                mock.patch('requests.Session.get', side_effect=timeout):
+            from ..views import get_content
+            content = get_content(request)
+        # The content is returned with the state it has.
+        self.assertEqual(content.metadata['state'], 'Processing')
+        self.assertEqual(update.call_count, 0)
+
+    def test_storage_management_aborts_on_error(self):
+        from .. import storage as storage_pkg
+        from ..views import storage_management
+
+        @storage_management
+        def view(request):
+            raise ValueError('oops')
+
+        request = testing.DummyRequest()
+        self.assertRaises(ValueError, view, request)
+        storage_pkg.storage.abort.assert_called_once_with()
+        self.assertEqual(storage_pkg.storage.persist.call_count, 0)
+
+        # Error responses don't keep the changes either.
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        @storage_management
+        def rejecting_view(request):
+            raise HTTPBadRequest('no')
+
+        storage_pkg.storage.abort.reset_mock()
+        self.assertRaises(HTTPBadRequest, rejecting_view, request)
+        storage_pkg.storage.abort.assert_called_once_with()
+        self.assertEqual(storage_pkg.storage.persist.call_count, 0)
+
+    def test_storage_management_releases_when_finished(self):
+        from .. import storage as storage_pkg
+        from ..views import storage_management
+
+        @storage_management
+        def view(request):
+            return {}
+
+        request = testing.DummyRequest()
+        view(request)
+        storage_pkg.storage.persist.assert_called_once_with()
+        self.assertEqual(storage_pkg.storage.abort.call_count, 0)
+
+        # Reads made while rendering the response aren't committed.
+        for callback in request.finished_callbacks:
+            callback(request)
+        storage_pkg.storage.abort.assert_called_once_with()
+        storage_pkg.storage.persist.assert_called_once_with()
+
+    def test_publishing_connection_error(self):
+        from ..models import PublishingConnectionError
+        from ..views import publishing_connection_error
+        request = testing.DummyRequest()
+        response = publishing_connection_error(
+            PublishingConnectionError('down'), request)
+        self.assertEqual(response.status_int, 503)
+        response = publishing_connection_error(
+            PublishingConnectionError('slow', timeout=True), request)
+        self.assertEqual(response.status_int, 502)
+
+    def test_post_to_publishing_upload_timeout(self):
+        import requests
+        from ..models import PublishingConnectionError
+        from ..views import post_to_publishing
+        request = testing.DummyRequest()
+        request.registry.settings.update({
+            'publishing.url': 'http://publishing/',
+            'publishing.api_key': 'b07',
+            'publishing.connect-timeout': '2',
+            'publishing.upload-timeout': '600',
+            })
+        with mock.patch('cnxauthoring.utils.build_epub') as build_epub, \
+                mock.patch('requests.Session.post') as post:
+            build_epub.return_value = io.BytesIO(b'epub')
+            post_to_publishing(request, 'me', 'Publishing', [])
+            self.assertEqual(post.call_args[1]['timeout'], (2.0, 600.0))
+
+            post.side_effect = requests.exceptions.ReadTimeout('slow')
+            with self.assertRaises(PublishingConnectionError) as cm:
+                post_to_publishing(request, 'me', 'Publishing', [])
+            self.assertTrue(cm.exception.timeout)
+
     def test_get_content_404(self):
         request = testing.DummyRequest()
         request.matchdict = {'id': '1234abcde'}
@@ -247,6 +355,17 @@ class ViewsTests(unittest.TestCase):
         self.assertIn(('Location', content_url,),
                       request.response.headerlist)
 
+    def test_post_content_multiple(self):
+        from ..views import post_content
+        request = testing.DummyRequest()
+        request.json_body = [{'title': 'One'}, {'title': 'Two'}]
+        with mock.patch.object(self.storage_cls, 'add') as add:
+            contents = post_content(request)
+        self.assertEqual([c.metadata['title'] for c in contents],
+                         ['One', 'Two'])
+        # The items are added together.
+        add.assert_called_once_with(contents)
+
     def test_post_content(self):
         from ..models import DEFAULT_LICENSE
         post_data = {
@@ -5,15 +5,17 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import base64
 import io
 import re
 import datetime
+import functools
+import hashlib
 import json
+import uuid
 import logging
-try:
-    import urllib2  # python2
-except ImportError:
-    import urllib.request as urllib2  # renamed in python3
+import threading
+from multiprocessing.pool import ThreadPool
 try:
     import urlparse  # python2
 except ImportError:
@@ -24,11 +26,15 @@ from cnxepub.models import Document, DocumentPointer, TranslucentBinder
 import requests
 import tzlocal
 from lxml import etree
-from openstax_accounts.interfaces import IOpenstaxAccounts
-from pyramid.threadlocal import get_current_registry, get_current_request
+from pyramid.threadlocal import (
+    get_current_registry, get_current_request, manager as threadlocal_manager,
+    )
 from cnxquerygrammar.query_parser import grammar, DictFormater
 from parsimonious.exceptions import IncompleteParseError
 
+from .cache import ResponseCache
+from .clients import get_client
+
 
 # Timezone info initialized from the system timezone.
 TZINFO = tzlocal.get_localzone()
@@ -42,6 +48,12 @@ PUBLISHING_ROLES_MAPPING = {
     'Publisher': 'publishers',
     'Translator': 'translators',
     }
+# Number of threads making requests to publishing concurrently
+# (see ``declare_publishing``).
+PUBLISHING_THREADS = 10
+# Default bytes of archive responses cached in memory
+# (see ``fetch_archive_content``).
+ARCHIVE_CACHE_SIZE = 16777216
 
 
 def utf8(item):
@@ -111,6 +123,33 @@ def fix_quotes(query_string):
     return query_string
 
 
+ISO_DATETIME = re.compile(
+    r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?([+-]\d\d:\d\d)?$')
+
+
+def encode_page_cursor(revised, id):
+    """Encode the (revised, id) key of the last item of a page into an
+    opaque cursor for requesting the next page.
+    """
+    key = [revised.isoformat(), str(id)]
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(cursor):
+    """Decode a cursor made by ``encode_page_cursor`` into the (revised, id)
+    key. Raises ``ValueError`` when it isn't a valid cursor.
+    """
+    try:
+        revised, id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if ISO_DATETIME.match(revised):
+            return (revised, str(uuid.UUID(id)))
+    except (AttributeError, TypeError, ValueError, UnicodeError):
+        pass
+    raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
 def filter_binder_documents(binder, documents):
     """walks through a binder, converting any draft documents that are
         not in the list of documents into documentpointers."""
@@ -176,7 +215,40 @@ def build_epub(contents, submitter, submitlog):
     return epub
 
 
+_archive_cache_lock = threading.Lock()
+
+
+def get_archive_cache(registry):
+    """The cache of archive responses shared by the application of the
+    ``registry``, or None when the ``archive.cache-size`` setting is 0
+    and there is no ``archive.cache-directory``.
+    """
+    with _archive_cache_lock:
+        if not hasattr(registry, 'archive_cache'):
+            settings = registry.settings or {}
+            max_size = int(settings.get('archive.cache-size',
+                                        ARCHIVE_CACHE_SIZE))
+            directory = settings.get('archive.cache-directory')
+            registry.archive_cache = None
+            if max_size or directory:
+                registry.archive_cache = ResponseCache(max_size, directory)
+        return registry.archive_cache
+
+
+def _is_versioned(ident_hash):
+    id, sep, version = ident_hash.partition('@')
+    return bool(version)
+
+
 def fetch_archive_content(request, archive_id, extras=False):
+    """The content (or its extras) of ``archive_id`` in archive.
+
+    Responses are cached by url (see ``get_archive_cache``). The content
+    of a version is the same for good, so it is only requested once.
+    Otherwise, e.g. for the latest version or the extras (which hold
+    the users that can publish), the cached response is revalidated
+    with its ETag.
+    """
     from .models import ArchiveConnectionError, DocumentNotFoundError
 
     settings = request.registry.settings
@@ -187,16 +259,40 @@ def fetch_archive_content(request, archive_id, extras=False):
     else:
         content_url = urlparse.urljoin(
             archive_url, '/contents/{}.json'.format(archive_id))
+    immutable = not extras and _is_versioned(archive_id)
+    cache = get_archive_cache(request.registry)
+    cached = cache and cache.get(content_url)
+    response = None
+    if cached is not None and immutable:
+        body = cached[1]
+    else:
+        headers = {}
+        if cached is not None and cached[0]:
+            headers['If-None-Match'] = cached[0]
+        try:
+            response = get_client('archive', request.registry).get(
+                content_url, headers=headers)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as exc:
+            raise ArchiveConnectionError(exc.message)
+        if response.status_code == 304 and cached is not None:
+            body = cached[1]
+            response = None
+        elif response.status_code >= 400:
+            raise DocumentNotFoundError(archive_id)
+        else:
+            body = response.content
     try:
-        response = requests.get(content_url)
-    except requests.exceptions.ConnectionError as exc:
-        raise ArchiveConnectionError(exc.message)
-    if response.status_code >= 400:
-        raise DocumentNotFoundError(archive_id)
-    try:
-        document = response.json()
+        document = json.loads(body.decode('utf-8'))
     except (TypeError, ValueError):
         raise DocumentNotFoundError(archive_id)
+    if response is not None and cache is not None:
+        etag = response.headers.get('etag')
+        if etag or immutable:
+            cache.set(content_url, etag, body)
+        if not extras and response.history:
+            # Redirected from the latest version to the version itself.
+            cache.set(response.url, etag, body)
     change_dict_keys(document, camelcase_to_underscore)
     return document
 
@@ -207,14 +303,16 @@ def derive_resources(request, document):
     settings = request.registry.settings
     archive_url = settings['archive.url']
     path = urlparse.unquote(request.route_path('get-resource', hash='{}'))
+    archive = get_client('archive', request.registry)
     resources = {}
     for r in document.references:
         if r.uri.startswith('/resources'):
             if not resources.get(r.uri):
                 url = urlparse.urljoin(archive_url, r.uri)
                 try:
-                    response = requests.get(url)
-                except requests.exceptions.ConnectionError as exc:
+                    response = archive.get(url)
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout) as exc:
                     raise ArchiveConnectionError(exc.message)
                 if response.status_code >= 400:
                     continue
@@ -272,22 +370,16 @@ def update_containment(binder, deletion=False):
 
     b_id = binder.id
     doc_ids = []
-    old_docs = storage.get_all(contained_in=b_id)
-
-    # additions
     if not deletion:
         docs = cnxepub.flatten_to_documents(binder)
         for doc in docs:
-            doc_ids.append(doc.id)  # gather for subtractions below
+            doc_ids.append(doc.id)
+            # Keep the loaded documents up to date.
             if b_id not in doc.metadata['contained_in']:
                 doc.metadata['contained_in'].append(b_id)
-                storage.update(doc)
-    # subtractions
-    for doc in old_docs:
-        if doc.id not in doc_ids:
-            if b_id in doc.metadata['contained_in']:
-                doc.metadata['contained_in'].remove(b_id)
-                storage.update(doc)
+    # The documents that are no longer in the binder are updated
+    # by the storage, without retrieving them.
+    storage.update_containment(b_id, doc_ids)
 
 
 def get_roles(document, uid):
@@ -306,8 +398,10 @@ def get_roles(document, uid):
 def notify_role_for_acceptance(user_id, requester, model):
     """Notify the given ``user_id`` on ``model`` that s/he has been
     assigned a role on said model and can now accept the role.
+    The message is sent in the background once the changes are persisted.
     """
-    accounts = get_current_registry().getUtility(IOpenstaxAccounts)
+    from .notifications import enqueue_notification
+
     settings = get_current_registry().settings
     base_url = settings['webview.url']
     link = urlparse.urljoin(base_url, '/users/role-acceptance/{}'
@@ -326,13 +420,7 @@ Thank you from your friends at OpenStax CNX
            requester=requester,
            title=model.metadata['title'],
            link=link)
-    try:
-        accounts.send_message(user_id, subject, body)
-    except urllib2.HTTPError:
-        # Can't send messages via accounts for some reason - should be async!
-        logger.warning("Failed sending notification message to {}"
-                       .format(user_id))
-        pass
+    enqueue_notification(user_id, subject, body)
 
 
 def accept_roles(cstruct, user):
@@ -366,31 +454,157 @@ def accept_license(document, user):
         document.licensor_acceptance.append(user_copy)
 
 
-def declare_acl(model):
-    """Declare publication permission on the model and within publishing.
-    The model is updated as part of this procedure, but it is not persisted.
+def publishing_connection(function):
+    """Report the failures of ``function`` to connect to publishing,
+    or to receive its response in time, as ``PublishingConnectionError``.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        from .models import PublishingConnectionError
+
+        try:
+            return function(*args, **kwargs)
+        except requests.exceptions.ConnectionError as exc:
+            raise PublishingConnectionError(str(exc))
+        except requests.exceptions.Timeout as exc:
+            raise PublishingConnectionError(str(exc), timeout=True)
+    return wrapper
+
+
+def _publishing_endpoint(model, name):
+    """The publishing client, url and headers for requests to the ``name``
+    (e.g. 'roles') endpoint of the model in publishing.
     """
-    from .models import PublishingError
-
-    # Put together the information necessary to make publishing requests.
     settings = get_current_registry().settings
-    publishing_url = settings['publishing.url']
-    api_key = settings['publishing.api_key']
+    url = urlparse.urljoin(settings['publishing.url'],
+                           '/contents/{}/{}'.format(model.id, name))
     headers = {
-            'x-api-key': api_key,
-            'content-type': 'application/json',
+        'x-api-key': settings['publishing.api_key'],
+        'content-type': 'application/json',
+        }
+    return get_client('publishing'), url, headers
+
+
+_publishing_sync_pool = None
+_publishing_sync_lock = threading.Lock()
+
+
+def _get_publishing_sync_pool():
+    """The pool of threads making requests to publishing."""
+    global _publishing_sync_pool
+    with _publishing_sync_lock:
+        if _publishing_sync_pool is None:
+            _publishing_sync_pool = ThreadPool(PUBLISHING_THREADS)
+        return _publishing_sync_pool
+
+
+def _call_concurrently(*funcs):
+    """Call the ``funcs`` concurrently and return their results in order.
+    The first is called in this thread and the rest in the publishing
+    thread pool, with this thread's registry and request.
+    Once all the calls have finished, the exception raised by the first
+    failing call (if any) is re-raised.
+    """
+    threadlocals = threadlocal_manager.get()
+
+    def call(func):
+        threadlocal_manager.push(threadlocals)
+        try:
+            return func()
+        finally:
+            threadlocal_manager.pop()
+
+    pending = []
+    if len(funcs) > 1:
+        pool = _get_publishing_sync_pool()
+        pending = [pool.apply_async(call, (func,)) for func in funcs[1:]]
+    try:
+        results = [funcs[0]()]
+    finally:
+        # Wait for the other calls, even when this one has failed.
+        for result in pending:
+            result.wait()
+    results.extend([result.get() for result in pending])
+    return results
+
+
+def _publishing_fingerprint(model, name):
+    """A fingerprint of the state of the model that ``declare_<name>``
+    (i.e. 'roles', 'licensors' or 'acl') declares within publishing.
+    """
+    roles = {}
+    for role_type in set(cnxepub.ATTRIBUTED_ROLE_KEYS) \
+            .union(PUBLISHING_ROLES_MAPPING.values()):
+        roles[role_type] = model.metadata.get(role_type, [])
+    if name == 'roles':
+        state = roles
+    elif name == 'licensors':
+        role_ids = set([r['id'] for role_type in PUBLISHING_ROLES_MAPPING
+                        .values() for r in roles[role_type]])
+        state = {
+            'license_url': model.metadata['license'].url,
+            'licensor_acceptance': model.licensor_acceptance,
+            'role_ids': sorted(role_ids),
             }
-    url = urlparse.urljoin(publishing_url,
-                           '/contents/{}/permissions'.format(model.id))
+    else:
+        state = {
+            'roles': roles,
+            'acls': {uid: sorted(permissions)
+                     for uid, permissions in model.acls.items()},
+            }
+    state = json.dumps(state, sort_keys=True, default=str)
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
 
-    # Acquire the current ACL
-    #   (which at this time only contains the publish permission)
+
+def _is_declared(model, name):
+    """Whether the state of the model that ``declare_<name>`` declares
+    is unchanged since it was last declared within publishing.
+    """
+    fingerprint = model.publishing_fingerprints.get(name)
+    return fingerprint == _publishing_fingerprint(model, name)
+
+
+def _declared(model, name):
+    """Record that the state of the model that ``declare_<name>``
+    declares has been declared within publishing.
+    """
+    model.publishing_fingerprints[name] = _publishing_fingerprint(model, name)
+
+
+@publishing_connection
+def _get_upstream_acl(model):
+    """The ids of the users with permissions on the model in publishing
+    (which at this time is only the publish permission).
+    """
+    from .models import PublishingError
+
+    publishing, url, headers = _publishing_endpoint(model, 'permissions')
     upstream_acl_ids = set([])
-    response = requests.get(url, headers=headers)
+    response = publishing.get(url, headers=headers)
     if response.status_code == 200:
         upstream_acl_ids = set([x['uid'] for x in response.json()])
     elif response.status_code >= 400:
         raise PublishingError(response)
+    return upstream_acl_ids
+
+
+@publishing_connection
+def declare_acl(model, upstream_acl_ids=None):
+    """Declare publication permission on the model and within publishing.
+    The model is updated as part of this procedure, but it is not persisted.
+    Pass the ``upstream_acl_ids`` when they have already been acquired
+    (see ``_get_upstream_acl``). Nothing is done when the roles' acceptance
+    and the ACL haven't changed since they were last declared.
+    """
+    from .models import PublishingError
+
+    if _is_declared(model, 'acl'):
+        return
+    publishing, url, headers = _publishing_endpoint(model, 'permissions')
+    # Acquire the current ACL
+    #   (which at this time only contains the publish permission)
+    if upstream_acl_ids is None:
+        upstream_acl_ids = _get_upstream_acl(model)
 
     # Push out the current set of publishers.
     payload = []
@@ -398,7 +612,7 @@ def declare_acl(model):
         for user in model.metadata.get(role_type, []):
             if user.get('has_accepted'):
                 payload.append({'uid': user['id'], 'permission': 'publish'})
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
+    response = publishing.post(url, data=json.dumps(payload), headers=headers)
     if response.status_code != 202:
         raise PublishingError(response)
 
@@ -407,13 +621,13 @@ def declare_acl(model):
     removal_payload = [{'permission': 'publish', 'uid': uid}
                        for uid in upstream_acl_ids.difference(local_acl_ids)]
     if removal_payload:
-        response = requests.delete(url, headers=headers,
-                                   data=json.dumps(removal_payload))
+        response = publishing.delete(url, headers=headers,
+                                     data=json.dumps(removal_payload))
         if response.status_code != 200:
             raise PublishingError(response)
 
     # Aquire the updated ACL
-    response = requests.get(url, headers=headers)
+    response = publishing.get(url, headers=headers)
     upstream_acl = response.json()
 
     # Update the model's ACL attribute.
@@ -457,31 +671,42 @@ def declare_acl(model):
         if uid in model.acls and 'view' not in model.acls[uid]:
             permissions.remove('view')
         model.acls[uid] = permissions
+    _declared(model, 'acl')
+
+
+@publishing_connection
+def _get_upstream_roles(model):
+    """The role entities of the model in publishing."""
+    from .models import PublishingError
+
+    publishing, url, headers = _publishing_endpoint(model, 'roles')
+    response = publishing.get(url, headers=headers)
+    upstream_role_entities = []
+    if response.status_code == 200:
+        upstream_role_entities = response.json()
+    elif response.status_code >= 400 and response.status_code != 404:
+        raise PublishingError(response)
+    return upstream_role_entities
 
 
-def declare_roles(model):
+@publishing_connection
+def declare_roles(model, upstream_role_entities=None):
     """Annotate the roles to include role acceptance information.
     The model is updated as part of this procedure, but it is not persisted.
+    Pass the ``upstream_role_entities`` when they have already been
+    acquired (see ``_get_upstream_roles``). Nothing is done when the roles
+    haven't changed since they were last declared.
     """
     from .models import PublishingError
 
+    if _is_declared(model, 'roles'):
+        return
     authenticated_userid = get_current_request().authenticated_userid
-    settings = get_current_registry().settings
-    publishing_url = settings['publishing.url']
-    headers = {
-        'x-api-key': settings['publishing.api_key'],
-        'content-type': 'application/json',
-        }
-    url = urlparse.urljoin(publishing_url,
-                           '/contents/{}/roles'.format(model.id))
+    publishing, url, headers = _publishing_endpoint(model, 'roles')
 
     # Sync with the current set of attributed roles.
-    response = requests.get(url, headers=headers)
-    upstream_role_entities = []
-    if response.status_code == 200:
-        upstream_role_entities = response.json()
-    elif response.status_code >= 400 and response.status_code != 404:
-        raise PublishingError(response)
+    if upstream_role_entities is None:
+        upstream_role_entities = _get_upstream_roles(model)
 
     tobe_removed = []
     for role_entity in upstream_role_entities:
@@ -530,14 +755,14 @@ def declare_roles(model):
     if tobe_removed:
         deletes_payload = [dict(zip(['uid', 'role'], e))
                            for e in tobe_removed]
-        response = requests.delete(url, data=json.dumps(deletes_payload),
-                                   headers=headers)
+        response = publishing.delete(url, data=json.dumps(deletes_payload),
+                                     headers=headers)
         if response.status_code != 200:
             raise PublishingError(response)
 
     # Post roles
-    response = requests.post(url, data=json.dumps(payload),
-                             headers=headers)
+    response = publishing.post(url, data=json.dumps(payload),
+                               headers=headers)
     if response.status_code != 202:
         raise PublishingError(response)
 
@@ -545,6 +770,7 @@ def declare_roles(model):
     #     needs changed in webview and archive before removing here.
     model.metadata['copyright_holders'] = model.metadata['licensors']
     # /BBB
+    _declared(model, 'roles')
 
     # Notify any new roles that they need to accept the assigned attribution.
     if tobe_notified:
@@ -554,30 +780,36 @@ def declare_roles(model):
         notify_role_for_acceptance(user_id, authenticated_userid, model)
 
 
-def declare_licensors(model):
+@publishing_connection
+def _get_upstream_licensors(model):
+    """The license acceptance information of the model in publishing."""
+    publishing, url, headers = _publishing_endpoint(model, 'licensors')
+    response = publishing.get(url)
+    if response.status_code >= 400:
+        return {
+            'license_url': None,
+            'licensors': [],
+            }
+    return response.json()
+
+
+@publishing_connection
+def declare_licensors(model, upstream_license_info=None):
     """Declare license acceptance information on the model.
     The model is updated as part of this procedure, but it is not persisted.
+    Pass the ``upstream_license_info`` when it has already been acquired
+    (see ``_get_upstream_licensors``). Nothing is done when the license,
+    licensors and roles haven't changed since they were last declared.
     """
     from .models import PublishingError
 
-    settings = get_current_registry().settings
-    publishing_url = settings['publishing.url']
-    headers = {
-        'x-api-key': settings['publishing.api_key'],
-        'content-type': 'application/json',
-        }
-    url = urlparse.urljoin(publishing_url,
-                           '/contents/{}/licensors'.format(model.id))
+    if _is_declared(model, 'licensors'):
+        return
+    publishing, url, headers = _publishing_endpoint(model, 'licensors')
 
     # Acquire a list of known roles from publishing.
-    response = requests.get(url)
-    if response.status_code >= 400:
-        upstream_license_info = {
-            'license_url': None,
-            'licensors': [],
-            }
-    else:
-        upstream_license_info = response.json()
+    if upstream_license_info is None:
+        upstream_license_info = _get_upstream_licensors(model)
     upstream = upstream_license_info.get('licensors', [])
     upstream_user_ids = [x['uid'] for x in upstream]
     existing_licensor_ids = [l['id'] for l in model.licensor_acceptance]
@@ -613,8 +845,8 @@ def declare_licensors(model):
             del model.licensor_acceptance[idx]
     if tobe_removed:
         deletes_payload = {'licensors': [{'uid': e} for e in tobe_removed]}
-        response = requests.delete(url, data=json.dumps(deletes_payload),
-                                   headers=headers)
+        response = publishing.delete(url, data=json.dumps(deletes_payload),
+                                     headers=headers)
         if response.status_code != 200:
             raise PublishingError(response)
 
@@ -624,10 +856,50 @@ def declare_licensors(model):
         'licensors': [{'uid': x['id'], 'has_accepted': x['has_accepted']}
                       for x in model.licensor_acceptance],
         }
-    response = requests.post(url, data=json.dumps(payload),
-                             headers=headers)
+    response = publishing.post(url, data=json.dumps(payload),
+                               headers=headers)
     if response.status_code != 202:
         raise PublishingError(response)
+    _declared(model, 'licensors')
+
+
+def declare_publishing(model):
+    """Declare the roles, licensors and publication permission of the model
+    within publishing (see ``declare_roles``, ``declare_licensors`` and
+    ``declare_acl``), making the requests that don't depend on each other
+    concurrently. Only what has changed since it was last declared is
+    declared.
+    The model is updated as part of this procedure, but it is not persisted.
+    """
+    getters = {
+        'roles': _get_upstream_roles,
+        'licensors': _get_upstream_licensors,
+        'acl': _get_upstream_acl,
+        }
+    changed = [name for name in ('roles', 'licensors', 'acl',)
+               if not _is_declared(model, name)]
+    # Declaring the roles can change their acceptance, on which the
+    #   publication permission depends.
+    if 'roles' in changed and 'acl' not in changed:
+        changed.append('acl')
+    upstream = dict.fromkeys(getters)
+    if changed:
+        results = _call_concurrently(*[functools.partial(getters[name], model)
+                                       for name in changed])
+        upstream.update(zip(changed, results))
+
+    # The publication permission is declared for the roles that have
+    #   been accepted, which is known once the roles have been declared.
+    #   (They are declared in this thread, since they add notifications
+    #   to the request's changes.)
+    def declare_roles_and_acl():
+        declare_roles(model, upstream['roles'])
+        declare_acl(model, upstream['acl'])
+
+    _call_concurrently(
+        declare_roles_and_acl,
+        lambda: declare_licensors(model, upstream['licensors']),
+        )
 
 
 VALIDATION_ROLES_PENDING = 'roles_pending'
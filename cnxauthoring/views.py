@@ -10,6 +10,7 @@ import datetime
 import functools
 import json
 import logging
+import time
 try:
     from urllib import urlencode  # python 2
 except ImportError:
@@ -19,10 +20,10 @@ try:
 except ImportError:
     import urllib.parse as urlparse  # renamed in python3
 
+from pyramid.response import FileIter, FileResponse
 from pyramid.security import forget
 from pyramid.view import view_config
 from pyramid import httpexceptions
-import requests
 from openstax_accounts.interfaces import *
 
 from cnxepub.models import ATTRIBUTED_ROLE_KEYS
@@ -30,18 +31,24 @@ from .models import (
     BINDER_MEDIATYPE, DOCUMENT_MEDIATYPE, LICENSES,
     ArchiveConnectionError, DocumentNotFoundError,
     create_content, derive_content, revise_content,
-    Document, Binder, Resource,
+    Document, Resource, StoredResource,
     )
 from .schemata import (AcceptanceSchema, DocumentSchema, BinderSchema,
                        UserSchema)
+from .clients import get_client
 from .storage import storage
-from . import utils
-from .models import PublishingError
+from . import publications, utils
+from .models import PublishingConnectionError, PublishingError
 
 NO_CACHE = (0, {'public': True})
 TIMED_CACHE = (datetime.timedelta(
     weeks=1, days=0, hours=0, minutes=0, seconds=0), {'public': True})
 DEFAULT_CACHE = (None, {'public': True})
+# The session key of the time the user last wrote to the storage.
+LAST_WRITE_SESSION_KEY = 'storage.last_write'
+# Seconds to wait for publishing to respond to the upload of an epub
+# (the ``publishing.upload-timeout`` setting).
+PUBLISHING_UPLOAD_TIMEOUT = 300
 
 logger = logging.getLogger('cnxauthoring')
 
@@ -57,13 +64,15 @@ def authenticated_only(function):
 
 def storage_management(function):
     @functools.wraps(function)
-    def wrapper(*args, **kwargs):
-        try:
-            response = function(*args, **kwargs)
+    def wrapper(request, *args, **kwargs):
+        def persist():
             storage.persist()
-            return response
-        except storage.Error:
-            logger.exception('Storage failure')
+            if storage.has_replicas and request.method != 'GET':
+                # Read the user's writes from the primary for a while,
+                # see ``replica_reads``.
+                request.session[LAST_WRITE_SESSION_KEY] = time.time()
+
+        def abort():
             try:
                 storage.abort()
             except storage.Error:
@@ -72,11 +81,62 @@ def storage_management(function):
                     storage.restart()
                 except storage.Error:
                     logger.exception('Storage failed to restart')
+
+        # Models load their content and binder trees lazily, which can
+        # happen while the response is rendered; end the transaction
+        # this reads in and give back the connection used for it.
+        request.add_finished_callback(lambda request: abort())
+
+        try:
+            try:
+                response = function(request, *args, **kwargs)
+            except storage.Error:
+                raise
+            except Exception:
+                # Drop the partial changes of the failed request (including
+                # error responses) and hand back the connection, rather
+                # than leaving it idle in the transaction for the thread's
+                # next request. Views persist what they need to keep.
+                abort()
+                raise
+            persist()
+            return response
+        except storage.Error:
+            logger.exception('Storage failure')
+            try:
+                abort()
             finally:
                 raise httpexceptions.HTTPServiceUnavailable()
     return wrapper
 
 
+def replica_reads(function):
+    """Read from a replica of the storage, if there is one. The storage
+    is read from the primary after writes, and for a while after the
+    user's last write request, so that users see their own changes.
+    Used within ``storage_management``.
+    """
+    @functools.wraps(function)
+    def wrapper(request, *args, **kwargs):
+        storage.read_from_replica(
+            request.session.get(LAST_WRITE_SESSION_KEY))
+        return function(request, *args, **kwargs)
+    return wrapper
+
+
+@view_config(context=PublishingConnectionError)
+def publishing_connection_error(exc, request):
+    """Publishing didn't respond in time (502) or couldn't be reached
+    (503), e.g. while publishing or declaring roles within publishing.
+    """
+    logger.error('Publishing connection failure: {}'.format(exc))
+    if exc.timeout:
+        return httpexceptions.HTTPBadGateway(
+            'Publishing did not respond in time')
+    return httpexceptions.HTTPServiceUnavailable(
+        'Unable to connect to publishing')
+
+
 @view_config(route_name='options', request_method='OPTIONS',
              renderer='string', http_cache=DEFAULT_CACHE)
 def options(request):
@@ -115,49 +175,85 @@ def profile(request):
             utils.profile_to_user_dict(request.user))
 
 
+def is_publication_pending(content):
+    """Whether the content's publication state is non-terminal"""
+    return (content.metadata['state'] not in
+            (None,) + publications.FINAL_STATES and
+            content.metadata['publication'])
+
+
 def update_content_state(request, content):
     """Updates content state if it is non-terminal by checking w/ publishing
-    service
+    service, unless the states are kept up to date in the background
+    (see ``publications.PublicationPoller``)
     """
-    if (content.metadata['state'] not in [None, 'Done/Success'] and
-            content.metadata['publication']):
-        publishing_url = request.registry.settings['publishing.url']
-        url = urlparse.urljoin(
-            publishing_url,
-            'publications/{}'.format(content.metadata['publication']))
-        response = requests.get(url)
-        if response.status_code == 200:
-            try:
-                result = json.loads(response.content.decode('utf-8'))
-                if content.metadata['state'] != result['state']:
-                    content.update(state=result['state'])
-                    storage.update(content)
-            except (TypeError, ValueError):
-                # Not critical if there's a json problem here - perhaps log
-                # this
-                pass
+    if is_publication_pending(content) and \
+            publications.get_poller(request.registry) is None:
+        state = publications.get_publication_state(
+            content.metadata['publication'], request.registry)
+        if state is not None and content.metadata['state'] != state:
+            content.update(state=state)
+            # Only the state is written (on the primary), rather than the
+            # content, which may have been read from a replica behind it.
+            storage.update_document_state(
+                content.id, content.metadata['publication'], state,
+                content.metadata['revised'])
+
+
+def page_params(request):
+    """The ``limit`` and the key to continue after (from the ``cursor``)
+    requested for a page of results.
+    """
+    limit = after = None
+    try:
+        if request.GET.get('limit'):
+            limit = int(request.GET['limit'])
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        if request.GET.get('cursor'):
+            after = utils.decode_page_cursor(request.GET['cursor'])
+    except ValueError as e:
+        raise httpexceptions.HTTPBadRequest(str(e))
+    return limit, after
 
 
 @view_config(route_name='user-contents', request_method='GET',
              renderer='json', http_cache=NO_CACHE)
 @authenticated_only
 @storage_management
+@replica_reads
 def user_contents(request):
     """Extract of the contents that belong to the current logged in user"""
     items = []
-    binder_ids = set()
     # filter kwargs to subset of content metadata fields - avoid DB errors
     kwargs = {k: v for k, v in request.GET.items()
               if k in ['mediaType', 'state', 'containedIn']}
     if kwargs:
         utils.change_dict_keys(kwargs, utils.camelcase_to_underscore)
+    limit, after = page_params(request)
     user_id = request.unauthenticated_userid
-    contents = storage.get_all(user_id=user_id,
-                               permissions=('view',), **kwargs)
+    # Draft docs inside draft binders that this user can see are left out.
+    # One more than the limit is requested to know if there's a next page.
+    contents = storage.get_all(user_id=user_id, permissions=('view',),
+                               stream=True, exclude_contained=True,
+                               limit=limit and limit + 1, after=after,
+                               summary=True, **kwargs)
+    cursor = None
+    last_key = None
     for content in contents:
-        update_content_state(request, content)
-        if isinstance(content, Binder):
-            binder_ids.add(content.id)
+        if limit is not None and len(items) == limit:
+            cursor = utils.encode_page_cursor(*last_key)
+            break
+        # The page key, taken before a state update changes revised.
+        last_key = (content.metadata['revised'], content.id)
+        if is_publication_pending(content) and \
+                publications.get_poller(request.registry) is None:
+            # The listing only has a summary, the state is updated on
+            # the full model.
+            model = storage.get(id=content.id)
+            update_content_state(request, model)
+            content.metadata['state'] = model.metadata['state']
+            content.metadata['revised'] = model.metadata['revised']
 
         item = content.__json__()
         document = {k: item[k] for k in [
@@ -186,20 +282,18 @@ def user_contents(request):
 
         items.append(document)
 
-    # filter out draft docs inside draft binders that this user can see
-    items = [i for i in items
-             if not set(i['containedIn']).intersection(binder_ids)]
-
-    items.sort(key=lambda item: item['revised'], reverse=True)
+    results = {
+        u'items': items,
+        u'total': len(items),
+        u'limits': [],
+        }
+    if limit is not None:
+        results[u'cursor'] = cursor
     return {
             u'query': {
                 u'limits': [],
                 },
-            u'results': {
-                u'items': items,
-                u'total': len(items),
-                u'limits': [],
-                },
+            u'results': results,
             }
 
 
@@ -207,6 +301,7 @@ def user_contents(request):
              renderer='json', http_cache=NO_CACHE)
 @authenticated_only
 @storage_management
+@replica_reads
 def get_content(request):
     """Acquisition of content by id"""
     id = request.matchdict['id']
@@ -226,6 +321,7 @@ def get_content(request):
              http_cache=NO_CACHE)
 @authenticated_only
 @storage_management
+@replica_reads
 def get_resource(request):
     """Acquisition of a resource item"""
     hash = request.matchdict['hash']
@@ -234,16 +330,29 @@ def get_resource(request):
         raise httpexceptions.HTTPNotFound()
     if not request.has_permission('view', resource):
         raise httpexceptions.HTTPForbidden()
-    resp = request.response
-    with resource.open() as data:
-        resp.body = data.read()
+    if getattr(resource, 'path', None) is not None:
+        # Serve the file directly, using the server's file wrapper.
+        resp = FileResponse(resource.path, request=request)
+    elif isinstance(resource, StoredResource):
+        # Send the data as it is read, rather than loading all of it.
+        resp = request.response
+        resp.app_iter = FileIter(resource.stream())
+        resp.content_length = resource.size
+    else:
+        resp = request.response
+        with resource.open() as data:
+            resp.body = data.read()
     resp.content_type = resource.media_type
     if 'html' in resp.content_type:
         resp.content_type = 'application/octet-stream'
     return resp
 
 
-def post_content_single(request, cstruct):
+def post_content_single(request, cstruct, pending=None):
+    """Create the content of ``cstruct``. When a ``pending`` list is
+    given, the content and its resources are appended to it to be added
+    to the storage along with others, rather than added right away.
+    """
     current_uid = request.unauthenticated_userid
     utils.change_dict_keys(cstruct, utils.camelcase_to_underscore)
     derived_from = cstruct.get('derived_from')
@@ -330,25 +439,34 @@ def post_content_single(request, cstruct):
         appstruct['id'] = archive_id.split('@')[0]
         appstruct['cnx_archive_uri'] = archive_id
 
+    if pending and 'tree' in appstruct:
+        # The binder's tree is built from the stored documents, which
+        # may be among the pending items.
+        storage.add(list(pending))
+        del pending[:]
     content = create_content(**appstruct)
 
     utils.accept_license(content, user)
-    utils.declare_roles(content)
-    utils.declare_licensors(content)
-    utils.declare_acl(content)
+    utils.declare_publishing(content)
 
     resources = []
     if content.mediatype != BINDER_MEDIATYPE and (derived_from or archive_id):
         resources = utils.derive_resources(request, content)
 
     try:
-        for r in resources:
-            storage.add(r)
+        if pending is not None:
+            pending.extend(resources)
+        else:
+            for r in resources:
+                storage.add(r)
     except ArchiveConnectionError:
         raise httpexceptions.HTTPBadRequest(
             'Derive failed: {}'.format(derived_from))
 
-    content = storage.add(content)
+    if pending is not None:
+        pending.append(content)
+    else:
+        content = storage.add(content)
     if content.mediatype == BINDER_MEDIATYPE:
         utils.update_containment(content)
 
@@ -371,10 +489,14 @@ def post_content(request):
     content = None
     try:
         if isinstance(cstruct, list):
+            # The items are added together, in a few round trips.
+            pending = []
             for item in cstruct:
-                contents.append(post_content_single(request, item))
+                contents.append(post_content_single(request, item, pending))
                 if not request.has_permission('create', contents[-1]):
                     raise httpexceptions.HTTPForbidden()
+            if pending:
+                storage.add(pending)
         else:
             content = post_content_single(request, cstruct)
             if not request.has_permission('create', content):
@@ -426,7 +548,12 @@ def post_resource(request):
     return location
 
 
-def delete_content_single(request, id, user_id=None, raise_error=True):
+def delete_content_single(request, id, user_id=None, raise_error=True,
+                          removed=None):
+    """Delete the content ``id``, or the ``user_id``'s access to it.
+    When a ``removed`` list is given, the content is appended to it to be
+    removed from the storage along with others, rather than right away.
+    """
     content = storage.get(id=id)
     if content is None:
         if raise_error:
@@ -469,7 +596,12 @@ def delete_content_single(request, id, user_id=None, raise_error=True):
         finally:
             storage.update(content)
     else:
-        resource = storage.remove(content)
+        if removed is not None:
+            removed.append(content)
+        else:
+            storage.remove(content)
+        # The documents are taken out of the binder right away, so that
+        # they can be deleted after it.
         if content.metadata['media_type'] == BINDER_MEDIATYPE:
             utils.update_containment(content, deletion=True)
     return True
@@ -489,6 +621,7 @@ def delete_content(request):
         # delete multiple content
         user_id = request.authenticated_userid
         deleted_ids = []
+        removed = []
         try:
             cstruct = request.json_body
         except (TypeError, ValueError):
@@ -496,9 +629,13 @@ def delete_content(request):
         for ident_hash in cstruct:
             id = ident_hash.split('@')[0]
             succeeded = delete_content_single(
-                request, id, user_id=user_id, raise_error=False)
+                request, id, user_id=user_id, raise_error=False,
+                removed=removed)
             if succeeded:
                 deleted_ids.append(id)
+        # The content is removed together, in a few round trips.
+        if removed:
+            storage.remove(removed)
         return deleted_ids
     ident_hash = request.matchdict['ident_hash']
     id = ident_hash.split('@')[0]
@@ -549,9 +686,7 @@ def put_content(request):
     except DocumentNotFoundError as e:
         raise httpexceptions.HTTPBadRequest(e.message)
     utils.accept_license(content, user)
-    utils.declare_roles(content)
-    utils.declare_licensors(content)
-    utils.declare_acl(content)
+    utils.declare_publishing(content)
     storage.update(content)
     if content.mediatype == BINDER_MEDIATYPE:
         utils.update_containment(content)
@@ -570,6 +705,7 @@ def put_content(request):
              renderer='json', http_cache=NO_CACHE)
 @authenticated_only
 @storage_management
+@replica_reads
 def search_content(request):
     """Search documents by title and contents"""
     empty_response = {
@@ -586,25 +722,38 @@ def search_content(request):
     if not q:
         return empty_response
     q = utils.structured_query(q)
+    limit, after = page_params(request)
 
-    result = storage.search(q, submitter_id=request.unauthenticated_userid)
+    # One more than the limit is requested to know if there's a next page.
+    result = storage.search(q, submitter_id=request.unauthenticated_userid,
+                            limit=limit and limit + 1, after=after)
     items = []
+    cursor = None
+    last_key = None
     for content in result:
+        if limit is not None and len(items) == limit:
+            cursor = utils.encode_page_cursor(*last_key)
+            break
+        last_key = (content.metadata['revised'], content.id)
         document = content.__json__()
         document['id'] = '@'.join([document['id'], document['version']])
         items.append(document)
+    results = {
+        u'items': items,
+        u'total': len(items),
+        u'limits': [],
+        }
+    if limit is not None:
+        results[u'cursor'] = cursor
     return {
             u'query': {
                 u'limits': [{'tag': tag, 'value': value} for tag, value in q],
                 },
-            u'results': {
-                u'items': items,
-                u'total': len(items),
-                u'limits': [],
-                },
+            u'results': results,
             }
 
 
+@utils.publishing_connection
 def post_to_publishing(request, userid, submitlog, content_ids,
                        license=None):
     """all params come from publish post. Content_ids is a json list of lists,
@@ -670,7 +819,13 @@ def post_to_publishing(request, userid, submitlog, content_ids,
     publishing_url = request.registry.settings['publishing.url']
     url = urlparse.urljoin(publishing_url, 'publications')
     headers = {'x-api-key': api_key}
-    return contents, requests.post(url, files=files, headers=headers)
+    publishing = get_client('publishing', request.registry)
+    # Publishing processes the epub before responding, which takes longer
+    # than its other requests.
+    timeout = (publishing.timeout[0], float(request.registry.settings.get(
+        'publishing.upload-timeout', PUBLISHING_UPLOAD_TIMEOUT)))
+    return contents, publishing.post(url, files=files, headers=headers,
+                                     timeout=timeout)
 
 
 @view_config(route_name='publish', request_method='POST',
@@ -709,8 +864,15 @@ def publish(request):
         raise httpexceptions.HTTPBadRequest(
             'Unable to publish: response body: {}'.format(
                 response.content.decode('utf-8')))
+    poller = publications.get_poller(request.registry)
+    if poller is not None:
+        # Follow the publication from when it is stored.
+        request.add_finished_callback(lambda request: poller.wake())
 
     if result['state'] == 'Failed/Error':
+        # Keep the failed publication state of the contents, which the
+        # error response would otherwise abort.
+        storage.persist()
         # FIXME: when publishing becomes asynchronous
         # the response will always be a 201 Created
         raise httpexceptions.HTTPBadRequest(
@@ -725,6 +887,7 @@ def publish(request):
              renderer='json', http_cache=NO_CACHE)
 @authenticated_only
 @storage_management
+@replica_reads
 def get_acceptance_info(request):
     """Retrieve role and license acceptance info
     on the routed content for the authenticated user.
@@ -841,9 +1004,7 @@ def post_acceptance_info(request):
     for role_type, has_accepted, index in tobe_updated_roles:
         content.metadata[role_type][index]['has_accepted'] = has_accepted
 
-    utils.declare_roles(content)
-    utils.declare_licensors(content)
-    utils.declare_acl(content)
+    utils.declare_publishing(content)
 
     if tobe_updated_roles:
         storage.update(content)
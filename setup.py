@@ -8,7 +8,7 @@ install_requires = (
         'openstax-accounts>=1.0.0',
         'PasteDeploy',
         'pyramid',
-        'psycopg2>=2.5',
+        'psycopg2>=2.7',
         'requests',
         'pytz',
         'tzlocal',